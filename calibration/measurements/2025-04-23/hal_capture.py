@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# Realtime capture of the gantry joints and axes with the HAL sampler
+# See the LinuxCNC HAL manual, sampler and halsampler components
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Optional
+
+# Prefix of the pins and parameters exported by the calibxyzkins module
+KINS_PREFIX = "calibxzkins"
+
+# Name of the sampler instance
+SAMPLER = "sampler.0"
+
+# Sampler configuration letter for each HAL type
+HAL_TYPE_CFG = {"float": "f", "bit": "b", "s32": "s", "u32": "u"}
+
+
+def halcmd(*args: str) -> str:
+    return subprocess.run(
+        ["halcmd", *args], check=True, capture_output=True, text=True
+    ).stdout
+
+
+def get_pin_signal(pin: str) -> Optional[str]:
+    """Name of the signal linked to a pin, or None if the pin is not linked."""
+    for line in halcmd("-s", "show", "pin", pin).splitlines():
+        tokens = line.split()
+        if pin in tokens and ("==>" in tokens or "<==" in tokens or "<=>" in tokens):
+            return tokens[-1]
+    return None
+
+
+def get_channels(coordinates: str, calibxyzkins: bool) -> list[tuple[str, str]]:
+    """Pins and HAL types of the captured channels."""
+    channels = []
+
+    for jno in range(len(coordinates)):
+        channels.append((f"joint.{jno}.pos-cmd", "float"))
+        channels.append((f"joint.{jno}.pos-fb", "float"))
+        channels.append((f"joint.{jno}.f-error", "float"))
+
+    for axis in sorted(set(coordinates.lower()) & set("xyz")):
+        channels.append((f"axis.{axis}.pos-cmd", "float"))
+
+    if calibxyzkins:
+        channels.append((f"{KINS_PREFIX}.inverse-iter", "u32"))
+        channels.append((f"{KINS_PREFIX}.inverse-error", "float"))
+
+    return channels
+
+
+def get_kinematics_params() -> dict[str, list]:
+    """Read the calibration matrices A, B and vector C of calibxyzkins."""
+    coords = "xyz"
+
+    def getp(name: str) -> float:
+        return float(halcmd("getp", f"{KINS_PREFIX}.{name}").strip())
+
+    return {
+        "A": [[getp(f"calib-a.{r}{c}") for c in coords] for r in coords],
+        "B": [[getp(f"calib-b.{r}{c}") for c in coords] for r in coords],
+        "C": [getp(f"calib-c.{r}") for r in coords],
+    }
+
+
+def setup_sampler(channels: list[tuple[str, str]], depth: int, thread: str):
+    cfg = "".join(HAL_TYPE_CFG[hal_type] for _, hal_type in channels)
+    halcmd("loadrt", "sampler", f"depth={depth}", f"cfg={cfg}")
+    halcmd("setp", f"{SAMPLER}.enable", "0")
+
+    for i, (pin, _) in enumerate(channels):
+        signal_name = get_pin_signal(pin) or f"capture-{pin.replace('.', '-')}"
+        halcmd("net", signal_name, pin, f"{SAMPLER}.pin.{i}")
+
+    halcmd("addf", SAMPLER, thread)
+
+
+def teardown_sampler(thread: str):
+    halcmd("delf", SAMPLER, thread)
+    halcmd("unloadrt", "sampler")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Capture joint and axis positions at servo rate with the HAL sampler",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--output",
+        help="Path to the JSON metadata file of the capture. The samples are "
+        "written to a file with the same name and the .txt extension",
+        type=str,
+        default="take_gantry_hal.json",
+    )
+
+    parser.add_argument(
+        "--coordinates",
+        help="Coordinates of the joints as in the kinematics module",
+        type=str,
+        default="XXYZ",
+    )
+
+    parser.add_argument(
+        "--servo-period",
+        help="Servo thread period in nanoseconds ([EMCMOT]SERVO_PERIOD)",
+        type=int,
+        default=1000000,
+    )
+
+    parser.add_argument(
+        "--thread",
+        help="HAL thread where the sampler function is added",
+        type=str,
+        default="servo-thread",
+    )
+
+    parser.add_argument(
+        "--depth",
+        help="Depth of the sampler FIFO in samples",
+        type=int,
+        default=16000,
+    )
+
+    parser.add_argument(
+        "--calibxyzkins",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Capture the inverse kinematics convergence of calibxyzkins and "
+        "save its calibration parameters",
+    )
+
+    args = parser.parse_args()
+
+    data_file = os.path.splitext(args.output)[0] + ".txt"
+    channels = get_channels(args.coordinates, args.calibxyzkins)
+
+    setup_sampler(channels, args.depth, args.thread)
+    sampler_proc: Optional[subprocess.Popen] = None
+
+    try:
+        with open(data_file, "w") as f:
+            # Tag each sample with its number to detect lost samples
+            sampler_proc = subprocess.Popen(["halsampler", "-t"], stdout=f)
+
+            t_before = time.time()
+            halcmd("setp", f"{SAMPLER}.enable", "1")
+            t_after = time.time()
+
+            metadata = {
+                "data_file": os.path.basename(data_file),
+                "start_time": (t_before + t_after) / 2,
+                "servo_period": args.servo_period * 1e-9,
+                "coordinates": args.coordinates,
+                "channels": [pin for pin, _ in channels],
+                "kinematics": get_kinematics_params() if args.calibxyzkins else None,
+            }
+
+            with open(args.output, "w") as f_meta:
+                json.dump(metadata, f_meta, indent=2)
+
+            print("Capturing, press Ctrl+C to stop...", file=sys.stderr)
+
+            try:
+                sampler_proc.wait()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        halcmd("setp", f"{SAMPLER}.enable", "0")
+        overruns = halcmd("getp", f"{SAMPLER}.overruns").strip()
+
+        if sampler_proc is not None and sampler_proc.poll() is None:
+            sampler_proc.send_signal(signal.SIGINT)
+            sampler_proc.wait()
+
+        teardown_sampler(args.thread)
+        print(f"Sampler overruns: {overruns}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except subprocess.CalledProcessError as e:
+        print("error: ", e.stderr or e)
+        print("is LinuxCNC running?")
+        sys.exit(1)
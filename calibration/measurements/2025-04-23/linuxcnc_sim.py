@@ -0,0 +1,298 @@
+# Offline simulator of the linuxcnc Python module
+# Implements the subset of the interface used by run_measurement.py, with the
+# axes moving along trapezoidal velocity profiles limited by the INI file.
+#
+# Usage:
+#   import linuxcnc_sim
+#   linuxcnc_sim.configure("citic_gantry_robot.ini", time_scale=100)
+#   sys.modules["linuxcnc"] = linuxcnc_sim
+
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from measurements_utils import (
+    DEFAULT_INI,
+    MachineLimits,
+    TrapezoidProfile,
+    linear_move_profile,
+    load_machine_limits,
+)
+
+MODE_MANUAL = 1
+MODE_AUTO = 2
+MODE_MDI = 3
+
+AUTO_RUN = 0
+AUTO_STEP = 1
+AUTO_PAUSE = 2
+AUTO_RESUME = 3
+
+INTERP_IDLE = 1
+INTERP_READING = 2
+INTERP_PAUSED = 3
+INTERP_WAITING = 4
+
+RCS_DONE = 1
+RCS_EXEC = 2
+RCS_ERROR = 3
+
+NUM_JOINTS = 4  # XXYZ
+MAX_JOINTS = 16
+
+Position = tuple[float, float, float]
+
+
+class error(RuntimeError):
+    pass
+
+
+class SimClock:
+    """Clock of the simulation running time_scale times faster than real time.
+
+    It provides the functions of the time module used by the measurement
+    scripts, so it can replace the time module of those scripts.
+    """
+
+    def __init__(self, time_scale: float = 1.0):
+        assert time_scale > 0, "time_scale must be positive"
+        self.time_scale = time_scale
+        self.real_start_ns = time.monotonic_ns()
+        self.wall_start_ns = time.time_ns()
+
+    def monotonic_ns(self) -> int:
+        return round((time.monotonic_ns() - self.real_start_ns) * self.time_scale)
+
+    def monotonic(self) -> float:
+        return self.monotonic_ns() / 1e9
+
+    def time_ns(self) -> int:
+        return self.wall_start_ns + self.monotonic_ns()
+
+    def time(self) -> float:
+        return self.time_ns() / 1e9
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds / self.time_scale)
+
+    def real_elapsed(self) -> float:
+        return (time.monotonic_ns() - self.real_start_ns) / 1e9
+
+
+@dataclass
+class Segment:
+    start_time: float
+    start: Position
+    end: Position
+    profile: TrapezoidProfile
+
+    @property
+    def end_time(self) -> float:
+        return self.start_time + self.profile.duration
+
+    def position_at(self, t: float) -> Position:
+        if self.profile.distance == 0:
+            return self.end
+
+        f = self.profile.distance_at(t - self.start_time) / self.profile.distance
+        return (
+            self.start[0] + f * (self.end[0] - self.start[0]),
+            self.start[1] + f * (self.end[1] - self.start[1]),
+            self.start[2] + f * (self.end[2] - self.start[2]),
+        )
+
+
+class Machine:
+    """Motion timeline of the simulated gantry.
+
+    The moves are queued as segments that start when the previous one ends,
+    i.e., the moves are run in exact stop mode without path blending.
+    """
+
+    def __init__(self, limits: MachineLimits, clock: SimClock):
+        self.limits = limits
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        self.mode = MODE_MANUAL
+        self.feed_rate = 0.0
+        self.segments: list[Segment] = []
+        self.position: Position = (0.0, 0.0, 0.0)  # at the end of the queue
+        self.end_time = 0.0
+        self.program: Optional[list[str]] = None
+        self.program_end_time: Optional[float] = None
+
+    def now(self) -> float:
+        return self.clock.monotonic()
+
+    def position_at(self, t: float) -> Position:
+        # Drop the segments already finished, they are not needed anymore
+        while len(self.segments) > 1 and self.segments[0].end_time <= t:
+            self.segments.pop(0)
+
+        if not self.segments:
+            return self.position
+        if t <= self.segments[0].start_time:
+            return self.segments[0].start
+        return self.segments[0].position_at(t)
+
+    def queue_move(self, target: list[Optional[float]], rapid: bool = False):
+        start_time = max(self.end_time, self.now())
+        end: Position = tuple(  # type: ignore[assignment]
+            p if t is None else t for p, t in zip(self.position, target)
+        )
+
+        for value, axis in zip(end, "XYZ"):
+            axis_limits = self.limits.axes[axis]
+            if not axis_limits.min_limit <= value <= axis_limits.max_limit:
+                raise error(f"{axis}{value} exceeds the soft limits of the axis")
+
+        feed_rate = float("inf") if rapid else self.feed_rate
+        if feed_rate <= 0:
+            raise error("Linear move with zero feed rate")
+
+        profile = linear_move_profile(self.position, end, feed_rate, self.limits)
+        self.segments.append(Segment(start_time, self.position, end, profile))
+        self.position = end
+        self.end_time = start_time + profile.duration
+
+    def execute(self, line: str):
+        """Execute a line of G-code, only linear moves are simulated."""
+        line = re.sub(r"\(.*?\)|;.*", "", line).upper()
+        words = re.findall(r"([A-Z])\s*([-+]?[0-9.]+)", line)
+
+        target: list[Optional[float]] = [None, None, None]
+        motion = None
+        for letter, value in words:
+            if letter == "G" and float(value) in (0, 1):
+                motion = int(float(value))
+            elif letter == "F":
+                self.feed_rate = float(value)
+            elif letter in "XYZ":
+                target["XYZ".index(letter)] = float(value)
+            elif letter == "G" and float(value) == 4:
+                motion = 4
+            elif letter == "P" and motion == 4:
+                self.end_time = max(self.end_time, self.now()) + float(value)
+
+        if any(t is not None for t in target):
+            self.queue_move(target, rapid=motion == 0)
+
+    def abort(self):
+        """Stop at the current position (with infinite deceleration)."""
+        now = self.now()
+        self.position = self.position_at(now)
+        self.segments.clear()
+        self.end_time = now
+        self.program_end_time = None
+
+
+_machine: Optional[Machine] = None
+
+
+def configure(
+    ini_filename: str = DEFAULT_INI, time_scale: float = 1.0
+) -> SimClock:
+    """Create the simulated machine and return its clock."""
+    global _machine
+    _machine = Machine(load_machine_limits(ini_filename), SimClock(time_scale))
+    return _machine.clock
+
+
+def get_machine() -> Machine:
+    if _machine is None:
+        configure()
+    assert _machine is not None
+    return _machine
+
+
+class stat:
+    def __init__(self):
+        self.machine = get_machine()
+        self.estop = 0
+        self.enabled = True
+        self.joints = NUM_JOINTS
+        self.homed = (1,) * NUM_JOINTS + (0,) * (MAX_JOINTS - NUM_JOINTS)
+        self.task_mode = MODE_MANUAL
+        self.interp_state = INTERP_IDLE
+        self.actual_position = (0.0,) * 9
+        self.position = self.actual_position
+
+    def poll(self):
+        m = self.machine
+        with m.lock:
+            now = m.now()
+            x, y, z = m.position_at(now)
+            self.task_mode = m.mode
+            running = m.program_end_time is not None and now < m.program_end_time
+
+        self.interp_state = INTERP_READING if running else INTERP_IDLE
+        self.actual_position = (x, y, z, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        self.position = self.actual_position
+
+
+class command:
+    def __init__(self):
+        self.machine = get_machine()
+        self.wait_time = 0.0  # motion time that wait_complete waits for
+
+    def mode(self, mode: int):
+        with self.machine.lock:
+            self.machine.mode = mode
+
+    def mdi(self, gcode: str):
+        m = self.machine
+        with m.lock:
+            if m.mode != MODE_MDI:
+                raise error("mdi command requires MODE_MDI")
+            m.execute(gcode)
+            self.wait_time = m.end_time
+
+    def wait_complete(self, timeout: float = 5.0) -> int:
+        """Wait until the last MDI command is completed.
+
+        The timeout is in seconds of the simulation, a negative value waits
+        forever. Returns -1 on timeout like linuxcnc.command.wait_complete.
+        """
+        m = self.machine
+        remaining = self.wait_time - m.now()
+
+        if remaining <= 0:
+            return RCS_DONE
+        if 0 <= timeout < remaining:
+            m.clock.sleep(timeout)
+            return -1
+
+        m.clock.sleep(remaining)
+        return RCS_DONE
+
+    def program_open(self, filename: str):
+        with open(filename) as f:
+            program = f.read().splitlines()
+
+        with self.machine.lock:
+            self.machine.program = program
+
+    def auto(self, auto_type: int, line: int = 0):
+        m = self.machine
+        with m.lock:
+            if m.mode != MODE_AUTO:
+                raise error("auto command requires MODE_AUTO")
+            if auto_type != AUTO_RUN:
+                raise error("Only AUTO_RUN is simulated")
+            if m.program is None:
+                raise error("No program open")
+
+            for gcode in m.program[line:]:
+                if re.match(r"\s*[Mm]0*[23]\b", gcode):
+                    break
+                m.execute(gcode)
+
+            m.program_end_time = m.end_time
+
+    def abort(self):
+        with self.machine.lock:
+            self.machine.abort()
+        self.wait_time = 0.0
@@ -1,5 +1,15 @@
+import configparser
+import csv
+import os
+from dataclasses import dataclass
 from enum import StrEnum
-from typing import Literal
+from typing import Literal, Optional
+
+# INI file of the gantry LinuxCNC configuration
+DEFAULT_INI = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "../../../linuxcnc/configs/citic_gantry_robot/citic_gantry_robot.ini",
+)
 
 
 class Direction(StrEnum):
@@ -11,6 +21,11 @@ class Direction(StrEnum):
 
 Coordinate = tuple[float, float]
 
+# Linear move, None coordinates are not moved
+Move = tuple[Optional[float], Optional[float], Optional[float]]
+
+Position = tuple[float, float, float]
+
 
 def snake_move(
     start: Coordinate,
@@ -47,3 +62,235 @@ def snake_move(
         (float(start[0] + x * x_factor), float(start[1] + y * y_factor))
         for x, y in coordinates
     ]
+
+
+def snake_moves(
+    start_xy: Coordinate,
+    end_xy: Coordinate,
+    turns: int,
+    z_coords: list[float],
+) -> list[Move]:
+    """Horizontal and vertical serpentines over the XY workspace per Z level."""
+    coordinates = snake_move(start_xy, end_xy, turns, "H")[:-1]
+    coordinates += snake_move(end_xy, start_xy, turns, "V")
+
+    moves: list[Move] = []
+    for z in z_coords:
+        moves.append((None, None, z))
+        moves += [(x, y, None) for x, y in coordinates]
+
+    return moves
+
+
+def save_waypoints(filename: str, moves: list[Move]):
+    """Save the moves to a CSV file, empty values are not moved."""
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["x", "y", "z"])
+        writer.writerows(["" if v is None else v for v in move] for move in moves)
+
+
+def load_waypoints(filename: str) -> list[Move]:
+    """Load the moves saved with save_waypoints."""
+    with open(filename, newline="") as f:
+        return [
+            tuple(  # type: ignore[misc]
+                None if row[axis] == "" else float(row[axis]) for axis in "xyz"
+            )
+            for row in csv.DictReader(f)
+        ]
+
+
+def gcode_move(
+    x: Optional[float] = None,
+    y: Optional[float] = None,
+    z: Optional[float] = None,
+    feed_rate: Optional[float] = None,
+) -> str:
+    gcode = "G1"
+
+    if x is not None:
+        gcode += f" X{x}"
+    if y is not None:
+        gcode += f" Y{y}"
+    if z is not None:
+        gcode += f" Z{z}"
+    if feed_rate is not None:
+        gcode += f" F{feed_rate}"
+
+    return gcode
+
+
+def gcode_dwell(seconds: float) -> str:
+    return f"G4 P{seconds}"
+
+
+def gcode_program(
+    moves: list[Move],
+    feed_rate: float,
+    blend_tolerance: Optional[float] = None,
+    dwell: Optional[float] = None,
+) -> str:
+    """G-code program with a sequence of linear moves.
+
+    If blend_tolerance is given the trajectory planner is allowed to blend
+    consecutive moves with G64 deviating at most blend_tolerance from the path,
+    otherwise the moves are run in exact stop mode (G61). If dwell is given the
+    machine stops for dwell seconds at the end of each move, which also
+    prevents the blending.
+    """
+    lines = [
+        "G21 G90 G17",
+        "G61" if blend_tolerance is None else f"G64 P{blend_tolerance}",
+        f"F{feed_rate}",
+    ]
+    for x, y, z in moves:
+        lines.append(gcode_move(x, y, z))
+        if dwell is not None:
+            lines.append(gcode_dwell(dwell))
+    lines.append("M2")
+
+    return "\n".join(lines) + "\n"
+
+
+@dataclass
+class AxisLimits:
+    max_velocity: float  # units per second
+    max_acceleration: float  # units per second^2
+    min_limit: float
+    max_limit: float
+
+
+@dataclass
+class MachineLimits:
+    axes: dict[str, AxisLimits]
+    max_linear_velocity: float  # units per second
+    max_linear_acceleration: float  # units per second^2
+
+
+def load_machine_limits(ini_filename: str) -> MachineLimits:
+    """Load the XYZ axes and trajectory limits from a LinuxCNC INI file."""
+    ini = configparser.ConfigParser(
+        strict=False, interpolation=None, comment_prefixes=("#", ";")
+    )
+    ini.optionxform = str  # type: ignore[assignment, method-assign]
+    ini.read(ini_filename)
+
+    axes = {
+        axis: AxisLimits(
+            max_velocity=ini.getfloat(f"AXIS_{axis}", "MAX_VELOCITY"),
+            max_acceleration=ini.getfloat(f"AXIS_{axis}", "MAX_ACCELERATION"),
+            min_limit=ini.getfloat(f"AXIS_{axis}", "MIN_LIMIT"),
+            max_limit=ini.getfloat(f"AXIS_{axis}", "MAX_LIMIT"),
+        )
+        for axis in "XYZ"
+    }
+
+    return MachineLimits(
+        axes=axes,
+        max_linear_velocity=ini.getfloat(
+            "TRAJ", "MAX_LINEAR_VELOCITY", fallback=float("inf")
+        ),
+        max_linear_acceleration=ini.getfloat(
+            "TRAJ", "MAX_LINEAR_ACCELERATION", fallback=float("inf")
+        ),
+    )
+
+
+@dataclass
+class TrapezoidProfile:
+    """Trapezoidal velocity profile of a linear move from rest to rest."""
+
+    distance: float
+    velocity: float  # cruise (or peak) velocity
+    acceleration: float
+    t_acc: float  # acceleration and deceleration time
+    duration: float
+
+    def distance_at(self, t: float) -> float:
+        """Distance traveled t seconds after the start of the move."""
+        if t <= 0:
+            return 0.0
+        if t >= self.duration:
+            return self.distance
+        if t < self.t_acc:
+            return 0.5 * self.acceleration * t**2
+
+        d_acc = 0.5 * self.acceleration * self.t_acc**2
+        t_dec = self.duration - self.t_acc
+        if t <= t_dec:
+            return d_acc + self.velocity * (t - self.t_acc)
+
+        t_left = self.duration - t
+        return self.distance - 0.5 * self.acceleration * t_left**2
+
+
+def trapezoid_profile(
+    distance: float, max_velocity: float, max_acceleration: float
+) -> TrapezoidProfile:
+    """Fastest rest-to-rest profile over a distance with the given limits."""
+    if distance <= 0:
+        return TrapezoidProfile(0.0, 0.0, max_acceleration, 0.0, 0.0)
+
+    t_acc = max_velocity / max_acceleration
+    if max_acceleration * t_acc**2 >= distance:
+        # Triangular profile, the cruise velocity is not reached
+        t_acc = (distance / max_acceleration) ** 0.5
+        velocity = max_acceleration * t_acc
+        duration = 2 * t_acc
+    else:
+        velocity = max_velocity
+        duration = 2 * t_acc + (distance - max_acceleration * t_acc**2) / velocity
+
+    return TrapezoidProfile(distance, velocity, max_acceleration, t_acc, duration)
+
+
+def linear_move_profile(
+    start: Position,
+    end: Position,
+    feed_rate: float,
+    limits: MachineLimits,
+) -> TrapezoidProfile:
+    """Profile of a coordinated linear move with a feed rate in units/min.
+
+    The velocity and acceleration along the path are limited by the feed
+    rate, the trajectory limits, and the axis limits projected on the path
+    direction, like the LinuxCNC trajectory planner in exact stop mode.
+    """
+    delta = [e - s for s, e in zip(start, end)]
+    distance = sum(d**2 for d in delta) ** 0.5
+    if distance == 0:
+        return trapezoid_profile(0.0, 1.0, 1.0)
+
+    max_velocity = min(feed_rate / 60, limits.max_linear_velocity)
+    max_acceleration = limits.max_linear_acceleration
+
+    for d, axis in zip(delta, "XYZ"):
+        if d != 0:
+            scale = distance / abs(d)
+            max_velocity = min(max_velocity, limits.axes[axis].max_velocity * scale)
+            max_acceleration = min(
+                max_acceleration, limits.axes[axis].max_acceleration * scale
+            )
+
+    return trapezoid_profile(distance, max_velocity, max_acceleration)
+
+
+def move_time(
+    start: Position, end: Position, feed_rate: float, limits: MachineLimits
+) -> float:
+    """Duration in seconds of a linear move in exact stop mode."""
+    return linear_move_profile(start, end, feed_rate, limits).duration
+
+
+def take_duration(
+    positions: list[Position],
+    start: Position,
+    feed_rate: float,
+    limits: MachineLimits,
+) -> float:
+    """Estimated duration in seconds of visiting the positions in order."""
+    return sum(
+        move_time(a, b, feed_rate, limits)
+        for a, b in zip([start, *positions[:-1]], positions)
+    )
@@ -0,0 +1,186 @@
+import sys
+import threading
+import time
+from array import array
+from typing import Protocol, Sequence, TextIO
+
+
+class PositionStat(Protocol):
+    """Subset of linuxcnc.stat used by the position logger."""
+
+    actual_position: Sequence[float]
+
+    def poll(self) -> None: ...
+
+
+class PositionLogger:
+    """Log the gantry position at a fixed rate from a background thread.
+
+    A sampling thread polls the stat channel every 1/rate seconds and stores the
+    position with a time.monotonic_ns() timestamp in a preallocated ring buffer.
+    A writer thread flushes the buffered samples to the output file in bulk, so
+    the sampling loop never blocks on I/O.
+
+    The output is a CSV file with the columns time, x, y, z, and monotonic_ns,
+    where time is the wall-clock time in seconds obtained from the monotonic
+    timestamp and the wall-clock offset measured when the logger starts. Thus,
+    the time column keeps the format expected by load_gantry_data but without
+    the jitter of the wall clock.
+
+    The stat object must not be shared with other threads. Any object with a
+    poll() method and an actual_position attribute can be used, e.g., a
+    simulator of the linuxcnc module.
+
+    Args:
+        stat: Status channel to poll, e.g., linuxcnc.stat()
+        file: Text file where the samples are written
+        rate: Sampling rate in Hz
+        capacity: Number of samples of the ring buffer
+        flush_size: Number of samples that triggers a flush of the buffer
+        flush_interval: Maximum time in seconds between flushes
+        write_header: Whether to write the CSV header
+    """
+
+    def __init__(
+        self,
+        stat: PositionStat,
+        file: TextIO,
+        rate: float = 100.0,
+        capacity: int = 16384,
+        flush_size: int = 1024,
+        flush_interval: float = 1.0,
+        write_header: bool = True,
+    ):
+        assert rate > 0, "rate must be positive"
+        assert 0 < flush_size <= capacity, "flush_size must be in (0, capacity]"
+
+        self.stat = stat
+        self.file = file
+        self.period_ns = round(1e9 / rate)
+        self.capacity = capacity
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.write_header = write_header
+
+        # Ring buffer. head and tail are the total number of samples stored and
+        # flushed, respectively, the buffer index is obtained modulo capacity.
+        self.timestamps = array("q", bytes(8 * capacity))
+        self.positions = array("d", bytes(8 * 3 * capacity))
+        self.head = 0
+        self.tail = 0
+
+        # Statistics
+        self.num_dropped = 0
+        self.num_overruns = 0
+
+        self.wall_offset_ns = 0
+        self.lock = threading.Lock()
+        self.data_ready = threading.Condition(self.lock)
+        self.stop_event = threading.Event()
+        self.sampler_thread = threading.Thread(target=self.sample_loop, daemon=True)
+        self.writer_thread = threading.Thread(target=self.write_loop, daemon=True)
+
+    def start(self):
+        if self.write_header:
+            self.file.write("time,x,y,z,monotonic_ns\n")
+
+        self.wall_offset_ns = time.time_ns() - time.monotonic_ns()
+        self.stop_event.clear()
+        self.sampler_thread.start()
+        self.writer_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.sampler_thread.join()
+
+        with self.data_ready:
+            self.data_ready.notify()
+
+        self.writer_thread.join()
+        self.file.flush()
+
+        if self.num_dropped or self.num_overruns:
+            print(
+                f"Position logger: {self.num_dropped} samples dropped, "
+                f"{self.num_overruns} sampling deadlines missed",
+                file=sys.stderr,
+            )
+
+    def __enter__(self) -> "PositionLogger":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def sample(self):
+        """Poll the stat channel and store a sample in the ring buffer."""
+        self.stat.poll()
+        timestamp = time.monotonic_ns()
+        x, y, z = self.stat.actual_position[:3]
+
+        with self.lock:
+            if self.head - self.tail >= self.capacity:
+                # The writer is not keeping up, drop the new sample
+                self.num_dropped += 1
+                return
+
+            i = self.head % self.capacity
+            self.timestamps[i] = timestamp
+            self.positions[3 * i] = x
+            self.positions[3 * i + 1] = y
+            self.positions[3 * i + 2] = z
+            self.head += 1
+
+            if self.head - self.tail >= self.flush_size:
+                self.data_ready.notify()
+
+    def sample_loop(self):
+        next_ns = time.monotonic_ns()
+
+        while not self.stop_event.is_set():
+            self.sample()
+
+            next_ns += self.period_ns
+            delay_ns = next_ns - time.monotonic_ns()
+
+            if delay_ns > 0:
+                time.sleep(delay_ns / 1e9)
+            else:
+                # Missed the deadline, resynchronize instead of bursting
+                self.num_overruns += 1
+                next_ns = time.monotonic_ns()
+
+    def write_samples(self, start: int, end: int):
+        """Write the samples in the [start, end) range of the ring buffer."""
+        lines = []
+        for n in range(start, end):
+            i = n % self.capacity
+            timestamp = self.timestamps[i]
+            t = (timestamp + self.wall_offset_ns) / 1e9
+            x, y, z = self.positions[3 * i : 3 * i + 3]
+            lines.append(f"{t!r},{x!r},{y!r},{z!r},{timestamp}\n")
+
+        self.file.write("".join(lines))
+
+    def write_loop(self):
+        while True:
+            with self.data_ready:
+                self.data_ready.wait_for(
+                    lambda: self.head - self.tail >= self.flush_size
+                    or self.stop_event.is_set(),
+                    timeout=self.flush_interval,
+                )
+                start, end = self.tail, self.head
+                stopping = self.stop_event.is_set()
+
+            # The sampler does not overwrite samples until the tail is updated,
+            # so they can be written without holding the lock
+            if end > start:
+                self.write_samples(start, end)
+
+                with self.lock:
+                    self.tail = end
+
+            if stopping and end == self.head:
+                break
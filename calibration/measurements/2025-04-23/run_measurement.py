@@ -2,15 +2,23 @@
 # Example of LinuxCNC control with Python
 # See the LinucCNC user manual, section 13.5 - Python Interface
 
+import argparse
+import os
 import sys
-import linuxcnc
 import time
-import sys
+import linuxcnc
 
 from collections.abc import Callable
 from typing import Optional
 
-from measurements_utils import snake_move
+from measurements_utils import (
+    gcode_dwell,
+    gcode_move,
+    gcode_program,
+    load_waypoints,
+    snake_moves,
+)
+from position_logger import PositionLogger
 
 
 def set_feed_rate(c: linuxcnc.command, v: float):
@@ -27,18 +35,7 @@ def go_to(
     wait_timeout: float = -1,
     callback: Optional[Callable[[], None]] = None,
 ):
-    mdi_str = "G1"
-
-    if x is not None:
-        mdi_str += f" X{x}"
-    if y is not None:
-        mdi_str += f" Y{y}"
-    if z is not None:
-        mdi_str += f" Z{z}"
-    if feed_rate is not None:
-        mdi_str += f" F{feed_rate}"
-
-    c.mdi(mdi_str)
+    c.mdi(gcode_move(x, y, z, feed_rate))
     if callback is not None:
         callback()
 
@@ -50,17 +47,50 @@ def go_to(
         print("RCS_ERROR", file=sys.stderr)
 
 
+def run_program(
+    c: linuxcnc.command,
+    s: linuxcnc.stat,
+    filename: str,
+    poll_period: float = 0.1,
+):
+    """Run a G-code program in auto mode and wait until it finishes."""
+    c.mode(linuxcnc.MODE_AUTO)
+    c.wait_complete()
+    c.program_open(os.path.abspath(filename))
+    c.auto(linuxcnc.AUTO_RUN, 0)
+
+    if c.wait_complete() == linuxcnc.RCS_ERROR:
+        print("RCS_ERROR", file=sys.stderr)
+        return
+
+    while True:
+        s.poll()
+        if s.interp_state == linuxcnc.INTERP_IDLE:
+            break
+        time.sleep(poll_period)
+
+
 def program_robot(
     c: linuxcnc.command,
     s: linuxcnc.stat,
+    program_file: Optional[str] = None,
+    blend_tolerance: Optional[float] = None,
+    waypoints_file: Optional[str] = None,
+    dwell: Optional[float] = None,
 ) -> None:
+    """Run the measurement movements.
 
-    print("time,x,y,z")
+    The moves are the serpentines of the default take, or the waypoints of
+    waypoints_file, e.g., planned with trajectory_planner.py.
 
-    def write_coordinates():
-        s.poll()
-        print(",".join(str(x) for x in (time.time(), *s.actual_position[:3])))
+    If dwell is given the gantry stays still for dwell seconds at the end of
+    each move, so static measurements can be averaged at each waypoint.
 
+    By default each move is sent as an MDI command that blocks until it is
+    completed. If program_file is given, all the moves are compiled into a
+    G-code program that is run in auto mode, so the trajectory planner can
+    blend consecutive moves within blend_tolerance.
+    """
     # -------------------------
     # Robot movement parameters
     # -------------------------
@@ -76,17 +106,78 @@ def program_robot(
     # -------------------------
     # Robot movement commands
     # -------------------------
-    coordinates = snake_move(start_xy, end_xy, turns, "H")[:-1]
-    coordinates += snake_move(end_xy, start_xy, turns, "V")
+    if waypoints_file is not None:
+        moves = load_waypoints(waypoints_file)
+    else:
+        moves = snake_moves(start_xy, end_xy, turns, z_coords)
+
+    if program_file is not None:
+        with open(program_file, "w") as f:
+            f.write(gcode_program(moves, feed_rate, blend_tolerance, dwell))
+        run_program(c, s, program_file)
+        return
 
     set_feed_rate(c, feed_rate)
-    for z in z_coords:
-        go_to(c, z=z, wait_timeout=wait_timeout, callback=write_coordinates)
-        for x, y in coordinates:
-            go_to(c, x, y, wait_timeout=wait_timeout, callback=write_coordinates)
+    for x, y, z in moves:
+        go_to(c, x, y, z, wait_timeout=wait_timeout)
+        if dwell is not None:
+            c.mdi(gcode_dwell(dwell))
+            while c.wait_complete(wait_timeout) == -1:
+                pass
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Run the gantry measurement program and log its position",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--output",
+        help="Path to the CSV file for the gantry positions ('-' for stdout)",
+        type=str,
+        default="-",
+    )
+
+    parser.add_argument(
+        "--rate",
+        help="Sampling rate of the gantry position (Hz)",
+        type=float,
+        default=100.0,
+    )
+
+    parser.add_argument(
+        "--program",
+        help="Compile the moves into this G-code file and run it in auto mode "
+        "instead of sending one MDI command per move",
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--blend-tolerance",
+        help="Path blending tolerance (G64 P) of the G-code program in mm",
+        type=float,
+        default=1.0,
+    )
+
+    parser.add_argument(
+        "--waypoints",
+        help="CSV file with the waypoints to visit instead of the default take",
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--dwell",
+        help="Dwell time in seconds at the end of each move, for static "
+        "measurements. No dwell if not given",
+        type=float,
+        default=None,
+    )
+
+    args = parser.parse_args()
+
     s = linuxcnc.stat()  # connect to the status channel
     c = linuxcnc.command()  # connect to the command channel
 
@@ -103,11 +194,26 @@ def main():
         c.mode(linuxcnc.MODE_MDI)
         c.wait_complete()  # wait until mode switch executed
         print("OK, running...", file=sys.stderr)
+
+        output = sys.stdout if args.output == "-" else open(args.output, "w")
+
+        # The logger polls its own stat channel from the sampling thread
         try:
-            program_robot(c, s)
+            with PositionLogger(linuxcnc.stat(), output, rate=args.rate):
+                program_robot(
+                    c,
+                    s,
+                    args.program,
+                    args.blend_tolerance,
+                    args.waypoints,
+                    args.dwell,
+                )
         except KeyboardInterrupt:
             c.abort()
             sys.exit(1)
+        finally:
+            if output is not sys.stdout:
+                output.close()
     else:
         print(
             "Not OK for running. Check that the robot is homed and idle.",
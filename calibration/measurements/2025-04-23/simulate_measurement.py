@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Run run_measurement.py offline against the linuxcnc simulator
+# The remaining arguments are passed to run_measurement.py, e.g.:
+#   ./simulate_measurement.py --time-scale 100 -- --output take_gantry_sim.csv
+
+import argparse
+import sys
+
+import linuxcnc_sim
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the measurement program with a simulated LinuxCNC",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--ini",
+        help="LinuxCNC INI file with the axes limits",
+        type=str,
+        default=linuxcnc_sim.DEFAULT_INI,
+    )
+
+    parser.add_argument(
+        "--time-scale",
+        help="Speed of the simulation relative to real time",
+        type=float,
+        default=100.0,
+    )
+
+    parser.add_argument(
+        "measurement_args",
+        help="Arguments of run_measurement.py",
+        nargs=argparse.REMAINDER,
+    )
+
+    args = parser.parse_args()
+    measurement_args = args.measurement_args
+    if measurement_args[:1] == ["--"]:
+        measurement_args = measurement_args[1:]
+
+    clock = linuxcnc_sim.configure(args.ini, args.time_scale)
+    sys.modules["linuxcnc"] = linuxcnc_sim
+
+    import position_logger
+    import run_measurement
+
+    # Timestamps and waits of the measurement scripts follow the simulation
+    position_logger.time = clock  # type: ignore[assignment]
+    run_measurement.time = clock  # type: ignore[assignment]
+
+    sys.argv = [run_measurement.__file__, *measurement_args]
+    run_measurement.main()
+
+    print(
+        f"Simulated {clock.monotonic():.1f} s in {clock.real_elapsed():.1f} s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
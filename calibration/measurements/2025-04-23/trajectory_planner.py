@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# Take duration estimation and waypoint reordering of measurement trajectories
+# The duration of each move is estimated with the trapezoidal velocity profile
+# limited by the INI file, in exact stop mode (no path blending).
+
+import argparse
+import sys
+from measurements_utils import (
+    DEFAULT_INI,
+    MachineLimits,
+    Move,
+    Position,
+    gcode_program,
+    load_machine_limits,
+    load_waypoints,
+    move_time,
+    save_waypoints,
+    snake_moves,
+    take_duration,
+)
+
+
+def resolve_moves(moves: list[Move], start: Position) -> list[Position]:
+    """Absolute position at the end of each move."""
+    positions = []
+    current = start
+
+    for move in moves:
+        current = tuple(  # type: ignore[assignment]
+            c if m is None else m for c, m in zip(current, move)
+        )
+        positions.append(current)
+
+    return positions
+
+
+Segment = tuple[Position, Position]
+
+
+def get_segments(
+    positions: list[Position], start: Position, tolerance: float = 1e-6
+) -> list[Segment]:
+    """Lines swept by the XY moves of the path, without repeated lines.
+
+    The moves that only change Z are transitions between levels and are left
+    out, the planner makes its own transitions between the lines.
+    """
+    seen = set()
+    segments = []
+    previous = start
+
+    for position in positions:
+        a, b = previous, position
+        previous = position
+        if all(abs(p - q) <= tolerance for p, q in zip(a[:2], b[:2])):
+            continue
+
+        key = frozenset(tuple(round(p / tolerance) for p in q) for q in (a, b))
+        if key not in seen:
+            seen.add(key)
+            segments.append((a, b))
+
+    return segments
+
+
+def get_time_matrix(
+    points: list[Position], feed_rate: float, limits: MachineLimits
+) -> list[list[float]]:
+    n = len(points)
+    times = [[0.0] * n for _ in range(n)]
+
+    for i in range(n):
+        for j in range(i + 1, n):
+            t = move_time(points[i], points[j], feed_rate, limits)
+            times[i][j] = times[j][i] = t
+
+    return times
+
+
+# A segment visit is (segment, reversed). In the time matrix, the point 0 is
+# the start position and the segment k goes from point 2k + 1 to point 2k + 2.
+Visit = tuple[int, bool]
+
+
+def entry_point(visit: Visit) -> int:
+    k, reverse = visit
+    return 2 * k + 2 if reverse else 2 * k + 1
+
+
+def exit_point(visit: Visit) -> int:
+    k, reverse = visit
+    return 2 * k + 1 if reverse else 2 * k + 2
+
+
+def nearest_neighbour_tour(times: list[list[float]]) -> list[Visit]:
+    """Greedy order of the segments from the start position.
+
+    Each step visits the unvisited segment with the fastest move from the
+    current point to one of its ends, in the direction starting at that end.
+    """
+    num_segments = (len(times) - 1) // 2
+    unvisited = set(range(num_segments))
+    tour: list[Visit] = []
+    current = 0
+
+    while unvisited:
+        last = times[current]
+        visit = min(
+            ((k, reverse) for k in unvisited for reverse in (False, True)),
+            key=lambda visit: last[entry_point(visit)],
+        )
+        unvisited.remove(visit[0])
+        tour.append(visit)
+        current = exit_point(visit)
+
+    return tour
+
+
+def two_opt(
+    tour: list[Visit], times: list[list[float]], max_passes: int = 100
+) -> list[Visit]:
+    """Improve an order of the segments by reversing sub-sequences.
+
+    Reversing a sub-sequence also reverses the direction of its segments, so
+    only the transitions at its ends change. The segment times do not change.
+    """
+    tour = tour.copy()
+    n = len(tour)
+
+    def transition(a: int, i: int) -> float:
+        # Time from the point a to the entry of the visit i, 0 after the last one
+        return times[a][entry_point(tour[i])] if i < n else 0.0
+
+    for _ in range(max_passes):
+        improved = False
+
+        for i in range(n):
+            a = exit_point(tour[i - 1]) if i > 0 else 0
+
+            for j in range(i + 1, n):
+                b, c = entry_point(tour[i]), exit_point(tour[j])
+                t_ab = times[a][b]
+                t_cd = transition(c, j + 1)
+                t_ac = times[a][c]
+                t_bd = transition(b, j + 1)
+
+                if t_ac + t_bd < t_ab + t_cd - 1e-9:
+                    tour[i : j + 1] = [(k, not r) for k, r in reversed(tour[i : j + 1])]
+                    improved = True
+
+        if not improved:
+            break
+
+    return tour
+
+
+def tour_positions(
+    tour: list[Visit], segments: list[Segment], start: Position
+) -> list[Position]:
+    """Waypoints sweeping the segments in the order and direction of the tour."""
+    positions = []
+    current = start
+
+    for k, reverse in tour:
+        a, b = segments[k][::-1] if reverse else segments[k]
+        if a != current:
+            positions.append(a)
+        positions.append(b)
+        current = b
+
+    return positions
+
+
+def plan_waypoints(
+    positions: list[Position],
+    start: Position,
+    feed_rate: float,
+    limits: MachineLimits,
+) -> list[Position]:
+    """Reorder the lines of the path to minimize the take duration.
+
+    Each line swept by the path is kept whole, so the planned take covers the
+    same workspace. The lines of all the Z levels are ordered together, and
+    each can be swept in either direction. The order is a nearest-neighbour
+    tour from the start position improved with 2-opt, with the move times
+    between the ends of the lines as distances, so slow Z moves are avoided.
+    The input order is also improved with 2-opt, and the fastest of both is
+    returned, or the input waypoints if it is not faster than them.
+    """
+    segments = get_segments(positions, start)
+    points = [start, *(point for segment in segments for point in segment)]
+    times = get_time_matrix(points, feed_rate, limits)
+
+    input_tour = [(k, False) for k in range(len(segments))]
+    candidates = [
+        tour_positions(two_opt(tour, times), segments, start)
+        for tour in [nearest_neighbour_tour(times), input_tour]
+    ]
+    planned = min(
+        candidates, key=lambda p: take_duration(p, start, feed_rate, limits)
+    )
+
+    if take_duration(planned, start, feed_rate, limits) >= take_duration(
+        positions, start, feed_rate, limits
+    ):
+        return positions
+
+    return planned
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimate the take duration and reorder its waypoints",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--waypoints",
+        help="CSV file with the input waypoints. If not given, the serpentine "
+        "take is generated from the arguments below",
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument("--start-xy", type=float, nargs=2, default=[300, 300])
+    parser.add_argument("--end-xy", type=float, nargs=2, default=[5000, 4900])
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument(
+        "--z-levels", type=float, nargs="+", default=[-1000, -800, -600, -400]
+    )
+
+    parser.add_argument(
+        "--start",
+        help="Position of the gantry at the start of the take",
+        type=float,
+        nargs=3,
+        default=[0, 0, 0],
+    )
+
+    parser.add_argument(
+        "--feed-rate", help="Feed rate in mm/min", type=float, default=8000
+    )
+
+    parser.add_argument(
+        "--ini",
+        help="LinuxCNC INI file with the axes limits",
+        type=str,
+        default=DEFAULT_INI,
+    )
+
+    parser.add_argument(
+        "--output",
+        help="Output file: waypoints CSV, or G-code if the extension is .ngc",
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--blend-tolerance",
+        help="Path blending tolerance (G64 P) of the G-code output in mm",
+        type=float,
+        default=None,
+    )
+
+    args = parser.parse_args()
+
+    limits = load_machine_limits(args.ini)
+    start: Position = tuple(args.start)  # type: ignore[assignment]
+
+    if args.waypoints is not None:
+        moves = load_waypoints(args.waypoints)
+    else:
+        moves = snake_moves(
+            tuple(args.start_xy), tuple(args.end_xy), args.turns, args.z_levels
+        )
+
+    positions = resolve_moves(moves, start)
+
+    duration = take_duration(positions, start, args.feed_rate, limits)
+    print(f"Input: {len(positions)} waypoints, {duration:.1f} s", file=sys.stderr)
+
+    planned = plan_waypoints(positions, start, args.feed_rate, limits)
+    planned_duration = take_duration(planned, start, args.feed_rate, limits)
+    print(
+        f"Planned: {len(planned)} waypoints, {planned_duration:.1f} s",
+        file=sys.stderr,
+    )
+
+    if args.output is None:
+        return
+
+    planned_moves: list[Move] = list(planned)
+    if args.output.endswith(".ngc"):
+        with open(args.output, "w") as f:
+            f.write(gcode_program(planned_moves, args.feed_rate, args.blend_tolerance))
+    else:
+        save_waypoints(args.output, planned_moves)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,3 +10,74 @@ def parse_limit(limit_str: str) -> tuple[float, float]:
         raise argparse.ArgumentTypeError(
             f"Limit must be two comma-separated numbers (got '{limit_str}')"
         )
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """Add the --profile and --profile-memory arguments, see profiling.profiling."""
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Path of a JSON report of the time and peak memory of each processing "
+        "section, also saved as collapsed stacks for flame graphs to PATH.folded",
+    )
+
+    parser.add_argument(
+        "--profile-memory",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Trace the peak memory of the sections with --profile, which slows "
+        "down the processing",
+    )
+
+
+def add_take_server_argument(parser: argparse.ArgumentParser):
+    """Add the --take-server argument, see take_server.load_processed_data."""
+    # Imported here, the other tools do not need the take server
+    from take_server import DEFAULT_SOCKET
+
+    parser.add_argument(
+        "--take-server",
+        type=str,
+        nargs="?",
+        const=DEFAULT_SOCKET,
+        default=None,
+        help="Get the processed take from the take server listening on this "
+        f"socket ({DEFAULT_SOCKET} if not given), see take_server.py",
+    )
+
+
+def add_processed_take_argument(parser: argparse.ArgumentParser):
+    """Add the --processed-take argument, see take_server.load_processed_data."""
+    parser.add_argument(
+        "--processed-take",
+        type=str,
+        default=None,
+        help="Directory of the processed take, memory-mapped if it was saved with "
+        "the same files and options, otherwise the take is processed and saved to it",
+    )
+
+
+def add_resample_arguments(parser: argparse.ArgumentParser):
+    """Add the --resample-rate, --anti-alias and --resample-cache arguments, see
+    data.get_processed_data."""
+    parser.add_argument(
+        "--resample-rate",
+        type=float,
+        default=None,
+        help="Resample both streams on a uniform time grid at this rate (Hz)",
+    )
+
+    parser.add_argument(
+        "--anti-alias",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Low-pass filter the streams before resampling",
+    )
+
+    parser.add_argument(
+        "--resample-cache",
+        type=str,
+        default=None,
+        help="Path of a .npz file to cache the resampled data",
+    )
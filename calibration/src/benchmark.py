@@ -0,0 +1,676 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable, Sequence
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from functools import cached_property
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+import scipy as scp
+
+from check_params import forward_kinematics, inverse_kinematics
+from coordinates_utils import (
+    Transform,
+    TransformRotateCenter,
+    TransformShiftT,
+    TransformShiftXYZ,
+    coord_mse,
+    coord_transform,
+)
+from data import (
+    get_calibration_matrices,
+    get_processed_data,
+    load_gantry_data,
+    load_optitrack_data,
+)
+from optimizer_trace import load_traces
+from synthetic_take import SyntheticTake, load_ground_truth
+
+logger = logging.getLogger(__name__)
+
+BENCHMARKS = [
+    "load_optitrack",
+    "load_gantry",
+    "coord_transform",
+    "coord_mse",
+    "inverse_kinematics",
+    "fit_alignment",
+    "fit_calibration",
+]
+
+# Benchmarks whose time grows too fast to run them on the largest takes
+SLOW_BENCHMARKS = {"inverse_kinematics", "fit_alignment", "fit_calibration"}
+
+# Fit arguments of the time offset models checked by check_time_offset_models.
+# The first one is the reference, the fit of the time shift with the spatial
+# parameters from zero. The synthetic takes have no clock drift, so the drift
+# and the time warp must not make the fit worse.
+TIME_OFFSET_MODELS: dict[str, dict[str, Any]] = {
+    "no_xcorr": {"time_offset_xcorr": False},
+    "default": {},
+    "clock_drift": {"clock_drift": True},
+    "time_warp": {"time_warp": True},
+}
+
+
+@dataclass
+class BenchmarkResult:
+    """Measurements of a benchmark on a take.
+
+    Attributes:
+        name: Name of the benchmark
+        num_frames: Number of OptiTrack frames of the take
+        seconds: Best wall time of the runs (s)
+        repeat: Number of timed runs
+        peak_memory_mb: Peak memory traced by tracemalloc in a separate run
+            (MB), None without memory tracking
+        metrics: Accuracy against the ground truth of the take and other
+            measurements, e.g., the number of objective evaluations of a fit
+    """
+
+    name: str
+    num_frames: int
+    seconds: float
+    repeat: int
+    peak_memory_mb: Optional[float] = None
+    metrics: dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class BenchmarkTake:
+    """Files of a synthetic take and its ground truth, with the loaded data."""
+
+    optitrack_filename: str
+    gantry_filename: str
+    ground_truth_filename: str
+    num_frames: int
+
+    @cached_property
+    def ground_truth(self) -> dict[str, Any]:
+        return load_ground_truth(self.ground_truth_filename)
+
+    @cached_property
+    def optitrack(self) -> pd.DataFrame:
+        """Rigid body positions, with columns time, x, y, z."""
+        df, _ = load_optitrack_data(self.optitrack_filename, markers=False)
+        df = df[["time", "RB.X", "RB.Y", "RB.Z"]]
+        df.columns = ["time", "x", "y", "z"]
+        return df
+
+    @cached_property
+    def gantry(self) -> pd.DataFrame:
+        """Gantry positions, with the time relative to the capture start."""
+        df = load_gantry_data(self.gantry_filename)
+        start = datetime.fromisoformat(self.ground_truth["capture_start_time"])
+        df["time"] -= start.timestamp()
+        return df
+
+
+def get_take(take_dir: str, num_frames: int, seed: int = 0) -> BenchmarkTake:
+    """Synthetic take with num_frames OptiTrack frames, generated if needed.
+
+    The takes are kept in take_dir, so they are only generated once. The
+    ground truth file is written last, so it marks a complete take.
+    """
+    directory = os.path.join(take_dir, f"take-{num_frames}-{seed}")
+    take = BenchmarkTake(
+        os.path.join(directory, "take_optitrack.csv"),
+        os.path.join(directory, "take_gantry.csv"),
+        os.path.join(directory, "ground_truth.json"),
+        num_frames,
+    )
+
+    if not os.path.exists(take.ground_truth_filename):
+        logger.info("Generating a synthetic take of %d frames...", num_frames)
+        os.makedirs(directory, exist_ok=True)
+        synthetic_take = SyntheticTake(duration=num_frames / 120.0, seed=seed)
+        synthetic_take.write(
+            take.optitrack_filename,
+            take.gantry_filename,
+            take.ground_truth_filename,
+        )
+
+    return take
+
+
+def measure(
+    func: Callable[[], Any], repeat: int = 1, memory: bool = True
+) -> tuple[float, Optional[int], Any]:
+    """Best wall time and peak traced memory of a function.
+
+    The memory is measured in an additional run, since tracemalloc slows down
+    the allocations.
+
+    Returns:
+        tuple[float, Optional[int], Any]: Best time of the repeat runs (s), peak
+            memory (bytes) or None without memory tracking, and the output of
+            the last run
+    """
+    seconds = np.inf
+    output = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        output = func()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    peak_memory = None
+    if memory:
+        output = None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            output = func()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return seconds, peak_memory, output
+
+
+def get_alignment_transform(alignment_params: np.ndarray) -> list[Transform]:
+    """Transforms of the alignment of the OptiTrack data, as in data.py."""
+    x = alignment_params
+    return [
+        TransformShiftXYZ(x[0], x[1], x[2]),
+        TransformRotateCenter("x", x[3]),
+        TransformRotateCenter("y", x[4]),
+        TransformRotateCenter("z", x[5]),
+        TransformShiftT(x[6]),
+    ]
+
+
+def get_error_rms(df: pd.DataFrame, column: str) -> float:
+    return float(np.sqrt(np.nanmean(df[column].to_numpy() ** 2)))
+
+
+def run_fit(
+    take: BenchmarkTake,
+    calibrate: bool,
+    alignment_params: Optional[np.ndarray] = None,
+    **fit_args: Any,
+) -> tuple[pd.DataFrame, np.ndarray, Optional[np.ndarray], int]:
+    """Fit the parameters of a take with get_processed_data.
+
+    The parameter files are written to a temporary directory, so the fits are
+    run every time. With alignment_params, only the calibration is fitted. The
+    fit_args are passed to get_processed_data.
+
+    Returns:
+        tuple: The processed data, the alignment and calibration parameters,
+            and the number of evaluations of the objectives
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        alignment_filename = os.path.join(tmp_dir, "alignment_params.npy")
+        calibration_filename = os.path.join(tmp_dir, "calibration_params.npy")
+        trace_filename = os.path.join(tmp_dir, "optimizer_trace.npz")
+        if alignment_params is not None:
+            np.save(alignment_filename, alignment_params)
+
+        df, _ = get_processed_data(
+            take.gantry_filename,
+            take.optitrack_filename,
+            alignment_filename,
+            calibration_filename if calibrate else None,
+            calibrate=calibrate,
+            optimizer_trace_filename=trace_filename,
+            **fit_args,
+        )
+
+        evaluations = 0
+        if os.path.exists(trace_filename):
+            evaluations = sum(len(t.values) for t in load_traces(trace_filename))
+
+        return (
+            df,
+            np.load(alignment_filename),
+            np.load(calibration_filename) if calibrate else None,
+            evaluations,
+        )
+
+
+def get_benchmark(
+    name: str, take: BenchmarkTake
+) -> tuple[Callable[[], Any], Callable[[Any], dict[str, float]]]:
+    """Function of a benchmark on a take, and the metrics of its output."""
+    ground_truth = take.ground_truth
+    alignment_gt = ground_truth["alignment_params"]
+    calibration_gt = ground_truth["calibration_params"]
+
+    # Expected RMS of the distance to the ground truth, the 3D rigid body noise
+    noise_rms = np.sqrt(3) * ground_truth["rb_noise"]
+
+    def no_metrics(output: Any) -> dict[str, float]:
+        return {}
+
+    if name == "load_optitrack":
+        return lambda: load_optitrack_data(take.optitrack_filename), no_metrics
+
+    if name == "load_gantry":
+        return lambda: load_gantry_data(take.gantry_filename), no_metrics
+
+    if name == "coord_transform":
+        df_optitrack = take.optitrack
+        transform = get_alignment_transform(alignment_gt)
+        return lambda: coord_transform(df_optitrack, transform), no_metrics
+
+    if name == "coord_mse":
+        df_gantry = take.gantry
+        df_aligned = coord_transform(
+            take.optitrack, get_alignment_transform(alignment_gt)
+        )
+
+        def mse_metrics(value: float) -> dict[str, float]:
+            return {"value": float(value)}
+
+        return lambda: coord_mse(df_gantry, df_aligned), mse_metrics
+
+    if name == "inverse_kinematics":
+        # Joint positions of the gantry samples, up to one per frame
+        joints = take.gantry[["x", "y", "z"]].to_numpy()[: take.num_frames]
+        params = get_calibration_matrices(calibration_gt)
+        positions = forward_kinematics(joints, params)
+
+        def solve() -> np.ndarray:
+            return np.array(
+                [
+                    inverse_kinematics(pos, params, max_iter=20, tol=1e-9)
+                    for pos in positions
+                ]
+            )
+
+        def ik_metrics(solved: np.ndarray) -> dict[str, float]:
+            error = np.linalg.norm(solved - joints, axis=1)
+            return {"joint_error_max": float(error.max())}
+
+        return solve, ik_metrics
+
+    if name == "fit_alignment":
+
+        def alignment_metrics(output) -> dict[str, float]:
+            df, alignment_params, _, evaluations = output
+            error = alignment_params - alignment_gt
+            return {
+                "evaluations": evaluations,
+                "shift_error": float(np.linalg.norm(error[:3])),
+                "angle_error": float(np.abs(error[3:6]).max()),
+                "time_shift_error": float(abs(error[6])),
+                "error_rms": get_error_rms(df, "GAN.ERR.Abs"),
+            }
+
+        # The calibration distortion is not fitted, so it biases the alignment
+        return lambda: run_fit(take, calibrate=False), alignment_metrics
+
+    if name == "fit_calibration":
+
+        def calibration_metrics(output) -> dict[str, float]:
+            df, _, calibration_params, evaluations = output
+            error_rms = get_error_rms(df, "GAN.ERR.CALIBRATED.Abs")
+            return {
+                "evaluations": evaluations,
+                "params_error": float(
+                    np.abs(calibration_params - calibration_gt).max()
+                ),
+                "error_rms": error_rms,
+                # Error of the fit, in excess of the noise of the data
+                "excess_error_rms": float(
+                    np.sqrt(max(error_rms**2 - noise_rms**2, 0.0))
+                ),
+            }
+
+        # Only the calibration is fitted, aligned with the ground truth
+        return (
+            lambda: run_fit(take, calibrate=True, alignment_params=alignment_gt),
+            calibration_metrics,
+        )
+
+    raise ValueError(f"Unknown benchmark {name}")
+
+
+def run_benchmarks(
+    names: Sequence[str],
+    frames: Sequence[int],
+    take_dir: str,
+    repeat: int = 3,
+    memory: bool = True,
+    max_slow_frames: int = 10000,
+    seed: int = 0,
+) -> list[BenchmarkResult]:
+    """Run the benchmarks on synthetic takes of each number of frames.
+
+    Args:
+        names: Names of the benchmarks, see BENCHMARKS
+        frames: Numbers of OptiTrack frames of the takes
+        take_dir: Directory of the generated takes
+        repeat: Number of timed runs, the fits are run once
+        memory: Whether to measure the peak memory in an additional run
+        max_slow_frames: Maximum number of frames of the takes of the
+            SLOW_BENCHMARKS
+        seed: Seed of the synthetic takes
+
+    Returns:
+        list[BenchmarkResult]: Result of each benchmark and take
+    """
+    results = []
+    for num_frames in frames:
+        take = get_take(take_dir, num_frames, seed)
+
+        for name in names:
+            if name in SLOW_BENCHMARKS and num_frames > max_slow_frames:
+                logger.info("Skipping %s on %d frames", name, num_frames)
+                continue
+
+            func, get_metrics = get_benchmark(name, take)
+            num_runs = 1 if name.startswith("fit_") else repeat
+            seconds, peak_memory, output = measure(func, num_runs, memory)
+
+            result = BenchmarkResult(
+                name,
+                num_frames,
+                seconds,
+                num_runs,
+                peak_memory / 2**20 if peak_memory is not None else None,
+                get_metrics(output),
+            )
+            logger.info("%s", result)
+            results.append(result)
+
+    return results
+
+
+def check_time_offset_models(
+    take: BenchmarkTake, tolerance: float = 1.05
+) -> tuple[str, bool]:
+    """Compare the fits of the TIME_OFFSET_MODELS on a take.
+
+    The alignment and calibration are fitted with each model. A model passes if
+    its RMS error is at most tolerance times the one of the first model.
+
+    Returns:
+        tuple[str, bool]: Table of the time shift error, RMS error and time of
+            each model, and whether all the models passed
+    """
+    t_shift = take.ground_truth["alignment_params"][6]
+    width = max([len("Model")] + [len(name) for name in TIME_OFFSET_MODELS])
+    lines = [
+        f"{'Model':<{width}}  {'Shift error (ms)':>16}  {'Error RMS (mm)':>14}  "
+        f"{'Time (s)':>8}"
+    ]
+
+    passed = True
+    reference = None
+    for name, fit_args in TIME_OFFSET_MODELS.items():
+        logger.info("Fitting the time offset model %s...", name)
+        start = time.perf_counter()
+        df, alignment_params, _, _ = run_fit(take, calibrate=True, **fit_args)
+        seconds = time.perf_counter() - start
+
+        error_rms = get_error_rms(df, "GAN.ERR.CALIBRATED.Abs")
+        if reference is None:
+            reference = error_rms
+        ok = error_rms <= tolerance * reference
+        passed &= ok
+
+        lines.append(
+            f"{name:<{width}}  {abs(alignment_params[6] - t_shift) * 1e3:>16.3f}  "
+            f"{error_rms:>14.4f}  {seconds:>8.1f}  {'ok' if ok else 'WORSE'}"
+        )
+
+    return "\n".join(lines), passed
+
+
+def get_git_commit() -> tuple[Optional[str], bool]:
+    """Commit of the working tree, and whether it has uncommitted changes."""
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=src_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=src_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+    return commit, bool(status.strip())
+
+
+def get_run_info() -> dict[str, Any]:
+    """Commit, time and environment of a benchmark run."""
+    commit, dirty = get_git_commit()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "machine": platform.node(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "scipy": scp.__version__,
+    }
+
+
+def save_results(
+    results_dir: str, info: dict[str, Any], results: Sequence[BenchmarkResult]
+) -> str:
+    """Save the results of a run as <timestamp>-<commit>.json in results_dir."""
+    os.makedirs(results_dir, exist_ok=True)
+    timestamp = info["timestamp"].replace(":", "")
+    commit = (info["commit"] or "unknown")[:10] + ("-dirty" if info["dirty"] else "")
+    filename = os.path.join(results_dir, f"{timestamp}-{commit}.json")
+
+    with open(filename, "w") as f:
+        json.dump(
+            {"info": info, "results": [asdict(r) for r in results]}, f, indent=2
+        )
+
+    return filename
+
+
+def load_results(filename: str) -> tuple[dict[str, Any], list[BenchmarkResult]]:
+    """Load the results of a run saved with save_results."""
+    with open(filename) as f:
+        data = json.load(f)
+
+    return data["info"], [BenchmarkResult(**r) for r in data["results"]]
+
+
+def format_comparison(
+    runs: Sequence[tuple[dict[str, Any], list[BenchmarkResult]]],
+    threshold: float = 1.2,
+) -> tuple[str, bool]:
+    """Table of the times of the runs, relative to the first one.
+
+    The times over threshold times the time of the first run are marked as
+    regressions with a "!".
+
+    Returns:
+        tuple[str, bool]: The table, and whether there is any regression
+    """
+    keys: list[tuple[str, int]] = []
+    times: list[dict[tuple[str, int], float]] = []
+    for _, results in runs:
+        times.append({})
+        for r in results:
+            if (r.name, r.num_frames) not in keys:
+                keys.append((r.name, r.num_frames))
+            times[-1][(r.name, r.num_frames)] = r.seconds
+
+    labels = [
+        f"{(info['commit'] or 'unknown')[:8]}{'+' if info['dirty'] else ''}"
+        for info, _ in runs
+    ]
+    width = max([len("Benchmark")] + [len(name) for name, _ in keys])
+    lines = [
+        f"{'Benchmark':<{width}}  {'Frames':>9}"
+        + "".join(f"  {label:>18}" for label in labels)
+    ]
+
+    regression = False
+    for key in keys:
+        base = times[0].get(key)
+        cells = []
+        for run_times in times:
+            seconds = run_times.get(key)
+            if seconds is None:
+                cells.append(f"  {'-':>18}")
+            elif base is None or run_times is times[0]:
+                cells.append(f"  {seconds:>10.4f}        ")
+            else:
+                ratio = seconds / base
+                mark = "!" if ratio > threshold else " "
+                regression |= ratio > threshold
+                cells.append(f"  {seconds:>10.4f} {ratio:>5.2f}x{mark}")
+
+        lines.append(f"{key[0]:<{width}}  {key[1]:>9}" + "".join(cells))
+
+    return "\n".join(lines), regression
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the stages of the calibration pipeline on synthetic "
+        "takes, or compare the saved results of several runs",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--benchmarks",
+        type=str,
+        nargs="+",
+        choices=BENCHMARKS,
+        default=BENCHMARKS,
+        help="Benchmarks to run",
+    )
+    parser.add_argument(
+        "--frames",
+        type=lambda s: int(float(s)),
+        nargs="+",
+        default=[10**4, 10**5, 10**6],
+        help="Numbers of OptiTrack frames of the synthetic takes, e.g., 1e7",
+    )
+    parser.add_argument(
+        "--max-slow-frames",
+        type=lambda s: int(float(s)),
+        default=10**4,
+        help="Maximum number of frames of the takes of the inverse kinematics "
+        "and the fits",
+    )
+    parser.add_argument(
+        "--take-dir",
+        type=str,
+        default="benchmark_takes",
+        help="Directory of the generated synthetic takes, reused between runs",
+    )
+    parser.add_argument(
+        "--results-dir",
+        type=str,
+        default="benchmark_results",
+        help="Directory of the results, saved as <timestamp>-<commit>.json",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of timed runs, best is kept"
+    )
+    parser.add_argument(
+        "--memory",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Measure the peak memory in an additional run with tracemalloc",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the synthetic takes"
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Instead of running the benchmarks, compare the times of these "
+        "results files with the first one",
+    )
+    parser.add_argument(
+        "--check-time-offset",
+        type=lambda s: int(float(s)),
+        default=None,
+        metavar="FRAMES",
+        help="Instead of running the benchmarks, check that the fits of the time "
+        "offset models are as accurate as the fit of the time shift with the "
+        "spatial parameters, on a synthetic take of FRAMES frames, e.g., 2.4e4",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.05,
+        help="Error ratio over which a model fails with --check-time-offset",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="Time ratio over which a result is a regression with --compare",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # The processing and fits log every step
+    for module in ["data", "check_params", "optimizer_trace", "pipeline"]:
+        logging.getLogger(module).setLevel(logging.WARNING)
+
+    if args.compare:
+        table, regression = format_comparison(
+            [load_results(filename) for filename in args.compare], args.threshold
+        )
+        print(table)
+        sys.exit(1 if regression else 0)
+
+    if args.check_time_offset:
+        table, passed = check_time_offset_models(
+            get_take(args.take_dir, args.check_time_offset, args.seed),
+            args.tolerance,
+        )
+        print(table)
+        sys.exit(0 if passed else 1)
+
+    info = get_run_info()
+    results = run_benchmarks(
+        args.benchmarks,
+        args.frames,
+        args.take_dir,
+        args.repeat,
+        args.memory,
+        args.max_slow_frames,
+        args.seed,
+    )
+    filename = save_results(args.results_dir, info, results)
+
+    for r in results:
+        memory = f"{r.peak_memory_mb:8.1f} MB" if r.peak_memory_mb is not None else ""
+        metrics = ", ".join(f"{key}={value:.6g}" for key, value in r.metrics.items())
+        print(
+            f"{r.name:<18} {r.num_frames:>9} {r.seconds:>10.4f} s {memory}  {metrics}"
+        )
+
+    print(f"Results saved to {filename}")
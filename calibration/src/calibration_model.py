@@ -0,0 +1,52 @@
+import numpy as np
+import numpy.typing as npt
+
+
+def get_calibration_matrices(x) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Convert calibration parameters into transformation matrices.
+
+    Args:
+        x: Array of calibration parameters (18 elements).
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: A tuple containing:
+            - 3x3 transformation matrix for the first transformation
+            - 3x3 transformation matrix for the second transformation
+            - 3-element translation array
+    """
+    matrix1 = np.array(x[:9]).reshape(3, 3)
+    matrix2 = np.array(np.concatenate([x[9:15], [0, 0, 0]])).reshape(3, 3)
+    array = np.array(x[15:18])
+    return matrix1, matrix2, array
+
+
+def get_calibration_design_matrix(pos: npt.ArrayLike) -> np.ndarray:
+    """Design matrix of the calibration model for a set of gantry positions.
+
+    Each output coordinate of the calibration is a linear function of the
+    features [x, y, z, x**2, y**2, 1] of the gantry position, with the
+    coefficients given by a column of A, the first two rows of B, and C.
+
+    Args:
+        pos: Array of gantry positions with shape (N, 3).
+
+    Returns:
+        np.ndarray: Design matrix with shape (N, 6).
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    return np.column_stack([pos, pos[:, :2] ** 2, np.ones(len(pos))])
+
+
+def get_calibration_params(coef: npt.ArrayLike) -> np.ndarray:
+    """Convert the coefficients of the design matrix into calibration parameters.
+
+    Args:
+        coef: Array with shape (6, 3), column j holds the coefficients of the
+            features of get_calibration_design_matrix for the output coordinate j.
+
+    Returns:
+        np.ndarray: Array of calibration parameters (18 elements), as expected by
+            get_calibration_matrices.
+    """
+    coef = np.asarray(coef, dtype=np.float64)
+    return np.concatenate([coef[:3].ravel(), coef[3:5].ravel(), coef[5]])
@@ -3,10 +3,9 @@ import logging
 import sys
 from typing import Optional
 
-from data import get_calibration_matrices
-
 import numpy as np
-import scipy as scp
+
+from calibration_model import get_calibration_matrices
 
 logger = logging.getLogger(__name__)
 
@@ -88,6 +87,9 @@ def get_joint_bounds(
     params: tuple[np.ndarray, np.ndarray, np.ndarray],
     axis_bounds: tuple[np.ndarray, np.ndarray],
 ) -> tuple[np.ndarray, np.ndarray]:
+    # Imported here, so the other checks start without loading scipy
+    import scipy as scp
+
     A, B, C = params
 
     min_joints = np.zeros(3)
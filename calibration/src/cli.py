@@ -0,0 +1,169 @@
+import argparse
+import os
+import runpy
+import subprocess
+import sys
+import time
+from collections.abc import Sequence
+
+# Only the standard library is imported here, each command imports its own
+# dependencies when it runs, so the startup time is the one of the command.
+
+# Name of each command, and the module run as a script with its help
+COMMANDS: dict[str, tuple[str, str]] = {
+    "calibrate": ("run_calibration", "Align and calibrate the Optitrack data"),
+    "check": ("check_params", "Check calibration parameters"),
+    "hal-config": (
+        "print_calibxyzkins_config",
+        "Print the LinuxCNC hal configuration for the calibxyzkins module",
+    ),
+    "play": ("web_player", "Play the movement in the browser"),
+    "serve": ("take_server", "Serve processed takes in shared memory"),
+    "take": ("processed_take", "Print the schema of a processed take"),
+    "design": ("design_poses", "Design a minimal set of calibration poses"),
+    "plan": ("plan_remeasurement", "Plan a take over the high-residual regions"),
+    "time-offset": ("time_offset", "Estimate the time offset of the data"),
+    "synthetic": ("synthetic_take", "Generate a synthetic take"),
+    "benchmark": ("benchmark", "Benchmark the calibration pipeline"),
+    "trace": ("optimizer_trace", "Summarize the convergence of optimizer traces"),
+}
+
+PLOT_COMMANDS: dict[str, tuple[str, str]] = {
+    "errors": ("plot_errors", "Plot the gantry and Optitrack errors"),
+    "errors-probability": (
+        "plot_errors_probability",
+        "Plot the probability distribution of the errors",
+    ),
+    "errors-scatter": ("plot_errors_scatter", "Plot the errors by position"),
+    "movement": ("plot_movement", "Plot the gantry and Optitrack movement"),
+    "movement-gantry": ("plot_movement_gantry", "Plot the gantry movement"),
+    "movement-optitrack": ("plot_movement_optitrack", "Plot the Optitrack movement"),
+    "calibration-2d": ("plot_calibration_2d", "Plot the calibration in 2D"),
+    "calibration-3d": ("plot_calibration_3d", "Plot the calibration in 3D"),
+}
+
+# Maximum startup time of the modules of the quick commands (s)
+STARTUP_BUDGETS: dict[str, float] = {
+    "cli": 0.2,
+    "check_params": 0.5,
+    "print_calibxyzkins_config": 0.5,
+}
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_command(module: str, prog: str, args: Sequence[str]):
+    """Run a module as a script, with prog as its name in the help."""
+    sys.argv = [prog, *args]
+    runpy.run_module(module, run_name="__main__")
+
+
+def get_startup_time(module: str, repeat: int = 3) -> float:
+    """Best wall time of a new interpreter importing a module (s).
+
+    It includes the startup of the interpreter, so it is the time a command
+    takes before parsing its arguments.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", f"import {module}"],
+            cwd=SRC_DIR,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def check_startup(budgets: dict[str, float], repeat: int = 3) -> bool:
+    """Print the startup time of each module, and whether it is within budget."""
+    width = max([len("Module")] + [len(module) for module in budgets])
+    print(f"{'Module':<{width}}  {'Time (s)':>8}  {'Budget (s)':>10}")
+
+    passed = True
+    for module, budget in budgets.items():
+        seconds = get_startup_time(module, repeat)
+        status = "ok" if seconds <= budget else "OVER BUDGET"
+        passed &= seconds <= budget
+        print(f"{module:<{width}}  {seconds:>8.3f}  {budget:>10.3f}  {status}")
+
+    return passed
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Calibration tools. The arguments after the command are passed "
+        "to it, see '<command> -h'",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    for name, (_, description) in COMMANDS.items():
+        subparsers.add_parser(name, help=description, add_help=False)
+
+    plot_parser = subparsers.add_parser("plot", help="Plot the data or calibration")
+    plot_subparsers = plot_parser.add_subparsers(dest="plot", metavar="plot")
+    plot_subparsers.required = True
+    for name, (_, description) in PLOT_COMMANDS.items():
+        plot_subparsers.add_parser(name, help=description, add_help=False)
+
+    startup_parser = subparsers.add_parser(
+        "startup",
+        help="Check the startup time of the quick commands",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    startup_parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        help="Startup time budget of all the modules (s), instead of the default "
+        f"budgets {STARTUP_BUDGETS}",
+    )
+    startup_parser.add_argument(
+        "--modules",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Modules to check, by default the ones with a default budget",
+    )
+    startup_parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of runs, best is kept"
+    )
+
+    return parser
+
+
+def main(argv: Sequence[str]):
+    prog = os.path.basename(sys.argv[0])
+
+    # The commands parse their own arguments
+    if argv and argv[0] in COMMANDS:
+        run_command(COMMANDS[argv[0]][0], f"{prog} {argv[0]}", argv[1:])
+        return
+
+    if len(argv) >= 2 and argv[0] == "plot" and argv[1] in PLOT_COMMANDS:
+        run_command(PLOT_COMMANDS[argv[1]][0], f"{prog} plot {argv[1]}", argv[2:])
+        return
+
+    args = get_parser().parse_args(argv)
+
+    if args.command == "startup":
+        modules = args.modules or list(STARTUP_BUDGETS)
+        budgets = {
+            module: (
+                args.budget
+                if args.budget is not None
+                else STARTUP_BUDGETS.get(module, 1.0)
+            )
+            for module in modules
+        }
+        if not check_startup(budgets, args.repeat):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -7,7 +7,74 @@ import numpy as np
 import numpy.typing as npt
 import pandas as pd
 
+from profiling import profile_section
 
+
+class InterpKernel:
+    """Linear interpolation from the sample times xp to the query times x.
+
+    The searchsorted indices and the weights are computed once, so the kernel
+    can be applied to any number of columns sampled at xp, as a single (N, K)
+    block operation. It gives the same results as np.interp with NaN for the
+    query times out of the range of xp (or the left and right values), and
+    exact sample times do not take the NaN values of their neighbours.
+
+    Args:
+        x: Query times with shape (M,)
+        xp: Increasing sample times with shape (N,)
+        left: Value for the query times before xp[0]
+        right: Value for the query times after xp[-1]
+    """
+
+    def __init__(
+        self,
+        x: npt.ArrayLike,
+        xp: npt.ArrayLike,
+        left: float = np.nan,
+        right: float = np.nan,
+    ):
+        x = np.asarray(x, dtype=np.float64)
+        xp = np.asarray(xp, dtype=np.float64)
+
+        # Same times, the interpolation is the identity
+        self.identity = x.shape == xp.shape and np.array_equal(x, xp)
+        if self.identity:
+            return
+
+        assert len(xp) >= 2, "xp must have at least 2 samples"
+
+        idx = np.searchsorted(xp, x, side="right") - 1
+        self.idx = np.clip(idx, 0, len(xp) - 2)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = (x - xp[self.idx]) / (xp[self.idx + 1] - xp[self.idx])
+        self.weight = np.nan_to_num(weight, nan=0.0)
+
+        self.left = x < xp[0]
+        self.right = x > xp[-1]
+        self.left_value = left
+        self.right_value = right
+
+    def __call__(self, fp: npt.ArrayLike) -> np.ndarray:
+        """Interpolate the values fp with shape (N,) or (N, K)."""
+        fp = np.asarray(fp, dtype=np.float64)
+        if self.identity:
+            return fp.copy()
+
+        w = self.weight if fp.ndim == 1 else self.weight[:, None]
+        f0 = fp[self.idx]
+        f1 = fp[self.idx + 1]
+
+        out = f0 + w * (f1 - f0)
+        out = np.where(w == 0, f0, out)
+        out = np.where(w == 1, f1, out)
+        out[self.left] = self.left_value
+        out[self.right] = self.right_value
+
+        return out
+
+
+@profile_section("coord_mse")
 def coord_mse(
     df: pd.DataFrame,
     df_other: pd.DataFrame,
@@ -20,29 +87,10 @@ def coord_mse(
         len(df_cols) == len(df_other_cols) == 3
     ), "df_cols and df_other_cols must have 3 elements"
 
-    df_time, df_x, df_y, df_z = (
-        df[time_col],
-        df[df_cols[0]],
-        df[df_cols[1]],
-        df[df_cols[2]],
-    )
-
-    df_o_time, df_o_x, df_o_y, df_o_z = (
-        df_other[time_col],
-        df_other[df_other_cols[0]],
-        df_other[df_other_cols[1]],
-        df_other[df_other_cols[2]],
-    )
+    kernel = InterpKernel(df[time_col], df_other[time_col])
+    df_o_interp = kernel(df_other[df_other_cols].to_numpy())
 
-    df_o_interp_x = np.interp(df_time, df_o_time, df_o_x, left=np.nan, right=np.nan)
-    df_o_interp_y = np.interp(df_time, df_o_time, df_o_y, left=np.nan, right=np.nan)
-    df_o_interp_z = np.interp(df_time, df_o_time, df_o_z, left=np.nan, right=np.nan)
-
-    sq = (
-        (df_x - df_o_interp_x) ** 2
-        + (df_y - df_o_interp_y) ** 2
-        + (df_z - df_o_interp_z) ** 2
-    )
+    sq = ((df[df_cols].to_numpy() - df_o_interp) ** 2).sum(axis=1)
 
     return cast(float, np.nanmean(np.sqrt(sq)))
 
@@ -156,14 +204,46 @@ def coord_shift_t(
         len(x_cols) == len(y_cols) == len(z_cols)
     ), "x_cols, y_cols, and z_cols must have the same length"
 
-    time = df[time_col]
-    time_shifted = time - t_shift
+    time = df[time_col].to_numpy(dtype=np.float64)
+    cols = list(itertools.chain(x_cols, y_cols, z_cols))
+
+    kernel = InterpKernel(time - t_shift, time)
 
     df_shifted = df.copy()
-    for col in itertools.chain(x_cols, y_cols, z_cols):
-        df_shifted[col] = np.interp(
-            time_shifted, time, df[col], left=np.nan, right=np.nan
-        )
+    df_shifted[cols] = kernel(df[cols].to_numpy())
+
+    return df_shifted
+
+
+def coord_time_warp(
+    df: pd.DataFrame,
+    knots_t: npt.ArrayLike,
+    knots_shift: npt.ArrayLike,
+    time_col: str = "time",
+    x_cols: list[str] = ["x"],
+    y_cols: list[str] = ["y"],
+    z_cols: list[str] = ["z"],
+) -> pd.DataFrame:
+    """
+    Shift by a time-varying offset the coordinates of a dataframe.
+
+    The offset is piecewise linear through the knots (constant out of them),
+    so the value at time t is the value of the original data at time
+    t - shift(t). The interpolation indices and weights are computed once for
+    all the columns.
+    """
+    assert (
+        len(x_cols) == len(y_cols) == len(z_cols)
+    ), "x_cols, y_cols, and z_cols must have the same length"
+
+    time = df[time_col].to_numpy(dtype=np.float64)
+    time_shifted = time - np.interp(time, knots_t, knots_shift)
+    cols = list(itertools.chain(x_cols, y_cols, z_cols))
+
+    kernel = InterpKernel(time_shifted, time)
+
+    df_shifted = df.copy()
+    df_shifted[cols] = kernel(df[cols].to_numpy())
 
     return df_shifted
 
@@ -244,6 +324,27 @@ class TransformShiftT(Transform):
         )
 
 
+@dataclass
+class TransformTimeWarp(Transform):
+    knots_t: npt.NDArray[np.float64]
+    knots_shift: npt.NDArray[np.float64]
+    time_col: str = "time"
+    x_cols: list[str] = field(default_factory=lambda: ["x"])
+    y_cols: list[str] = field(default_factory=lambda: ["y"])
+    z_cols: list[str] = field(default_factory=lambda: ["z"])
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        return coord_time_warp(
+            df,
+            self.knots_t,
+            self.knots_shift,
+            self.time_col,
+            self.x_cols,
+            self.y_cols,
+            self.z_cols,
+        )
+
+
 @dataclass
 class TransformShiftXYZ(Transform):
     x_shift: float = 0.0
@@ -340,6 +441,7 @@ class TransformMatrix2(Transform):
 def coord_transform(df: pd.DataFrame, transform: list[Transform]) -> pd.DataFrame:
     """Apply a sequence of transformations to the coordinates of a dataframe."""
     for t in transform:
-        df = t.apply(df)
+        with profile_section(type(t).__name__):
+            df = t.apply(df)
 
     return df
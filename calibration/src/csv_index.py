@@ -0,0 +1,186 @@
+import logging
+import os
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from resample import get_cache_key
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CsvIndex:
+    """Byte offsets of the rows of a CSV file sorted by time.
+
+    Attributes:
+        skiprows: Number of lines of the header
+        stride: Number of rows between indexed rows
+        offsets: Byte offset of the rows 0, stride, 2 * stride...
+        times: Time of the indexed rows
+        num_rows: Number of rows of the file
+        extra: Additional arrays stored with the index
+    """
+
+    skiprows: int
+    stride: int
+    offsets: np.ndarray
+    times: np.ndarray
+    num_rows: int
+    extra: dict[str, np.ndarray] = field(default_factory=dict)
+
+    def get_row_range(self, t_start: float, t_end: float) -> tuple[int, int]:
+        """First row and number of rows covering the times [t_start, t_end].
+
+        The range starts at an indexed row, so it can be read with a single seek,
+        and may include some rows out of the time range.
+        """
+        i = max(0, int(np.searchsorted(self.times, t_start, side="right")) - 1)
+        j = int(np.searchsorted(self.times, t_end, side="right"))
+
+        first_row = i * self.stride
+        last_row = min(self.num_rows, j * self.stride)
+
+        return first_row, max(0, last_row - first_row)
+
+
+def build_csv_index(
+    filename: str, skiprows: int, time_col: int, stride: int = 1000
+) -> CsvIndex:
+    """Scan a CSV file for the byte offset and time of every stride-th row.
+
+    Args:
+        filename: Path to the CSV file
+        skiprows: Number of lines of the header
+        time_col: Position of the time column
+        stride: Number of rows between indexed rows
+
+    Returns:
+        CsvIndex: Index of the file
+    """
+    offsets = []
+    times = []
+    num_rows = 0
+
+    with open(filename, "rb") as f:
+        for _ in range(skiprows):
+            f.readline()
+
+        offset = f.tell()
+        for line in iter(f.readline, b""):
+            if num_rows % stride == 0:
+                offsets.append(offset)
+                times.append(float(line.split(b",", time_col + 1)[time_col]))
+
+            num_rows += 1
+            offset += len(line)
+
+    return CsvIndex(
+        skiprows, stride, np.array(offsets, dtype=np.int64), np.array(times), num_rows
+    )
+
+
+def load_csv_index(
+    filename: str,
+    skiprows: int,
+    time_col: int,
+    stride: int = 1000,
+    get_extra: Optional[Callable[[], dict[str, np.ndarray]]] = None,
+) -> CsvIndex:
+    """Load the index of a CSV file from its sidecar file, or build it.
+
+    The index is saved to filename + ".index.npz", and rebuilt if the CSV file
+    changes.
+
+    Args:
+        filename: Path to the CSV file
+        skiprows: Number of lines of the header
+        time_col: Position of the time column
+        stride: Number of rows between indexed rows
+        get_extra: Optional function returning additional arrays of the full
+            file to store with the index
+
+    Returns:
+        CsvIndex: Index of the file
+    """
+    index_filename = f"{filename}.index.npz"
+    key = get_cache_key([filename], skiprows=skiprows, time_col=time_col, stride=stride)
+
+    if os.path.exists(index_filename):
+        with np.load(index_filename) as data:
+            if str(data["key"]) == key:
+                return CsvIndex(
+                    int(data["skiprows"]),
+                    int(data["stride"]),
+                    data["offsets"],
+                    data["times"],
+                    int(data["num_rows"]),
+                    {
+                        name[len("extra.") :]: data[name]
+                        for name in data.files
+                        if name.startswith("extra.")
+                    },
+                )
+
+    logger.info("Building the row index of %s", filename)
+    index = build_csv_index(filename, skiprows, time_col, stride)
+    if get_extra is not None:
+        index.extra = get_extra()
+
+    try:
+        with open(index_filename, "wb") as f:
+            np.savez(
+                f,
+                key=np.array(key),
+                skiprows=index.skiprows,
+                stride=index.stride,
+                offsets=index.offsets,
+                times=index.times,
+                num_rows=index.num_rows,
+                **{f"extra.{name}": value for name, value in index.extra.items()},
+            )
+    except OSError as e:
+        logger.warning("Cannot save the row index %s: %s", index_filename, e)
+
+    return index
+
+
+def read_csv_rows(
+    filename: str,
+    index: CsvIndex,
+    first_row: int,
+    num_rows: int,
+    usecols: Optional[Sequence[int]] = None,
+) -> pd.DataFrame:
+    """Read a range of rows of a CSV file, without parsing the previous rows.
+
+    Args:
+        filename: Path to the CSV file
+        index: Index of the file
+        first_row: First row to read, multiple of the stride of the index
+        num_rows: Number of rows to read
+        usecols: Positions of the columns to read, all if None
+
+    Returns:
+        pd.DataFrame: Rows of the file, with the column positions as names and
+            the row numbers as index
+    """
+    assert first_row % index.stride == 0, "first_row must be an indexed row"
+
+    if num_rows == 0:
+        return pd.DataFrame(columns=list(usecols) if usecols is not None else [])
+
+    with open(filename, "rb") as f:
+        if first_row < index.num_rows:
+            f.seek(int(index.offsets[first_row // index.stride]))
+        else:
+            f.seek(0, os.SEEK_END)
+
+        df = pd.read_csv(f, header=None, nrows=num_rows, usecols=usecols)
+
+    df.index = pd.RangeIndex(first_row, first_row + len(df))
+
+    return df
@@ -4,20 +4,46 @@ import os
 import re
 from collections.abc import Sequence
 from datetime import datetime
-from typing import Any, Optional, cast
+from typing import Any, Optional, Union, cast
 
 import numpy as np
 import pandas as pd
-import scipy as scp
 
+from calibration_model import (
+    get_calibration_design_matrix,
+    get_calibration_matrices,
+    get_calibration_params,
+)
 from coordinates_utils import (
+    InterpKernel,
+    Transform,
+    TransformRotate,
     TransformRotateCenter,
     TransformShiftT,
     TransformShiftXYZ,
+    TransformTimeWarp,
     coord_matrix_transform2,
     coord_mse,
     coord_transform,
 )
+from csv_index import CsvIndex, load_csv_index, read_csv_rows
+from lazy_frame import LazyFrame
+from optimizer_trace import OptimizerTrace, save_traces
+from pipeline import Pipeline
+from profiling import profile_section
+from resample import (
+    get_cache_key,
+    get_time_grid,
+    load_resampled,
+    resample_frame,
+    save_resampled,
+)
+from time_offset import (
+    ClockOffset,
+    estimate_clock_offset,
+    fit_time_warp,
+    refine_time_warp,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -38,16 +64,100 @@ def load_bad_frames(filename: str) -> list[tuple[int, int]]:
     return [tuple(range) for range in data.get("ranges", [])]
 
 
-def load_gantry_data(filename: str) -> pd.DataFrame:
+@profile_section("load_gantry_data")
+def load_gantry_data(
+    filename: str, time_window: Optional[tuple[float, float]] = None
+) -> pd.DataFrame:
     """Load gantry position data from a CSV file.
 
+    If the filename has the .json extension it is considered the metadata file
+    of a realtime capture with the HAL sampler, and the data is loaded with
+    load_hal_sampler_data.
+
     Args:
         filename (str): Path to the CSV file containing gantry data.
+        time_window (Optional[tuple[float, float]], optional): If given, only the
+            rows of this (min, max) time range, and some rows around it, are read
+            with the row index of the CSV file. Defaults to None.
 
     Returns:
         pd.DataFrame: DataFrame containing the gantry position data.
     """
-    return cast(pd.DataFrame, pd.read_csv(filename))
+    if filename.endswith(".json"):
+        df = load_hal_sampler_data(filename)
+        if time_window is not None:
+            df = df[df["time"].between(*time_window)].reset_index(drop=True)
+        return df
+
+    if time_window is None:
+        with profile_section("read_csv"):
+            return cast(pd.DataFrame, pd.read_csv(filename))
+
+    columns = pd.read_csv(filename, nrows=0).columns
+    index = load_csv_index(filename, 1, columns.get_loc("time"))
+    with profile_section("read_csv"):
+        df = read_csv_rows(filename, index, *index.get_row_range(*time_window))
+    df.columns = columns
+
+    return df.reset_index(drop=True)
+
+
+def load_hal_sampler_data(filename: str) -> pd.DataFrame:
+    """Load gantry position data captured at servo rate with the HAL sampler.
+
+    The capture is made of a JSON metadata file and a text file with the samples
+    written by halsampler, as done by the hal_capture.py measurement script. The
+    time of each sample is obtained from its sample number, the servo period and
+    the start time of the capture. The x, y, z positions are obtained from the
+    joints feedback using the forward kinematics of the captured kinematics
+    parameters (trivial kinematics if none), i.e., the same values reported by
+    the actual_position of linuxcnc.stat.
+
+    Args:
+        filename (str): Path to the JSON metadata file of the capture.
+
+    Returns:
+        pd.DataFrame: DataFrame with the time, x, y, z columns of the gantry data,
+            followed by the sample number and the captured channels.
+    """
+    with open(filename, "r") as f:
+        metadata = json.load(f)
+
+    data_filename = os.path.join(os.path.dirname(filename), metadata["data_file"])
+    df = pd.read_csv(
+        data_filename,
+        sep=r"\s+",
+        header=None,
+        names=["sample", *metadata["channels"]],
+    )
+
+    num_lost = int(df["sample"].iloc[-1] - df["sample"].iloc[0] + 1 - len(df))
+    if num_lost > 0:
+        logger.warning("HAL sampler capture has %d lost samples", num_lost)
+
+    # Position from the feedback of the first joint of each axis
+    coordinates = metadata["coordinates"].upper()
+    joints = np.column_stack(
+        [df[f"joint.{coordinates.index(axis)}.pos-fb"] for axis in "XYZ"]
+    )
+
+    # The kinematics parameters use column coordinate vectors
+    if kinematics := metadata.get("kinematics"):
+        A, B, C = (np.array(kinematics[k]) for k in ("A", "B", "C"))
+        pos = joints @ A.T + joints**2 @ B.T + C
+    else:
+        pos = joints
+
+    df_pos = pd.DataFrame(
+        {
+            "time": metadata["start_time"] + df["sample"] * metadata["servo_period"],
+            "x": pos[:, 0],
+            "y": pos[:, 1],
+            "z": pos[:, 2],
+        }
+    )
+
+    return pd.concat([df_pos, df], axis=1)
 
 
 def load_optitrack_metadata(filename: str) -> dict[str, Any]:
@@ -101,50 +211,143 @@ def load_optitrack_metadata(filename: str) -> dict[str, Any]:
     return metadata
 
 
-def load_optitrack_data(
-    filename: str, rigid_body_name: Optional[str] = None
-) -> tuple[pd.DataFrame, int]:
-    """Load and process OptiTrack motion capture data from a CSV file.
+def _nanmean(a: np.ndarray, axis: int) -> np.ndarray:
+    """Mean ignoring NaN values, NaN (without warnings) if all the values are NaN."""
+    valid = ~np.isnan(a)
+    total = np.where(valid, a, 0.0).sum(axis=axis)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return total / valid.sum(axis=axis)
 
-    This function loads OptiTrack data, processes marker positions, calculates errors
-    between raw and rigid body markers, and computes various statistics.
 
-    Args:
-        filename (str): Path to the OptiTrack CSV file.
-        rigid_body_name (Optional[str], optional): Name of the rigid body to process.
-            If None, uses the first rigid body found in the data. Defaults to None.
+def _get_marker_errors(
+    raw: np.ndarray, rb: np.ndarray, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Errors X, Y, Z and Abs of the markers, with shape (frames, markers, 4)."""
+    if out is None:
+        out = np.empty((*raw.shape[:2], 4), dtype=np.float64)
 
-    Returns:
-        tuple[pd.DataFrame, int]: A tuple containing:
-            - DataFrame with processed OptiTrack data including marker positions,
-              rigid body positions, errors, and centroids
-            - Number of markers detected
+    np.subtract(raw, rb, out=out[:, :, :3])
+    np.sqrt(np.einsum("fmk,fmk->fm", out[:, :, :3], out[:, :, :3]), out=out[:, :, 3])
 
-    Raises:
-        ValueError: If the number of rigid body markers doesn't match the number of
-            raw markers, or if an unknown column type is encountered.
+    return out
+
+
+def _get_marker_error_means(err: np.ndarray) -> np.ndarray:
+    """Means of the errors across all markers, with shape (frames, 4)."""
+    return np.column_stack([_nanmean(err[:, :, k], axis=1) for k in range(4)])
+
+
+def _get_marker_centroid(raw: np.ndarray) -> np.ndarray:
+    """Centroid of the raw markers with shape (frames, markers, 3).
+
+    The missing values of each marker are filled by linear interpolation, and the
+    centroid is NaN where no raw markers were detected.
+    """
+    num_frames, num_m, _ = raw.shape
+    centroid = np.empty((num_frames, 3), dtype=np.float64)
+    frames = np.arange(num_frames)
+
+    for k in range(3):
+        total = np.zeros(num_frames)
+        count = np.zeros(num_frames)
+        for m in range(num_m):
+            values = raw[:, m, k].copy()
+            missing = np.isnan(values)
+            if missing.any() and not missing.all():
+                values[missing] = np.interp(
+                    frames[missing],
+                    frames[~missing],
+                    values[~missing],
+                    left=np.nan,
+                    right=np.nan,
+                )
+            valid = ~np.isnan(values)
+            total[valid] += values[valid]
+            count += valid
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            centroid[:, k] = total / count
+
+    centroid[np.isnan(raw[:, :, 0]).all(axis=1)] = np.nan
+
+    return centroid
+
+
+def _register_marker_columns(frame: LazyFrame, num_m: int) -> LazyFrame:
+    """Register the derived columns of the markers of load_optitrack_data."""
+    num_frames = len(frame)
+    coords = ["X", "Y", "Z"]
+
+    def get_tensor(frame: LazyFrame, prefix: str, markers: list[int]) -> np.ndarray:
+        cols = [f"{prefix}.{coord}{i}" for i in markers for coord in coords]
+        values = frame[cols].to_numpy(dtype=np.float64)
+        return values.reshape(num_frames, len(markers), 3)
+
+    markers = list(range(1, num_m + 1))
+    m_cols = [f"M.{coord}{i}" for i in markers for coord in coords]
+    rb_m_cols = [f"RB.{coord}{i}" for i in markers for coord in coords]
+
+    for i in markers:
+        frame.register(
+            [f"ERR.{coord}{i}" for coord in [*coords, "Abs"]],
+            [f"{prefix}.{coord}{i}" for prefix in ["M", "RB"] for coord in coords],
+            lambda frame, i=i: _get_marker_errors(
+                get_tensor(frame, "M", [i]), get_tensor(frame, "RB", [i])
+            ),
+        )
+
+    frame.register(
+        [*[f"ERR.{coord}_mean" for coord in coords], "ERR.Abs_mean"],
+        [*m_cols, *rb_m_cols],
+        lambda frame: _get_marker_error_means(
+            _get_marker_errors(
+                get_tensor(frame, "M", markers), get_tensor(frame, "RB", markers)
+            )
+        ),
+    )
+
+    frame.register(
+        [f"M.{coord}_centroid" for coord in coords],
+        m_cols,
+        lambda frame: _get_marker_centroid(get_tensor(frame, "M", markers)),
+    )
+
+    return frame
+
+
+def _get_optitrack_columns(
+    filename: str, rigid_body_name: Optional[str] = None
+) -> tuple[list[int], list[str], int, int]:
+    """Position columns of an OptiTrack CSV file.
+
+    Returns:
+        tuple[list[int], list[str], int, int]: A tuple containing:
+            - Positions of the frame, time and position columns in the file
+            - Names of the columns: frame, time, RB.X, M.X1, RB.X1...
+            - Number of markers
+            - Number of lines of the header
     """
-    df = pd.read_csv(filename, header=[1, 2, 4, 5])
+    header = pd.read_csv(filename, header=[1, 2, 4, 5], nrows=0).columns
 
     # Get the columns we want to keep and create new names
-    df_cols = list(df.columns[:2])
+    df_cols = [0, 1]
     df_col_names = ["frame", "time"]
     num_rb_m = 0
     num_m = 0
 
     if rigid_body_name is None:
-        rigid_body_name = df.columns[2][1]
+        rigid_body_name = header[2][1]
         logger.info("Found rigid body name: %s", rigid_body_name)
 
-    for col in df.columns[2:]:
+    for i, col in enumerate(header[2:], start=2):
         if col[2] != "Position":
             continue
 
         if col[1] == rigid_body_name:
-            df_cols.append(col)
+            df_cols.append(i)
             df_col_names.append(f"RB.{col[3]}")
         elif match := re.match(rf"^{re.escape(rigid_body_name)}:Marker(\d+)$", col[1]):
-            df_cols.append(col)
+            df_cols.append(i)
             n = int(match.group(1))
 
             if col[0] == "Marker":
@@ -162,76 +365,404 @@ def load_optitrack_data(
             f"the number of markers ({num_m})"
         )
 
-    # Create a new dataframe with the columns we want to keep
-    df = df[df_cols]
-    df.columns = df_col_names
+    # Number of lines of the header, the blank lines are skipped by read_csv
+    num_header_lines = 0
+    with open(filename, "r") as f:
+        num_rows = 0
+        while num_rows < 6:
+            num_header_lines += 1
+            num_rows += bool(f.readline().strip())
 
-    # Calculate errors for the markers
-    for i in range(1, num_m + 1):
-        for coord in ["X", "Y", "Z"]:
-            rb_coords = df[f"RB.{coord}{i}"]
-            raw_coords = df[f"M.{coord}{i}"]
-            df[f"ERR.{coord}{i}"] = raw_coords - rb_coords
+    return df_cols, df_col_names, num_m, num_header_lines
 
-        df[f"ERR.Abs{i}"] = np.sqrt(
-            df[f"ERR.X{i}"] ** 2 + df[f"ERR.Y{i}"] ** 2 + df[f"ERR.Z{i}"] ** 2
-        )
 
-    # Calculate the mean errors across all markers
-    for coord in ["X", "Y", "Z"]:
-        # Calculate mean error for each coordinate
-        error_cols = [f"ERR.{coord}{i}" for i in range(1, num_m + 1)]
-        df[f"ERR.{coord}_mean"] = df[error_cols].mean(axis=1)
+def load_optitrack_index(
+    filename: str, rigid_body_name: Optional[str] = None
+) -> CsvIndex:
+    """Row index of an OptiTrack CSV file, to load time windows of the take.
 
-    # Calculate mean absolute error
-    abs_error_cols = [f"ERR.Abs{i}" for i in range(1, num_m + 1)]
-    df["ERR.Abs_mean"] = df[abs_error_cols].mean(axis=1)
+    Besides the byte offsets of the rows, the index stores the frames where no
+    raw markers were detected (no_markers), where the rigid body is discarded,
+    and the centroid of the valid rigid body positions of the take
+    (rb_centroid), the center of the rotations of the alignment. The index is
+    built with a full read of the file and saved to a sidecar file.
 
-    # Find the frames where no raw markers were detected
-    raw_markers_na = df[[f"M.X{i}" for i in range(1, num_m + 1)]].isna().all(axis=1)
+    Args:
+        filename (str): Path to the OptiTrack CSV file.
+        rigid_body_name (Optional[str], optional): Name of the rigid body. If None,
+            uses the first rigid body found in the data. Defaults to None.
 
-    # Calculate the centroid of the markers
-    for coord in ["X", "Y", "Z"]:
-        cols = [f"M.{coord}{i}" for i in range(1, num_m + 1)]
-        df_cols = df[cols]
+    Returns:
+        CsvIndex: Index of the file.
+    """
+    df_cols, df_col_names, num_m, num_header_lines = _get_optitrack_columns(
+        filename, rigid_body_name
+    )
 
-        # Interpolate the optitrack data to fill the missing values
-        df_cols = df_cols.interpolate(
-            method="linear", axis=0, limit_area="inside", inplace=False
+    def get_extra() -> dict[str, np.ndarray]:
+        names = ["RB.X", "RB.Y", "RB.Z", *[f"M.X{i}" for i in range(1, num_m + 1)]]
+        usecols = [df_cols[df_col_names.index(name)] for name in names]
+        df = pd.read_csv(
+            filename, skiprows=num_header_lines, header=None, usecols=usecols
         )
+        values = df[usecols].to_numpy(dtype=np.float64)
+
+        no_markers = np.isnan(values[:, 3:]).all(axis=1)
+        rb_centroid = _nanmean(values[~no_markers, :3], axis=0)
 
-        df[f"M.{coord}_centroid"] = df_cols.mean(axis=1)
+        return {"no_markers": np.packbits(no_markers), "rb_centroid": rb_centroid}
 
-    # Set to NA the coordinates where no raw markers were detected
-    m_centroid_cols = [f"M.{coord}_centroid" for coord in ["X", "Y", "Z"]]
-    df.loc[raw_markers_na, m_centroid_cols] = np.nan
+    return load_csv_index(filename, num_header_lines, 1, get_extra=get_extra)
 
-    rb_cols = ["RB.X", "RB.Y", "RB.Z"] + [
-        f"RB.{coord}{i}" for i in range(1, num_m + 1) for coord in ["X", "Y", "Z"]
+
+@profile_section("load_optitrack_data")
+def load_optitrack_data(
+    filename: str,
+    rigid_body_name: Optional[str] = None,
+    lazy: bool = False,
+    time_window: Optional[tuple[float, float]] = None,
+    markers: bool = True,
+) -> tuple[Union[pd.DataFrame, LazyFrame], int]:
+    """Load and process OptiTrack motion capture data from a CSV file.
+
+    This function loads OptiTrack data, processes marker positions, calculates errors
+    between raw and rigid body markers, and computes various statistics.
+
+    Args:
+        filename (str): Path to the OptiTrack CSV file.
+        rigid_body_name (Optional[str], optional): Name of the rigid body to process.
+            If None, uses the first rigid body found in the data. Defaults to None.
+        lazy (bool, optional): Whether to return a LazyFrame where the errors,
+            means and centroids are computed on first access. Defaults to False.
+        time_window (Optional[tuple[float, float]], optional): If given, only the
+            rows of this (min, max) time range, and some rows around it, are read
+            with the row index of the file (see load_optitrack_index). The index
+            of the dataframe keeps the row numbers of the file. Defaults to None.
+        markers (bool, optional): Whether to load the marker columns. If False,
+            only the frame, time and rigid body columns are loaded, without the
+            derived columns. Defaults to True.
+
+    Returns:
+        tuple[Union[pd.DataFrame, LazyFrame], int]: A tuple containing:
+            - DataFrame with processed OptiTrack data including marker positions,
+              rigid body positions, errors, and centroids
+            - Number of markers detected
+
+    Raises:
+        ValueError: If the number of rigid body markers doesn't match the number of
+            raw markers, or if an unknown column type is encountered.
+    """
+    # Read the header first, so only the position columns are loaded
+    df_cols, df_col_names, num_m, num_header_lines = _get_optitrack_columns(
+        filename, rigid_body_name
+    )
+
+    marker_x_cols = []
+    if not markers:
+        # Without a time window, the frames with no raw markers are found from
+        # the X columns of the markers, instead of building the row index
+        if time_window is None:
+            marker_x_cols = [f"M.X{i}" for i in range(1, num_m + 1)]
+        core_cols = ["frame", "time", "RB.X", "RB.Y", "RB.Z", *marker_x_cols]
+        df_cols = [df_cols[df_col_names.index(col)] for col in core_cols]
+        df_col_names = core_cols
+
+    # Load the columns we want to keep
+    index: Optional[CsvIndex] = None
+    if time_window is None:
+        with profile_section("read_csv"):
+            df_data = pd.read_csv(
+                filename, skiprows=num_header_lines, header=None, usecols=df_cols
+            )
+    else:
+        index = load_optitrack_index(filename, rigid_body_name)
+        first_row, num_rows = index.get_row_range(*time_window)
+        with profile_section("read_csv"):
+            df_data = read_csv_rows(filename, index, first_row, num_rows, df_cols)
+
+    df_data.columns = [df_col_names[df_cols.index(i)] for i in df_data.columns]
+    if not markers and time_window is None:
+        no_markers = df_data[marker_x_cols].isna().all(axis=1).to_numpy()
+        df_data = df_data.drop(columns=marker_x_cols)
+    row_index = df_data.index
+    num_frames = len(df_data)
+
+    # All the columns but the frame number are stored in a single block: the
+    # time, the rigid body, the rigid body markers and the raw markers, followed
+    # by the derived columns ERR.X{i}, ERR.Y{i}, ERR.Z{i}, ERR.Abs{i} of each
+    # marker, the means of the errors across all markers and the centroid of
+    # the markers. The markers are contiguous, so their (frames, markers, 3)
+    # tensors are views of the block.
+    coords = ["X", "Y", "Z"]
+    num_loaded_m = num_m if markers else 0
+    markers_range = range(1, num_loaded_m + 1)
+    rb_m_cols = [f"RB.{coord}{i}" for i in markers_range for coord in coords]
+    m_cols = [f"M.{coord}{i}" for i in markers_range for coord in coords]
+    err_cols = [f"ERR.{coord}{i}" for i in markers_range for coord in [*coords, "Abs"]]
+
+    data_cols = ["time", "RB.X", "RB.Y", "RB.Z", *rb_m_cols, *m_cols]
+    block_cols = [
+        *data_cols,
+        *err_cols,
+        *[f"ERR.{coord}_mean" for coord in coords],
+        "ERR.Abs_mean",
+        *[f"M.{coord}_centroid" for coord in coords],
     ]
-    df.loc[raw_markers_na, rb_cols] = np.nan
+    if lazy or not markers:
+        block_cols = data_cols
+    block = np.empty((num_frames, len(block_cols)), dtype=np.float64)
+
+    # Move the columns of the file to the block, releasing each parsed column
+    columns = {col: df_data[col].to_numpy() for col in df_data.columns}
+    del df_data
+
+    frame = columns.pop("frame")
+    for i, col in enumerate(data_cols):
+        block[:, i] = columns.pop(col)
+
+    rb_start = data_cols.index("RB.X")
+    m_start = len(data_cols) - 3 * num_loaded_m
+    rb = block[:, rb_start + 3 : m_start].reshape(num_frames, num_loaded_m, 3)
+    raw = block[:, m_start : len(data_cols)].reshape(num_frames, num_loaded_m, 3)
+    derived = block[:, len(data_cols) :]
+
+    # Set to NA the rigid body where no raw markers were detected
+    if markers:
+        raw_markers_na = np.isnan(raw[:, :, 0]).all(axis=1)
+    elif time_window is None:
+        raw_markers_na = no_markers
+    else:
+        assert index is not None
+        no_markers = np.unpackbits(index.extra["no_markers"], count=index.num_rows)
+        raw_markers_na = no_markers[row_index].astype(bool)
+    block[raw_markers_na, rb_start:m_start] = np.nan
+
+    if markers and not lazy:
+        # Errors of the markers, their means across all markers and centroid
+        err = derived[:, : 4 * num_m].reshape(num_frames, num_m, 4)
+        _get_marker_errors(raw, rb, out=err)
+        derived[:, 4 * num_m : 4 * num_m + 4] = _get_marker_error_means(err)
+        derived[:, 4 * num_m + 4 :] = _get_marker_centroid(raw)
+
+    # Create the dataframe from the block at once
+    df = pd.DataFrame(block, columns=block_cols, index=row_index, copy=False)
+    df.insert(0, "frame", frame)
+
+    if lazy:
+        frame_lazy = LazyFrame(df)
+        if markers:
+            _register_marker_columns(frame_lazy, num_m)
+        return frame_lazy, num_m
 
     return df, num_m
 
 
-def get_calibration_matrices(x) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-    """Convert calibration parameters into transformation matrices.
+@profile_section("load_resampled_data")
+def load_resampled_data(
+    gantry_filename: str,
+    optitrack_filename: str,
+    rate: float,
+    anti_alias: bool = True,
+    cache_filename: Optional[str] = None,
+) -> tuple[pd.DataFrame, pd.DataFrame, int]:
+    """Load the gantry and OptiTrack data resampled on a uniform time grid.
+
+    Both streams are resampled once on the same grid, which covers the time range
+    of the OptiTrack data, so the rows of both dataframes are aligned and the
+    index of a time is round((t - t[0]) * rate). The gantry time is converted to
+    the OptiTrack time (from the capture start).
+
+    Args:
+        gantry_filename (str): Path to the gantry data file.
+        optitrack_filename (str): Path to the OptiTrack data CSV file.
+        rate (float): Sample rate of the grid in Hz.
+        anti_alias (bool, optional): Whether to low-pass filter the streams faster
+            than the grid before resampling. Defaults to True.
+        cache_filename (Optional[str], optional): Path of a .npz file to cache the
+            resampled data. The cache is rebuilt if the data files or the
+            parameters change. Defaults to None.
+
+    Returns:
+        tuple[pd.DataFrame, pd.DataFrame, int]: A tuple containing:
+            - Resampled OptiTrack data
+            - Resampled gantry data, with the time in the OptiTrack time
+            - Number of markers detected
+    """
+    key = get_cache_key(
+        [gantry_filename, optitrack_filename], rate=rate, anti_alias=anti_alias
+    )
+
+    frames = load_resampled(cache_filename, key) if cache_filename else None
+    if frames is not None:
+        logger.info("Resampled data loaded from cache: %s", cache_filename)
+        df_optitrack, df_gantry = frames["optitrack"], frames["gantry"]
+    else:
+        df_optitrack, _ = load_optitrack_data(optitrack_filename)
+        metadata_optitrack = load_optitrack_metadata(optitrack_filename)
+        df_gantry = load_gantry_data(gantry_filename)
+
+        capture_start_time = metadata_optitrack["Capture Start Time"].timestamp()
+        df_gantry["time"] = df_gantry["time"] - capture_start_time
+
+        t_o = df_optitrack["time"]
+        grid = get_time_grid(t_o.iloc[0], t_o.iloc[-1], rate)
+
+        df_optitrack = resample_frame(df_optitrack, grid, anti_alias=anti_alias)
+        df_gantry = resample_frame(
+            df_gantry[["time", "x", "y", "z"]], grid, anti_alias=anti_alias
+        )
+
+        if cache_filename:
+            save_resampled(
+                cache_filename, key, {"optitrack": df_optitrack, "gantry": df_gantry}
+            )
+
+    num_markers = sum(
+        re.fullmatch(r"M\.X\d+", col) is not None for col in df_optitrack.columns
+    )
+
+    return df_optitrack, df_gantry, num_markers
+
+
+def detect_dwells(
+    df: pd.DataFrame,
+    cols: Sequence[str] = ("GAN.X", "GAN.Y", "GAN.Z"),
+    velocity_threshold: float = 0.5,
+    min_duration: float = 1.0,
+    settle_time: float = 0.25,
+    time_col: str = "time",
+) -> np.ndarray:
+    """Detect the dwells of the gantry from its velocity.
+
+    A dwell is a run of frames where the speed of the gantry is below the
+    velocity threshold. The first and last settle_time seconds of each run are
+    discarded to skip the settling of the machine and the interpolation of the
+    gantry position at the edges, and the runs shorter than min_duration are
+    ignored.
+
+    Args:
+        df: DataFrame with the time and gantry position columns.
+        cols: Gantry position columns.
+        velocity_threshold: Maximum speed of a dwell (mm/s).
+        min_duration: Minimum duration of a dwell after the settling (s).
+        settle_time: Time discarded at the start and end of each dwell (s).
+        time_col: Name of the time column.
+
+    Returns:
+        np.ndarray: Dwell number of each frame, -1 for frames out of a dwell.
+    """
+    t = df[time_col].to_numpy(dtype=np.float64)
+    pos = df[list(cols)].to_numpy(dtype=np.float64)
+
+    speed = np.linalg.norm(np.gradient(pos, t, axis=0), axis=1)
+    still = speed < velocity_threshold  # NaN speed is not still
+
+    # Run number of each frame, runs of still frames have odd numbers
+    edges = np.diff(still.astype(np.int8), prepend=0) != 0
+    run = np.cumsum(edges)
+    run_ids, run_start, run_count = np.unique(
+        run, return_index=True, return_counts=True
+    )
+    run_end = run_start + run_count - 1
+
+    t_start = t[run_start] + settle_time
+    t_end = t[run_end] - settle_time
+    valid = still[run_start] & (t_end - t_start >= min_duration)
+
+    # Dwell number of each valid run, consecutive from 0
+    dwell_of_run = np.full(len(run_ids), -1)
+    dwell_of_run[valid] = np.arange(np.count_nonzero(valid))
+
+    run_idx = run - run_ids[0]
+    dwell = dwell_of_run[run_idx]
+    dwell[(t < t_start[run_idx]) | (t > t_end[run_idx])] = -1
+
+    return dwell
+
+
+def get_dwell_points(
+    df: pd.DataFrame,
+    dwell: np.ndarray,
+    cols: Sequence[str] = ("GAN.X", "GAN.Y", "GAN.Z", "RB.X", "RB.Y", "RB.Z"),
+) -> pd.DataFrame:
+    """Average the frames of each dwell.
+
+    Args:
+        df: DataFrame with the processed data.
+        dwell: Dwell number of each frame, as returned by detect_dwells.
+        cols: Columns to average.
+
+    Returns:
+        pd.DataFrame: DataFrame indexed by dwell number with the columns
+            {col}, {col}.VAR and {col}.COUNT for each column, i.e., the mean,
+            the variance and the number of valid frames of the dwell.
+    """
+    cols = list(cols)
+    grouped = df.loc[dwell >= 0, cols].groupby(dwell[dwell >= 0])
+
+    mean = grouped.mean()
+    var = grouped.var().add_suffix(".VAR")
+    count = grouped.count().add_suffix(".COUNT")
+
+    return pd.concat([mean, var, count], axis=1)
+
+
+def calibrate_dwell_points(
+    points: pd.DataFrame,
+    gantry_cols: Sequence[str] = ("GAN.X", "GAN.Y", "GAN.Z"),
+    optitrack_cols: Sequence[str] = ("RB.X", "RB.Y", "RB.Z"),
+    min_var: float = 1e-4,
+) -> np.ndarray:
+    """Fit the calibration model to the averaged dwell points.
+
+    The calibration model is linear in its parameters, so each output
+    coordinate is fitted with weighted linear least squares, where the weight
+    of a point is the inverse of the variance of its mean.
 
     Args:
-        x: Array of calibration parameters (18 elements).
+        points: Averaged dwell points, as returned by get_dwell_points.
+        gantry_cols: Columns with the gantry positions.
+        optitrack_cols: Columns with the OptiTrack positions.
+        min_var: Lower bound of the frame variance (mm^2), to avoid giving an
+            excessive weight to points with a few frames.
 
     Returns:
-        tuple[np.ndarray, np.ndarray, np.ndarray]: A tuple containing:
-            - 3x3 transformation matrix for the first transformation
-            - 3x3 transformation matrix for the second transformation
-            - 3-element translation array
+        np.ndarray: Array of calibration parameters (18 elements).
+
+    Raises:
+        ValueError: If there are fewer valid points than coefficients of the
+            model, or the points do not determine them, e.g., no dwells were
+            detected or all of them are at the same height.
     """
-    matrix1 = np.array(x[:9]).reshape(3, 3)
-    matrix2 = np.array(np.concatenate([x[9:15], [0, 0, 0]])).reshape(3, 3)
-    array = np.array(x[15:18])
-    return matrix1, matrix2, array
+    design = get_calibration_design_matrix(points[list(gantry_cols)])
+    coef = np.zeros((design.shape[1], len(optitrack_cols)))
+
+    for j, col in enumerate(optitrack_cols):
+        count = points[f"{col}.COUNT"].to_numpy(dtype=np.float64)
+        var = np.maximum(points[f"{col}.VAR"].fillna(min_var).to_numpy(), min_var)
+        y = points[col].to_numpy(dtype=np.float64)
+
+        valid = (count >= 2) & np.isfinite(y) & np.isfinite(design).all(axis=1)
+        if np.count_nonzero(valid) < design.shape[1]:
+            raise ValueError(
+                f"{np.count_nonzero(valid)} valid dwell points for {col}, at least "
+                f"{design.shape[1]} are needed to fit the calibration"
+            )
+
+        sqrt_w = np.sqrt(count[valid] / var[valid])
+        coef[:, j], _, rank, _ = np.linalg.lstsq(
+            design[valid] * sqrt_w[:, None], y[valid] * sqrt_w, rcond=None
+        )
+        if rank < design.shape[1]:
+            raise ValueError(
+                f"The dwell points for {col} do not determine the calibration, "
+                f"the design matrix has rank {rank} < {design.shape[1]}"
+            )
+
+    return get_calibration_params(coef)
 
 
+@profile_section("get_processed_data")
 def get_processed_data(
     gantry_filename: str,
     optitrack_filename: str,
@@ -240,7 +771,20 @@ def get_processed_data(
     bad_frames: Optional[list[tuple[int, int]]] = None,
     alignment_init_params: Optional[Sequence[float]] = None,
     calibrate: bool = False,
-) -> tuple[pd.DataFrame, int]:
+    dwell_calibration: bool = False,
+    time_offset_xcorr: bool = True,
+    clock_drift: bool = False,
+    time_warp: bool = False,
+    time_warp_window: float = 60.0,
+    resample_rate: Optional[float] = None,
+    anti_alias: bool = True,
+    resample_cache_filename: Optional[str] = None,
+    lazy: bool = False,
+    columns: Optional[Sequence[str]] = None,
+    time_window: Optional[tuple[float, float]] = None,
+    cache_dir: Optional[str] = None,
+    optimizer_trace_filename: Optional[str] = None,
+) -> tuple[Union[pd.DataFrame, LazyFrame], int]:
     """Process and align gantry and OptiTrack data.
 
     This function loads gantry and OptiTrack data, aligns them temporally and spatially,
@@ -259,34 +803,265 @@ def get_processed_data(
         alignment_init_params (Optional[Sequence[float]], optional): Initial alignment
             parameters. Defaults to None.
         calibrate (bool, optional): Whether to perform calibration. Defaults to False.
+        dwell_calibration (bool, optional): Whether to calibrate with the averaged
+            points of the gantry dwells, e.g., of a take measured with the dwell
+            mode of run_measurement.py, instead of all the frames. Defaults to False.
+        time_offset_xcorr (bool, optional): Whether to estimate the time shift of the
+            alignment by cross-correlation of the speed of both streams, as the
+            initial value of the time shift of the fit. Defaults to True.
+        clock_drift (bool, optional): Whether to estimate a linear drift between the
+            gantry and OptiTrack clocks, and apply it as a time warp of the OptiTrack
+            data instead of the constant time shift. The drift is estimated every
+            time, and only applied if it aligns the data better than the time
+            shift of the alignment parameters. Defaults to False.
+        time_warp (bool, optional): Like clock_drift, but with a piecewise linear
+            time offset fitted on windows of the take, for long takes. Defaults to
+            False.
+        time_warp_window (float, optional): Length of the windows of the time warp,
+            and of the refinement of the clock drift, in seconds. Defaults to 60.0.
+        resample_rate (Optional[float], optional): If given, both streams are
+            resampled once on a uniform time grid at this rate (Hz), see
+            load_resampled_data, and the rows of the result are the times of the
+            grid. The frame column keeps the fractional OptiTrack frame number.
+            Defaults to None.
+        anti_alias (bool, optional): Whether to low-pass filter the streams before
+            resampling. Defaults to True.
+        resample_cache_filename (Optional[str], optional): Path of a .npz file to
+            cache the resampled data. Defaults to None.
+        lazy (bool, optional): Whether to return a LazyFrame where only the time,
+            rigid body and gantry columns are processed, and the marker columns,
+            their errors and centroids, the calibrated coordinates and the gantry
+            errors are computed on first access. The values are the same as
+            without lazy. Defaults to False.
+        columns (Optional[Sequence[str]], optional): If given, only these columns
+            are returned, and computed. The marker columns are not loaded if no
+            column needs them. Defaults to None.
+        time_window (Optional[tuple[float, float]], optional): If given, only the
+            rows of this (min, max) time range are returned. If the alignment
+            (and the calibration, if calibrate) parameters are loaded from their
+            files, and there is no resampling, clock drift or time warp, only
+            this time range of the files is read, with row indices saved next to
+            the data files. Otherwise, the whole take is processed. Defaults to
+            None.
+        cache_dir (Optional[str], optional): If given, the output of each
+            processing stage is cached in this directory, and a stage is only run
+            again when its inputs change, e.g., the files, the bad frames or the
+            parameters. Defaults to None.
+        optimizer_trace_filename (Optional[str], optional): Path of a .npz file
+            to save the objective evaluations of the alignment and calibration
+            fits run, see optimizer_trace.py. Defaults to None.
 
     Returns:
-        tuple[pd.DataFrame, int]: A tuple containing:
+        tuple[Union[pd.DataFrame, LazyFrame], int]: A tuple containing:
             - DataFrame with processed and aligned data
             - Number of markers detected
     """
+    # The processing is a graph of stages, see Pipeline: the gantry and
+    # OptiTrack data are loaded concurrently, and with cache_dir, the output of
+    # each stage is cached, so only the stages whose inputs changed are run
+    # again, e.g., only the bad frames, calibration and errors stages when the
+    # bad frames change.
+    pipeline = Pipeline(cache_dir)
+
+    # Objective evaluations of the fits run by the stages
+    traces: list[OptimizerTrace] = []
+
     # -------------------------------------------------------------------------
     # Load the Gantry and Optitrack data
+    #
+    # With a time window, only the rows of the window, plus the time shift of
+    # the alignment and a margin, are read if the parameters do not need the
+    # whole take. With columns, the marker columns are only read if needed.
     # -------------------------------------------------------------------------
 
-    df_optitrack, num_markers = load_optitrack_data(optitrack_filename)
-    metadata_optitrack = load_optitrack_metadata(optitrack_filename)
+    core_cols = ["frame", "time", "RB.X", "RB.Y", "RB.Z"]
+    gantry_cols = [
+        "GAN.X",
+        "GAN.Y",
+        "GAN.Z",
+        *[f"GAN.CALIBRATED.{coord}" for coord in ["X", "Y", "Z"]],
+        *[
+            f"GAN.ERR{coord_sep}{coord}"
+            for coord_sep in [".", ".CALIBRATED."]
+            for coord in ["X", "Y", "Z", "Abs"]
+        ],
+    ]
+
+    select = columns is not None or time_window is not None
+    lazy = lazy or select
+    markers = columns is None or any(
+        col not in core_cols and col not in gantry_cols for col in columns
+    )
+
+    need_alignment = not (
+        alignment_params_filename and os.path.exists(alignment_params_filename)
+    )
+    need_calibration = calibrate and not (
+        calibration_params_filename and os.path.exists(calibration_params_filename)
+    )
+
+    load_window: Optional[tuple[float, float]] = None
+    rb_centroid: Optional[np.ndarray] = None
+    margin = 1.0
+    if (
+        time_window is not None
+        and not need_alignment
+        and not (resample_rate or clock_drift or time_warp or dwell_calibration)
+        and not need_calibration
+        and not gantry_filename.endswith(".json")
+    ):
+        assert alignment_params_filename is not None
+        t_shift = float(np.load(alignment_params_filename)[6])
+        load_window = (
+            min(time_window[0], time_window[0] - t_shift) - margin,
+            max(time_window[1], time_window[1] - t_shift) + margin,
+        )
+        rb_centroid = load_optitrack_index(optitrack_filename).extra["rb_centroid"]
+    elif time_window is not None:
+        logger.info("The parameters need the whole take, the time window is not used")
+
+    if resample_rate:
+        pipeline.add(
+            "resampled",
+            [],
+            lambda: load_resampled_data(
+                gantry_filename,
+                optitrack_filename,
+                resample_rate,
+                anti_alias,
+                resample_cache_filename,
+            ),
+            params={
+                "files": get_cache_key([gantry_filename, optitrack_filename]),
+                "rate": resample_rate,
+                "anti_alias": anti_alias,
+            },
+        )
+        pipeline.add(
+            "optitrack",
+            ["resampled"],
+            lambda resampled: (resampled[0], resampled[2]),
+            cache=False,
+        )
+        pipeline.add(
+            "gantry", ["resampled"], lambda resampled: resampled[1], cache=False
+        )
+        capture_start_time = 0.0
+    else:
+        metadata_optitrack = load_optitrack_metadata(optitrack_filename)
+        capture_start_time = metadata_optitrack["Capture Start Time"].timestamp()
+
+        gantry_window = None
+        if load_window is not None:
+            gantry_window = (
+                capture_start_time + load_window[0] - margin,
+                capture_start_time + load_window[1] + margin,
+            )
 
-    df_gantry = load_gantry_data(gantry_filename)
+        # The lazy frames are not cached, their derived columns are functions
+        pipeline.add(
+            "optitrack",
+            [],
+            lambda: load_optitrack_data(
+                optitrack_filename, lazy=lazy, time_window=load_window, markers=markers
+            ),
+            params={
+                "file": get_cache_key([optitrack_filename]),
+                "time_window": load_window,
+                "markers": markers,
+            },
+            cache=not lazy,
+        )
+        pipeline.add(
+            "gantry",
+            [],
+            lambda: load_gantry_data(gantry_filename, gantry_window),
+            params={
+                "file": get_cache_key([gantry_filename]),
+                "time_window": gantry_window,
+            },
+        )
 
     # -------------------------------------------------------------------------
     # Combine the data
     # -------------------------------------------------------------------------
 
-    capture_start_time = metadata_optitrack["Capture Start Time"].timestamp()
+    # Without lazy, all the columns are processed. With lazy, only the time and
+    # the rigid body, the other columns are registered at the end
+    def merge_data(optitrack, df_gantry: pd.DataFrame) -> pd.DataFrame:
+        df_optitrack = optitrack[0]
+        if isinstance(df_optitrack, LazyFrame):
+            df = df_optitrack.to_frame(core_cols).copy()
+        else:
+            df = df_optitrack.copy()
+
+        t_g = df_gantry["time"] - capture_start_time
+        with profile_section("interpolate"):
+            kernel = InterpKernel(df_optitrack["time"], t_g)
+            gantry_pos = kernel(df_gantry[["x", "y", "z"]].to_numpy())
+        df[["GAN.X", "GAN.Y", "GAN.Z"]] = gantry_pos
 
-    df = df_optitrack.copy()
-    t_o = df_optitrack["time"]
-    t_g = df_gantry["time"] - capture_start_time
+        return df
 
-    df["GAN.X"] = np.interp(t_o, t_g, df_gantry["x"], left=np.nan, right=np.nan)
-    df["GAN.Y"] = np.interp(t_o, t_g, df_gantry["y"], left=np.nan, right=np.nan)
-    df["GAN.Z"] = np.interp(t_o, t_g, df_gantry["z"], left=np.nan, right=np.nan)
+    pipeline.add(
+        "merge",
+        ["optitrack", "gantry"],
+        merge_data,
+        params={"capture_start_time": capture_start_time, "lazy": lazy},
+    )
+
+    # Estimate the clock offset by cross-correlation if it is needed. A clock
+    # drift or a time warp is applied to the OptiTrack data as a piecewise
+    # linear time offset through the knots in warp_knots.
+    def estimate_time_offset(
+        optitrack, df_gantry: pd.DataFrame
+    ) -> tuple[Optional[ClockOffset], Optional[tuple[np.ndarray, np.ndarray]]]:
+        df_optitrack = optitrack[0]
+        t_o = df_optitrack["time"]
+        t_g = df_gantry["time"] - capture_start_time
+
+        gantry_pos = df_gantry[["x", "y", "z"]]
+        optitrack_pos = df_optitrack[["RB.X", "RB.Y", "RB.Z"]]
+
+        clock_offset: Optional[ClockOffset] = None
+        warp_knots: Optional[tuple[np.ndarray, np.ndarray]] = None
+
+        if time_warp:
+            warp_knots = fit_time_warp(
+                t_g, gantry_pos, t_o, optitrack_pos, window=time_warp_window
+            )
+            logger.info(
+                "Time warp with %d knots, offset from %.4f s to %.4f s",
+                len(warp_knots[0]),
+                warp_knots[1].min(),
+                warp_knots[1].max(),
+            )
+        elif clock_drift or (time_offset_xcorr and need_alignment):
+            clock_offset = estimate_clock_offset(
+                t_g, gantry_pos, t_o, optitrack_pos, drift=clock_drift
+            )
+            logger.info("Clock offset estimated by cross-correlation: %s", clock_offset)
+
+            if clock_drift:
+                t_range = np.array([t_o.min(), t_o.max()])
+                warp_knots = (t_range, clock_offset.shift(t_range))
+
+        return clock_offset, warp_knots
+
+    estimate_offset = time_warp or clock_drift or (time_offset_xcorr and need_alignment)
+    pipeline.add(
+        "time_offset",
+        ["optitrack", "gantry"] if estimate_offset else [],
+        estimate_time_offset if estimate_offset else lambda: (None, None),
+        params={
+            "capture_start_time": capture_start_time,
+            "time_warp": time_warp,
+            "time_warp_window": time_warp_window,
+            "clock_drift": clock_drift,
+            "estimate_offset": estimate_offset,
+        },
+        hash_output=True,
+    )
 
     # -------------------------------------------------------------------------
     # Align the optitrack data with the gantry data
@@ -295,13 +1070,113 @@ def get_processed_data(
     # data. The alignment parameters are saved in the alignment_params_filename
     # file. If the file exists, the alignment parameters are loaded from the file,
     # otherwise, the alignment parameters are calculated using the Powell method.
+    # If the time shift was estimated by cross-correlation, it is the initial
+    # value of the time shift. A time warp is refined on the aligned data, and
+    # only applied if it aligns the data better than the constant time shift,
+    # e.g., on a take without clock drift, a warp only adds the errors of its
+    # knots.
     # -------------------------------------------------------------------------
 
-    # File for the alignment parameters
-    if alignment_params_filename and os.path.exists(alignment_params_filename):
-        alignment_params = np.load(alignment_params_filename)
-        logger.info("Alignment parameters loaded from file: %s", alignment_params)
-    else:
+    # Gantry and rigid body positions of the data, with columns time, x, y, z
+    def get_alignment_data(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+        df_gantry_tr = df[["time", "GAN.X", "GAN.Y", "GAN.Z"]]
+        df_gantry_tr.columns = ["time", "x", "y", "z"]
+
+        df_optitrack_tr = df[["time", "RB.X", "RB.Y", "RB.Z"]]
+        df_optitrack_tr.columns = ["time", "x", "y", "z"]
+
+        return df_gantry_tr, df_optitrack_tr
+
+    # Function to transform the data with the spatial parameters. The rotations
+    # keep the centroid of the data, so all the rotation centers are the centroid
+    # of the untransformed data translated by the shift of the first transform.
+    def coord_transform_spatial(
+        x, df: pd.DataFrame, centroid: np.ndarray
+    ) -> pd.DataFrame:
+        center = tuple(centroid + x[:3])
+        return coord_transform(
+            df,
+            [
+                TransformShiftXYZ(x[0], x[1], x[2]),
+                TransformRotate("x", x[3], center),
+                TransformRotate("y", x[4], center),
+                TransformRotate("z", x[5], center),
+            ],
+        )
+
+    # The knots of the cross-correlation of the speeds are refined on the data
+    # aligned in space
+    def refine_warp_knots(
+        df_gantry_tr: pd.DataFrame,
+        df_spatial: pd.DataFrame,
+        warp_knots: tuple[np.ndarray, np.ndarray],
+    ) -> tuple[np.ndarray, np.ndarray]:
+        warp_knots = refine_time_warp(
+            df_gantry_tr["time"],
+            df_gantry_tr[["x", "y", "z"]],
+            df_spatial["time"],
+            df_spatial[["x", "y", "z"]],
+            warp_knots,
+            time_warp_window,
+            linear=not time_warp,
+        )
+        logger.info(
+            "Time warp refined, offset from %.4f s to %.4f s",
+            warp_knots[1].min(),
+            warp_knots[1].max(),
+        )
+        return warp_knots
+
+    def use_time_warp(mse_shift: float, mse_warp: float) -> bool:
+        use_warp = mse_warp < mse_shift
+        logger.info(
+            "Alignment error of %.4f mm with the constant time shift and %.4f mm "
+            "with the time warp, the %s is applied",
+            mse_shift,
+            mse_warp,
+            "time warp" if use_warp else "constant time shift",
+        )
+        return use_warp
+
+    def get_alignment_params(
+        df: Optional[pd.DataFrame] = None, time_offset=None
+    ) -> tuple[np.ndarray, Optional[tuple[np.ndarray, np.ndarray]]]:
+        warp_knots = None if time_offset is None else time_offset[1]
+
+        if not need_alignment:
+            alignment_params = np.load(cast(str, alignment_params_filename))
+            logger.info("Alignment parameters loaded from file: %s", alignment_params)
+
+            # The time warp is compared with the time shift of the parameters
+            if warp_knots is not None:
+                assert df is not None
+                df_gantry_tr, df_optitrack_tr = get_alignment_data(df)
+                centroid = (
+                    rb_centroid
+                    if rb_centroid is not None
+                    else df_optitrack_tr[["x", "y", "z"]].mean().to_numpy()
+                )
+                df_spatial = coord_transform_spatial(
+                    alignment_params, df_optitrack_tr, centroid
+                )
+                warp_knots = refine_warp_knots(df_gantry_tr, df_spatial, warp_knots)
+                mse_shift = coord_mse(
+                    df_gantry_tr, TransformShiftT(alignment_params[6]).apply(df_spatial)
+                )
+                mse_warp = coord_mse(
+                    df_gantry_tr, TransformTimeWarp(*warp_knots).apply(df_spatial)
+                )
+                if not use_time_warp(mse_shift, mse_warp):
+                    warp_knots = None
+
+            return alignment_params, warp_knots
+
+        # Imported when fitting, so loading the data does not import scipy
+        import scipy as scp
+
+        assert df is not None and time_offset is not None
+        clock_offset = time_offset[0]
+
         # Function to transform the data based on an array of parameters
         def coord_transform_array(x, df: pd.DataFrame) -> pd.DataFrame:
             return coord_transform(
@@ -315,13 +1190,7 @@ def get_processed_data(
                 ],
             )
 
-        # Gantry data
-        df_gantry_tr = df[["time", "GAN.X", "GAN.Y", "GAN.Z"]]
-        df_gantry_tr.columns = ["time", "x", "y", "z"]
-
-        # Optitrack data
-        df_optitrack_tr = df[["time", "RB.X", "RB.Y", "RB.Z"]]
-        df_optitrack_tr.columns = ["time", "x", "y", "z"]
+        df_gantry_tr, df_optitrack_tr = get_alignment_data(df)
 
         # Initial alignment parameters
         if alignment_init_params:
@@ -334,53 +1203,150 @@ def get_processed_data(
         bounds[4] = (x0[4] - np.pi / 32, x0[4] + np.pi / 32)
         bounds[5] = (x0[5] - np.pi / 32, x0[5] + np.pi / 32)
 
+        # The time shift estimated by cross-correlation, or the median of the
+        # time warp, is the initial value, it is refined with the spatial
+        # parameters
+        if warp_knots is not None:
+            x0[6] = float(np.median(warp_knots[1]))
+        elif clock_offset is not None and np.isfinite(clock_offset.offset):
+            x0[6] = clock_offset.offset
+
         logger.info("Aligning optitrack data with gantry data...")
-        res = scp.optimize.minimize(
-            fun=lambda x: coord_mse(
-                df_gantry_tr, coord_transform_array(x, df_optitrack_tr)
-            ),
-            x0=x0,
-            bounds=bounds,
-            tol=1e-9,
-            options={"disp": True},
-            callback=lambda intermediate_result: print(
-                f"fval: {getattr(intermediate_result, 'fun', intermediate_result)}"
-            ),
-            method="Powell",
-        )
+        trace = OptimizerTrace("alignment", "Powell", {"tol": 1e-9})
+        traces.append(trace)
+        with profile_section("optimize_alignment"):
+            res = scp.optimize.minimize(
+                fun=trace.wrap(
+                    lambda x: coord_mse(
+                        df_gantry_tr, coord_transform_array(x, df_optitrack_tr)
+                    )
+                ),
+                x0=x0,
+                bounds=bounds,
+                tol=1e-9,
+                options={"disp": True},
+                callback=trace.callback,
+                method="Powell",
+            )
 
         alignment_params = res.x
+
+        if warp_knots is not None:
+            # The spatial parameters are refined with the time warp. It commutes
+            # with the spatial transforms, so it is applied once in advance.
+            centroid = df_optitrack_tr[["x", "y", "z"]].mean().to_numpy()
+            warp_knots = refine_warp_knots(
+                df_gantry_tr,
+                coord_transform_spatial(res.x, df_optitrack_tr, centroid),
+                warp_knots,
+            )
+            df_warped = TransformTimeWarp(*warp_knots).apply(df_optitrack_tr)
+
+            logger.info("Aligning the time warped optitrack data (6 parameters)...")
+            trace = OptimizerTrace("alignment_warp", "Powell", {"tol": 1e-9})
+            traces.append(trace)
+            with profile_section("optimize_alignment"):
+                res_warp = scp.optimize.minimize(
+                    fun=trace.wrap(
+                        lambda x: coord_mse(
+                            df_gantry_tr,
+                            coord_transform_spatial(x, df_warped, centroid),
+                        )
+                    ),
+                    x0=res.x[:6],
+                    bounds=bounds[:6],
+                    tol=1e-9,
+                    options={"disp": True},
+                    callback=trace.callback,
+                    method="Powell",
+                )
+
+            # The time shift is kept, in case the warp is not applied later
+            if use_time_warp(res.fun, res_warp.fun):
+                alignment_params = np.append(res_warp.x, res.x[6])
+            else:
+                warp_knots = None
+
         logger.info("Alignment completed. Parameters: %s", alignment_params)
 
-        # save the alignment parameters
-        if alignment_params_filename:
-            np.save(alignment_params_filename, alignment_params)
-
-    # Transform all the optitrack data in the dataframe
-    center_cols = ["RB.X", "RB.Y", "RB.Z"]
-    cols_params = {
-        f"{axis.lower()}_cols": [
-            col
-            for col in df.columns
-            if col.startswith(f"M.{axis}") or col.startswith(f"RB.{axis}")
-        ]
-        for axis in ["X", "Y", "Z"]
-    }
-
-    df = coord_transform(
-        df,
-        [
-            TransformShiftXYZ(
-                alignment_params[0],
-                alignment_params[1],
-                alignment_params[2],
-                **cols_params,
+        return alignment_params, warp_knots
+
+    # The loaded parameters only depend on the data to check a time warp
+    pipeline.add(
+        "alignment",
+        (
+            ["merge", "time_offset"]
+            if need_alignment or time_warp or clock_drift
+            else []
+        ),
+        get_alignment_params,
+        params={
+            "file": (
+                None
+                if need_alignment
+                else get_cache_key([cast(str, alignment_params_filename)])
             ),
-            TransformRotateCenter("x", alignment_params[3], center_cols, **cols_params),
-            TransformRotateCenter("y", alignment_params[4], center_cols, **cols_params),
-            TransformRotateCenter("z", alignment_params[5], center_cols, **cols_params),
-            TransformShiftT(alignment_params[6], "time", **cols_params),
-        ],
+            "init_params": list(alignment_init_params or []),
+            "time_warp_window": time_warp_window,
+        },
+        hash_output=True,
+    )
+
+    # Transform all the optitrack data in the dataframe. The rotations are made
+    # about the centroid of the rigid body, which they keep. In a time window,
+    # it is the centroid of the whole take, stored in the row index.
+    def transform_optitrack(
+        df: pd.DataFrame,
+        alignment: tuple[np.ndarray, Optional[tuple[np.ndarray, np.ndarray]]],
+    ) -> pd.DataFrame:
+        alignment_params, warp_knots = alignment
+
+        center_cols = ["RB.X", "RB.Y", "RB.Z"]
+        cols_params = {
+            f"{axis.lower()}_cols": [
+                col
+                for col in df.columns
+                if col.startswith(f"M.{axis}") or col.startswith(f"RB.{axis}")
+            ]
+            for axis in ["X", "Y", "Z"]
+        }
+
+        rotations: list[Transform]
+        if rb_centroid is None:
+            rotations = [
+                TransformRotateCenter(axis, angle, center_cols, **cols_params)
+                for axis, angle in zip("xyz", alignment_params[3:6])
+            ]
+        else:
+            center = tuple(rb_centroid + alignment_params[:3])
+            rotations = [
+                TransformRotate(axis, angle, center, **cols_params)
+                for axis, angle in zip("xyz", alignment_params[3:6])
+            ]
+
+        return coord_transform(
+            df,
+            [
+                TransformShiftXYZ(
+                    alignment_params[0],
+                    alignment_params[1],
+                    alignment_params[2],
+                    **cols_params,
+                ),
+                *rotations,
+                (
+                    TransformShiftT(alignment_params[6], "time", **cols_params)
+                    if warp_knots is None
+                    else TransformTimeWarp(*warp_knots, "time", **cols_params)
+                ),
+            ],
+        )
+
+    pipeline.add(
+        "aligned",
+        ["merge", "alignment"],
+        transform_optitrack,
+        params={"rb_centroid": rb_centroid},
     )
 
     # -------------------------------------------------------------------------
@@ -394,10 +1360,33 @@ def get_processed_data(
     # that there are several TransformRotateCenter transformations whose results
     # depend on the data.
 
-    if bad_frames:
-        coord_cols = [col for col in df.columns if col not in ("time", "frame")]
+    def remove_bad_frames(
+        df: pd.DataFrame,
+    ) -> tuple[pd.DataFrame, Optional[np.ndarray]]:
+        if not bad_frames:
+            return df, None
+
+        # With resampling, the rows are the times of the grid, not the frames
+        frames = df["frame"] if resample_rate else df.index.to_series()
+        nan_rows = np.zeros(len(df), dtype=bool)
         for start, end in bad_frames:
-            df.loc[start:end, coord_cols] = np.nan
+            nan_rows |= frames.between(start, end).to_numpy()
+
+        df = df.copy()
+        coord_cols = [col for col in df.columns if col not in ("time", "frame")]
+        df.loc[nan_rows, coord_cols] = np.nan
+
+        return df, nan_rows
+
+    pipeline.add(
+        "bad_frames",
+        ["aligned"],
+        remove_bad_frames,
+        params={
+            "bad_frames": [list(frames) for frames in bad_frames or []],
+            "resampled": bool(resample_rate),
+        },
+    )
 
     # -------------------------------------------------------------------------
     # Calculate and apply calibration to the optitrack data
@@ -423,16 +1412,29 @@ def get_processed_data(
     # The calibration parameters are the elements of the matrices A, B, and C.
     # -------------------------------------------------------------------------
 
-    calibration_params: Optional[np.ndarray] = None
+    def get_calibration(masked=None) -> Optional[np.ndarray]:
+        if not calibrate:
+            return None
+
+        if not need_calibration:
+            calibration_params = np.load(cast(str, calibration_params_filename))
+            logger.info(
+                "Calibration parameters loaded from file: %s", calibration_params
+            )
+            return calibration_params
+
+        df, _ = masked
+        if dwell_calibration:
+            logger.info("Calibrating gantry data with the dwell points...")
+            dwell_points = get_dwell_points(df, detect_dwells(df))
+            logger.info("Detected %d dwells", len(dwell_points))
+
+            calibration_params = calibrate_dwell_points(dwell_points)
+            logger.info("Calibration completed. Parameters: %s", calibration_params)
+            return calibration_params
+
+        import scipy as scp
 
-    if (
-        calibrate
-        and calibration_params_filename
-        and os.path.exists(calibration_params_filename)
-    ):
-        calibration_params = np.load(calibration_params_filename)
-        logger.info("Calibration parameters loaded from file: %s", calibration_params)
-    elif calibrate:
         # Function to transform the data based on an array of parameters
         def coord_transform_array(x, df: pd.DataFrame) -> pd.DataFrame:
             matrix1, matrix2, array = get_calibration_matrices(x)
@@ -450,61 +1452,174 @@ def get_processed_data(
         x0[[0, 4, 8]] = 1
 
         logger.info("Calibrating gantry data...")
-        res = scp.optimize.minimize(
-            fun=lambda x: coord_mse(
-                df_optitrack_tr, coord_transform_array(x, df_gantry_tr)
-            ),
-            x0=x0,
-            tol=1e-9,
-            options={"disp": True},
-            callback=lambda intermediate_result: logger.info(
-                "fval: %s",
-                getattr(intermediate_result, "fun", intermediate_result),
-            ),
-            method="Powell",
-        )
+        trace = OptimizerTrace("calibration", "Powell", {"tol": 1e-9})
+        traces.append(trace)
+        with profile_section("optimize_calibration"):
+            res = scp.optimize.minimize(
+                fun=trace.wrap(
+                    lambda x: coord_mse(
+                        df_optitrack_tr, coord_transform_array(x, df_gantry_tr)
+                    )
+                ),
+                x0=x0,
+                tol=1e-9,
+                options={"disp": True},
+                callback=trace.callback,
+                method="Powell",
+            )
 
         calibration_params = cast(np.ndarray, res.x)
         logger.info("Calibration completed. Parameters: %s", calibration_params)
 
-        # save the calibration parameters
-        if calibration_params_filename:
-            np.save(calibration_params_filename, calibration_params)
+        return calibration_params
+
+    pipeline.add(
+        "calibration",
+        ["bad_frames"] if need_calibration else [],
+        get_calibration,
+        params={
+            "calibrate": calibrate,
+            "file": (
+                get_cache_key([cast(str, calibration_params_filename)])
+                if calibrate and not need_calibration
+                else None
+            ),
+            "dwell_calibration": dwell_calibration,
+        },
+        hash_output=True,
+    )
 
-    if calibration_params is not None:
-        df_calib = df[["GAN.X", "GAN.Y", "GAN.Z"]]
+    def get_calibrated_gantry(
+        frame: Union[pd.DataFrame, LazyFrame], calibration_params: Optional[np.ndarray]
+    ) -> np.ndarray:
+        if calibration_params is None:
+            # Calibrated coordinates with nan values
+            return np.full((len(frame), 3), np.nan)
+
+        df_calib = frame[["GAN.X", "GAN.Y", "GAN.Z"]]
         df_calib.columns = ["x", "y", "z"]
 
         m1, m2, vec = get_calibration_matrices(calibration_params)
-        df_calib = coord_matrix_transform2(df_calib, m1, m2, vec)
+        return coord_matrix_transform2(df_calib, m1, m2, vec).to_numpy()
 
-        # Add calibrated coordinates to the dataframe
-        df["GAN.CALIBRATED.X"] = df_calib["x"]
-        df["GAN.CALIBRATED.Y"] = df_calib["y"]
-        df["GAN.CALIBRATED.Z"] = df_calib["z"]
-    else:
-        # Add calibrated coordinates with nan values
-        df["GAN.CALIBRATED.X"] = np.nan
-        df["GAN.CALIBRATED.Y"] = np.nan
-        df["GAN.CALIBRATED.Z"] = np.nan
+    calibrated_cols = ["GAN.CALIBRATED.X", "GAN.CALIBRATED.Y", "GAN.CALIBRATED.Z"]
 
     # -----------------------------------------------------------------------------
     # Calculate Gantry errors
     # -----------------------------------------------------------------------------
 
-    for coord_sep in [".", ".CALIBRATED."]:
-        df[f"GAN.ERR{coord_sep}X"] = df["RB.X"] - df[f"GAN{coord_sep}X"]
-        df[f"GAN.ERR{coord_sep}Y"] = df["RB.Y"] - df[f"GAN{coord_sep}Y"]
-        df[f"GAN.ERR{coord_sep}Z"] = df["RB.Z"] - df[f"GAN{coord_sep}Z"]
-
-        df[f"GAN.ERR{coord_sep}Abs"] = np.sqrt(
-            df[f"GAN.ERR{coord_sep}X"] ** 2
-            + df[f"GAN.ERR{coord_sep}Y"] ** 2
-            + df[f"GAN.ERR{coord_sep}Z"] ** 2
+    def get_gantry_errors(
+        frame: Union[pd.DataFrame, LazyFrame], coord_sep: str
+    ) -> np.ndarray:
+        err = (
+            frame[["RB.X", "RB.Y", "RB.Z"]].to_numpy()
+            - frame[[f"GAN{coord_sep}{coord}" for coord in "XYZ"]].to_numpy()
         )
+        return np.column_stack([err, np.sqrt((err**2).sum(axis=1))])
+
+    def get_gantry_error_cols(coord_sep: str) -> list[str]:
+        return [f"GAN.ERR{coord_sep}{coord}" for coord in ["X", "Y", "Z", "Abs"]]
+
+    # Without lazy, all the columns are processed in the last stage
+    def add_gantry_errors(
+        masked, calibration_params: Optional[np.ndarray]
+    ) -> pd.DataFrame:
+        df = masked[0].copy()
+
+        # Add calibrated coordinates and errors to the dataframe
+        df[calibrated_cols] = get_calibrated_gantry(df, calibration_params)
+        for coord_sep in [".", ".CALIBRATED."]:
+            df[get_gantry_error_cols(coord_sep)] = get_gantry_errors(df, coord_sep)
+
+        return df
+
+    if not lazy:
+        pipeline.add("errors", ["bad_frames", "calibration"], add_gantry_errors)
+
+    # -------------------------------------------------------------------------
+    # Run the stages
+    # -------------------------------------------------------------------------
+
+    if lazy:
+        targets = ["optitrack", "bad_frames", "alignment"]
+    else:
+        targets = ["errors"]
+
+    outputs = pipeline.run([*targets, "alignment", "calibration"])
+    logger.info("Processing stages:\n%s", pipeline.report())
+
+    # Save the fitted parameters
+    if need_alignment and alignment_params_filename:
+        np.save(alignment_params_filename, outputs["alignment"][0])
+
+    if need_calibration and calibration_params_filename:
+        np.save(calibration_params_filename, outputs["calibration"])
+
+    if optimizer_trace_filename:
+        if traces:
+            save_traces(optimizer_trace_filename, traces)
+        else:
+            logger.info("No fit was run, the optimizer trace is not saved")
+
+    if not lazy:
+        # The loaded marker columns are not needed if the errors are cached
+        df = outputs["errors"]
+        num_markers = sum(re.fullmatch(r"M\.X\d+", col) is not None for col in df)
+        return df, num_markers
 
     # -------------------------------------------------------------------------
     # Return the processed data
     # -------------------------------------------------------------------------
 
+    # The marker columns are aligned by groups of X, Y, Z coordinates together
+    # with the rigid body, which is the center of the rotations, so they are the
+    # same as aligned with all the data. The other columns are not aligned.
+    df_loaded, num_markers = outputs["optitrack"]
+    if isinstance(df_loaded, pd.DataFrame):
+        df_loaded = LazyFrame(df_loaded)
+
+    df, nan_rows = outputs["bad_frames"]
+    alignment = outputs["alignment"]
+    calibration_params = outputs["calibration"]
+
+    result = LazyFrame(df, nan_rows)
+
+    aligned_groups: dict[tuple[str, str], list[str]] = {}
+    for col in df_loaded.columns:
+        if col in core_cols:
+            continue
+
+        if match := re.fullmatch(r"(M|RB)\.([XYZ])(.+)", col):
+            aligned_groups.setdefault((match[1], match[3]), []).append(col)
+        else:
+            result.register(
+                [col], [], lambda frame, col=col: df_loaded[col].to_numpy()
+            )
+
+    def get_aligned(cols: list[str]) -> np.ndarray:
+        df_group = df_loaded.to_frame(["time", "RB.X", "RB.Y", "RB.Z", *cols])
+        return transform_optitrack(df_group, alignment)[cols].to_numpy()
+
+    for cols in aligned_groups.values():
+        result.register(cols, [], lambda frame, cols=cols: get_aligned(cols))
+
+    result.register(
+        calibrated_cols,
+        ["GAN.X", "GAN.Y", "GAN.Z"],
+        lambda frame: get_calibrated_gantry(frame, calibration_params),
+    )
+    for coord_sep in [".", ".CALIBRATED."]:
+        result.register(
+            get_gantry_error_cols(coord_sep),
+            ["RB.X", "RB.Y", "RB.Z", *[f"GAN{coord_sep}{coord}" for coord in "XYZ"]],
+            lambda frame, coord_sep=coord_sep: get_gantry_errors(frame, coord_sep),
+        )
+
+    if not select:
+        return result, num_markers
+
+    df = result.to_frame(columns)
+    if time_window is not None:
+        df = df[result["time"].between(*time_window).to_numpy()]
+
     return df, num_markers
@@ -0,0 +1,390 @@
+import argparse
+import os
+import sys
+from typing import Literal, Optional
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from argutils import parse_limit
+from calibration_model import get_calibration_design_matrix, get_calibration_params
+
+# The machine limits and the move times are shared with the measurement scripts.
+# The other tools import them from this module, which sets up the path.
+MEASUREMENTS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "../measurements/2025-04-23"
+)
+sys.path.append(MEASUREMENTS_DIR)
+
+from measurements_utils import (  # noqa: E402
+    DEFAULT_INI,
+    MachineLimits,
+    load_machine_limits,
+    take_duration,
+)
+
+Criterion = Literal["D", "I"]
+
+
+def get_candidate_grid(
+    x_limit: tuple[float, float],
+    y_limit: tuple[float, float],
+    z_limit: tuple[float, float],
+    num: tuple[int, int, int],
+) -> np.ndarray:
+    """Regular grid of candidate poses in the axis box, with shape (K, 3)."""
+    limits = (x_limit, y_limit, z_limit)
+    axes = [np.linspace(*limit, n) for limit, n in zip(limits, num)]
+    return np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+
+
+def get_normalized_features(
+    pos: npt.ArrayLike, lower: npt.ArrayLike, upper: npt.ArrayLike
+) -> np.ndarray:
+    """Design matrix of the positions scaled to the [-1, 1] box.
+
+    The features of the calibration model span the same space after an affine
+    scaling of each axis, so the D- and I-optimal designs do not change, but
+    the information matrix is much better conditioned.
+    """
+    lower = np.asarray(lower, dtype=np.float64)
+    upper = np.asarray(upper, dtype=np.float64)
+    scale = np.where(upper > lower, (upper - lower) / 2, 1.0)
+    pos = (np.asarray(pos) - (upper + lower) / 2) / scale
+    return get_calibration_design_matrix(pos)
+
+
+def get_criterion(m_inv: np.ndarray, w: np.ndarray, criterion: Criterion) -> float:
+    """Value of the design criterion (lower is better).
+
+    D: logarithm of the determinant of the inverse information matrix.
+    I: average prediction variance over the region with moment matrix w.
+    """
+    if criterion == "D":
+        return -np.linalg.slogdet(np.linalg.inv(m_inv))[1]
+    return float(np.trace(m_inv @ w))
+
+
+def get_add_gain(
+    m_inv: np.ndarray, f: np.ndarray, w: np.ndarray, criterion: Criterion
+) -> np.ndarray:
+    """Decrease of the criterion when adding each row of f to the design."""
+    q = f @ m_inv
+    d = np.einsum("ij,ij->i", q, f)
+
+    if criterion == "D":
+        return np.log1p(d)
+    return np.einsum("ij,ij->i", q @ w, q) / (1 + d)
+
+
+def sherman_morrison(m_inv: np.ndarray, f: np.ndarray, sign: float) -> np.ndarray:
+    """Inverse of (M + sign * f f^T) from the inverse of M."""
+    q = m_inv @ f
+    return m_inv - sign * np.outer(q, q) / (1 + sign * f @ q)
+
+
+def greedy_design(
+    f: np.ndarray,
+    num_poses: int,
+    w: np.ndarray,
+    criterion: Criterion,
+    regularization: float = 1e-6,
+) -> list[int]:
+    """Add one candidate at a time, the one with the largest criterion gain."""
+    m_inv = np.eye(f.shape[1]) / regularization
+    design = []
+
+    for _ in range(num_poses):
+        best = int(np.argmax(get_add_gain(m_inv, f, w, criterion)))
+        design.append(best)
+        m_inv = sherman_morrison(m_inv, f[best], 1.0)
+
+    return design
+
+
+def exchange_design(
+    f: np.ndarray,
+    design: list[int],
+    w: np.ndarray,
+    criterion: Criterion,
+    max_iter: int = 100,
+    tol: float = 1e-9,
+) -> list[int]:
+    """Improve a design with Fedorov exchanges of design points and candidates."""
+    design = design.copy()
+    m_inv = np.linalg.inv(f[design].T @ f[design])
+    value = get_criterion(m_inv, w, criterion)
+
+    for _ in range(max_iter):
+        improved = False
+
+        for i, idx in enumerate(design):
+            f_i = f[idx]
+            if 1 - f_i @ m_inv @ f_i <= tol:
+                # Removing the point makes the information matrix singular
+                continue
+
+            m_inv_rm = sherman_morrison(m_inv, f_i, -1.0)
+            gains = get_add_gain(m_inv_rm, f, w, criterion)
+            best = int(np.argmax(gains))
+            m_inv_new = sherman_morrison(m_inv_rm, f[best], 1.0)
+            new_value = get_criterion(m_inv_new, w, criterion)
+
+            if new_value < value - tol * max(1.0, abs(value)):
+                design[i] = best
+                m_inv = m_inv_new
+                value = new_value
+                improved = True
+
+        if not improved:
+            break
+
+    return design
+
+
+def optimal_design(
+    f: np.ndarray, num_poses: int, criterion: Criterion = "D"
+) -> list[int]:
+    """Exact optimal design of num_poses rows of the candidate features f.
+
+    The candidates can be selected more than once, i.e., replicated poses.
+    """
+    assert num_poses >= f.shape[1], "At least one pose per parameter is needed"
+
+    w = f.T @ f / len(f)
+    design = greedy_design(f, num_poses, w, criterion)
+    return exchange_design(f, design, w, criterion)
+
+
+def get_parameter_std(pos: npt.ArrayLike, noise_std: float) -> np.ndarray:
+    """Standard deviation of the 18 calibration parameters of a least-squares fit.
+
+    Args:
+        pos: Measured gantry positions with shape (N, 3).
+        noise_std: Standard deviation of the measurement noise (mm).
+
+    Returns:
+        np.ndarray: Array of 18 standard deviations, ordered as the calibration
+            parameters of get_calibration_matrices.
+    """
+    x = get_calibration_design_matrix(pos)
+    col_norm = np.linalg.norm(x, axis=0)
+    x_scaled = x / col_norm
+    cov = np.linalg.inv(x_scaled.T @ x_scaled) / np.outer(col_norm, col_norm)
+    std = noise_std * np.sqrt(np.diag(cov))
+    return get_calibration_params(np.tile(std[:, None], (1, 3)))
+
+
+def get_prediction_std(
+    f_design: np.ndarray, f_region: np.ndarray, noise_std: float
+) -> tuple[float, float]:
+    """Mean and maximum standard deviation of the calibrated position."""
+    m_inv = np.linalg.inv(f_design.T @ f_design)
+    var = np.einsum("ij,jk,ik->i", f_region, m_inv, f_region)
+    std = noise_std * np.sqrt(var)
+    return float(std.mean()), float(std.max())
+
+
+def nearest_neighbour_order(pos: np.ndarray, start: npt.ArrayLike) -> np.ndarray:
+    """Order of the poses visiting the nearest unvisited one each time."""
+    order = []
+    unvisited = np.ones(len(pos), dtype=bool)
+    current = np.asarray(start, dtype=np.float64)
+
+    for _ in range(len(pos)):
+        dist = np.where(unvisited, np.linalg.norm(pos - current, axis=1), np.inf)
+        nearest = int(np.argmin(dist))
+        order.append(nearest)
+        unvisited[nearest] = False
+        current = pos[nearest]
+
+    return np.array(order, dtype=int)
+
+
+def get_take_length(
+    pos: np.ndarray,
+    start: npt.ArrayLike,
+    feed_rate: float,
+    machine_limits: MachineLimits,
+    dwell: float,
+) -> float:
+    """Approximate duration of a take visiting the poses in order.
+
+    Each move takes the time of the trapezoidal velocity profile of the linear
+    move with the machine limits, plus the dwell time at each pose.
+    """
+    positions = [tuple(p) for p in np.asarray(pos, dtype=np.float64).tolist()]
+    start = tuple(np.asarray(start, dtype=np.float64).tolist())
+    duration = take_duration(positions, start, feed_rate, machine_limits)
+
+    return float(duration + dwell * len(pos))
+
+
+def design_poses(
+    x_limit: tuple[float, float],
+    y_limit: tuple[float, float],
+    z_limit: tuple[float, float],
+    grid: tuple[int, int, int] = (11, 11, 7),
+    num_poses: Optional[list[int]] = None,
+    criterion: Criterion = "D",
+    noise_std: float = 0.5,
+    start: tuple[float, float, float] = (0, 0, 0),
+    feed_rate: float = 8000,
+    machine_limits: Optional[MachineLimits] = None,
+    dwell: float = 2.0,
+) -> tuple[pd.DataFrame, dict[int, np.ndarray]]:
+    """Optimal designs of calibration poses for several numbers of poses.
+
+    Args:
+        x_limit: Range of the X axis (mm)
+        y_limit: Range of the Y axis (mm)
+        z_limit: Range of the Z axis (mm)
+        grid: Number of candidate poses per axis
+        num_poses: Numbers of poses to design
+        criterion: D-optimal (parameter volume) or I-optimal (average prediction
+            variance in the axis box)
+        noise_std: Standard deviation of the measured position at a pose (mm)
+        start: Position of the gantry at the start of the take (mm)
+        feed_rate: Feed rate of the moves between the poses (mm/min)
+        machine_limits: Axes and trajectory limits of the machine. If None,
+            loaded from the default LinuxCNC INI file
+        dwell: Dwell time at each pose (s)
+
+    Returns:
+        tuple[pd.DataFrame, dict[int, np.ndarray]]: A tuple containing:
+            - Report with the expected variance and take length per design
+            - Poses of each design in visiting order, with shape (N, 3)
+    """
+    if num_poses is None:
+        num_poses = [6, 8, 10, 12, 16, 20, 30, 40]
+    if machine_limits is None:
+        machine_limits = load_machine_limits(DEFAULT_INI)
+
+    limits = np.array([x_limit, y_limit, z_limit], dtype=np.float64)
+    candidates = get_candidate_grid(x_limit, y_limit, z_limit, grid)
+    f = get_normalized_features(candidates, limits[:, 0], limits[:, 1])
+
+    report = []
+    designs = {}
+
+    for n in num_poses:
+        design = optimal_design(f, n, criterion)
+        pos = candidates[design]
+        pos = pos[nearest_neighbour_order(pos, start)]
+        designs[n] = pos
+
+        param_std = get_parameter_std(pos, noise_std)
+        mean_std, max_std = get_prediction_std(f[design], f, noise_std)
+
+        report.append(
+            {
+                "poses": n,
+                "unique poses": len(np.unique(pos, axis=0)),
+                "mean pred. std (mm)": mean_std,
+                "max pred. std (mm)": max_std,
+                "max A std": param_std[:9].max(),
+                "max B std": param_std[9:15].max(),
+                "max C std (mm)": param_std[15:].max(),
+                "take length (s)": get_take_length(
+                    pos, start, feed_rate, machine_limits, dwell
+                ),
+            }
+        )
+
+    return pd.DataFrame(report), designs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Design a minimal set of calibration poses (D/I-optimal design)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--xlim", type=parse_limit, default=(300, 5000), help="X axis range (mm)"
+    )
+    parser.add_argument(
+        "--ylim", type=parse_limit, default=(300, 4900), help="Y axis range (mm)"
+    )
+    parser.add_argument(
+        "--zlim", type=parse_limit, default=(-1000, -400), help="Z axis range (mm)"
+    )
+
+    parser.add_argument(
+        "--grid",
+        type=int,
+        nargs=3,
+        default=[11, 11, 7],
+        help="Number of candidate poses along each axis",
+    )
+
+    parser.add_argument(
+        "--criterion",
+        choices=["D", "I"],
+        default="D",
+        help="D-optimal (parameter variance) or I-optimal (prediction variance)",
+    )
+
+    parser.add_argument(
+        "--num-poses",
+        type=int,
+        nargs="+",
+        default=[6, 8, 10, 12, 16, 20, 30, 40],
+        help="Numbers of poses of the designs to compare",
+    )
+
+    parser.add_argument(
+        "--noise-std",
+        type=float,
+        default=0.5,
+        help="Standard deviation of the measured position at each pose (mm)",
+    )
+
+    parser.add_argument(
+        "--feed-rate",
+        type=float,
+        default=8000,
+        help="Feed rate of the moves between the poses (mm/min)",
+    )
+
+    parser.add_argument(
+        "--ini",
+        type=str,
+        default=DEFAULT_INI,
+        help="LinuxCNC INI file with the axes limits",
+    )
+
+    parser.add_argument(
+        "--dwell", type=float, default=2.0, help="Dwell time at each pose (s)"
+    )
+
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Path to save the waypoints CSV of the largest design, e.g., for "
+        "run_measurement.py --waypoints. Replicated poses are repeated rows",
+    )
+
+    args = parser.parse_args()
+
+    report, designs = design_poses(
+        args.xlim,
+        args.ylim,
+        args.zlim,
+        grid=tuple(args.grid),
+        num_poses=args.num_poses,
+        criterion=args.criterion,
+        noise_std=args.noise_std,
+        feed_rate=args.feed_rate,
+        machine_limits=load_machine_limits(args.ini),
+        dwell=args.dwell,
+    )
+
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(report.to_string(index=False, float_format="{:.4g}".format))
+
+    if args.output:
+        pos = designs[max(designs)]
+        pd.DataFrame(pos, columns=["x", "y", "z"]).to_csv(args.output, index=False)
@@ -0,0 +1,117 @@
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass
+from typing import Optional, Union, overload
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class DerivedColumns:
+    """Group of derived columns computed together by a single function.
+
+    Attributes:
+        columns: Names of the columns of the group
+        dependencies: Columns of the frame read by compute, they are computed
+            before the group if they are derived too
+        compute: Function of the frame returning the values of the columns, as
+            an array with shape (N, len(columns)) or a dataframe
+    """
+
+    columns: list[str]
+    dependencies: list[str]
+    compute: Callable[["LazyFrame"], Union[np.ndarray, pd.DataFrame]]
+
+
+class LazyFrame:
+    """Dataframe whose derived columns are computed on first access.
+
+    The derived columns are declared with register and computed, with their
+    dependencies, the first time they are read. Then they are kept in the
+    dataframe, so the data is only paid for the columns that are used. The
+    columns are read with the dataframe indexing syntax, frame[col] or
+    frame[cols].
+
+    Args:
+        df: Dataframe with the columns already computed
+        nan_rows: Optional boolean mask of the rows set to NaN in the derived
+            columns when they are computed, e.g., the bad frames
+    """
+
+    def __init__(self, df: pd.DataFrame, nan_rows: Optional[np.ndarray] = None):
+        self.df = df
+        self.nan_rows = nan_rows
+        self.derived: dict[str, DerivedColumns] = {}
+
+    def register(
+        self,
+        columns: Sequence[str],
+        dependencies: Sequence[str],
+        compute: Callable[["LazyFrame"], Union[np.ndarray, pd.DataFrame]],
+    ):
+        """Declare a group of derived columns computed by compute."""
+        group = DerivedColumns(list(columns), list(dependencies), compute)
+        for col in group.columns:
+            self.derived[col] = group
+
+    @property
+    def columns(self) -> pd.Index:
+        """Computed columns followed by the derived columns not computed yet."""
+        pending = [col for col in self.derived if col not in self.df.columns]
+        return self.df.columns.append(pd.Index(pending))
+
+    @property
+    def index(self) -> pd.Index:
+        return self.df.index
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def __contains__(self, col: str) -> bool:
+        return col in self.df.columns or col in self.derived
+
+    def materialize(self, columns: Sequence[str]):
+        """Compute the given columns, if they are not computed yet."""
+        for col in columns:
+            if col in self.df.columns:
+                continue
+
+            if col not in self.derived:
+                raise KeyError(col)
+
+            group = self.derived[col]
+            self.materialize(group.dependencies)
+
+            values = group.compute(self)
+            if isinstance(values, pd.DataFrame):
+                values = values.to_numpy(dtype=np.float64)
+
+            values = np.array(values, dtype=np.float64).reshape(
+                len(self.df), len(group.columns)
+            )
+            if self.nan_rows is not None:
+                values[self.nan_rows] = np.nan
+
+            df_group = pd.DataFrame(values, columns=group.columns, index=self.df.index)
+            self.df = pd.concat([self.df, df_group], axis=1)
+
+            for group_col in group.columns:
+                del self.derived[group_col]
+
+    @overload
+    def __getitem__(self, key: str) -> pd.Series: ...
+
+    @overload
+    def __getitem__(self, key: list[str]) -> pd.DataFrame: ...
+
+    def __getitem__(self, key):
+        self.materialize([key] if isinstance(key, str) else key)
+        return self.df[key]
+
+    def to_frame(self, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """Dataframe with the given columns, or all the columns if None."""
+        if columns is None:
+            columns = list(self.columns)
+
+        self.materialize(columns)
+        return self.df[list(columns)]
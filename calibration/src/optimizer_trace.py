@@ -0,0 +1,215 @@
+import argparse
+import json
+import logging
+import time
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class OptimizerTrace:
+    """Record of the objective evaluations of an optimization.
+
+    The objective is wrapped with wrap, so each evaluation is recorded with its
+    parameters, value and elapsed time since the first evaluation, and the
+    callback marks the evaluations where the optimizer finished an iteration.
+
+    Attributes:
+        name: Name of the optimization, e.g., alignment
+        method: Optimization method
+        options: Options of the optimizer, e.g., tol, JSON serializable
+        params: Parameters of each evaluation
+        values: Objective value of each evaluation
+        times: Elapsed time of each evaluation since the first one (s)
+        iterations: Number of evaluations at the end of each iteration
+    """
+
+    name: str
+    method: str = ""
+    options: dict[str, Any] = field(default_factory=dict)
+    params: list[np.ndarray] = field(default_factory=list)
+    values: list[float] = field(default_factory=list)
+    times: list[float] = field(default_factory=list)
+    iterations: list[int] = field(default_factory=list)
+    start: Optional[float] = field(default=None, repr=False)
+
+    def wrap(
+        self, fun: Callable[[np.ndarray], float]
+    ) -> Callable[[np.ndarray], float]:
+        """Objective function recording its evaluations in the trace."""
+
+        def traced_fun(x: np.ndarray) -> float:
+            if self.start is None:
+                self.start = time.perf_counter()
+
+            value = fun(x)
+
+            self.params.append(np.array(x, dtype=np.float64))
+            self.values.append(float(value))
+            self.times.append(time.perf_counter() - self.start)
+
+            return value
+
+        return traced_fun
+
+    def callback(self, intermediate_result: Any):
+        """Iteration callback of scipy.optimize.minimize."""
+        self.iterations.append(len(self.values))
+        logger.info(
+            "%s iteration %d: fval %s (%d evaluations, %.1f s)",
+            self.name,
+            len(self.iterations),
+            getattr(intermediate_result, "fun", intermediate_result),
+            len(self.values),
+            self.times[-1] if self.times else 0.0,
+        )
+
+
+def save_traces(filename: str, traces: Sequence[OptimizerTrace]):
+    """Save optimizer traces to a .npz file.
+
+    The evaluations of each trace are stored as float64 arrays, the parameters
+    with shape (N, P), and the name, method and options as JSON.
+    """
+    arrays: dict[str, npt.NDArray] = {}
+    for trace in traces:
+        num_params = len(trace.params[0]) if trace.params else 0
+        arrays[f"{trace.name}.meta"] = np.array(
+            json.dumps({"method": trace.method, "options": trace.options})
+        )
+        arrays[f"{trace.name}.params"] = np.array(trace.params).reshape(
+            -1, num_params
+        )
+        arrays[f"{trace.name}.values"] = np.array(trace.values)
+        arrays[f"{trace.name}.times"] = np.array(trace.times)
+        arrays[f"{trace.name}.iterations"] = np.array(trace.iterations, dtype=int)
+
+    # Through a file object so no .npz extension is appended to the filename
+    with open(filename, "wb") as f:
+        np.savez_compressed(f, **arrays)
+
+
+def load_traces(filename: str) -> list[OptimizerTrace]:
+    """Load optimizer traces saved with save_traces."""
+    traces = []
+    with np.load(filename) as data:
+        names = [f[: -len(".meta")] for f in data.files if f.endswith(".meta")]
+        for name in names:
+            meta = json.loads(str(data[f"{name}.meta"]))
+            traces.append(
+                OptimizerTrace(
+                    name,
+                    meta["method"],
+                    meta["options"],
+                    list(data[f"{name}.params"]),
+                    data[f"{name}.values"].tolist(),
+                    data[f"{name}.times"].tolist(),
+                    data[f"{name}.iterations"].tolist(),
+                )
+            )
+
+    return traces
+
+
+def get_evaluations_to_converge(
+    values: npt.ArrayLike, rel_tols: Sequence[float]
+) -> list[int]:
+    """Number of evaluations to reach the best value within relative tolerances.
+
+    Args:
+        values: Objective value of each evaluation
+        rel_tols: Relative tolerances of the gap to the best value
+
+    Returns:
+        list[int]: Number of evaluations for each tolerance, until the best value
+            so far is within the tolerance of the best value of the trace
+    """
+    values = np.asarray(values, dtype=np.float64)
+    best_so_far = np.fmin.accumulate(values)
+    best = best_so_far[-1]
+    scale = max(abs(best), np.finfo(np.float64).tiny)
+
+    return [
+        int(np.argmax(best_so_far - best <= rel_tol * scale)) + 1
+        for rel_tol in rel_tols
+    ]
+
+
+def format_summary(trace: OptimizerTrace, rel_tols: Sequence[float]) -> str:
+    """Text summary of the convergence of an optimizer trace."""
+    num_evals = len(trace.values)
+    num_params = len(trace.params[0]) if trace.params else 0
+    options = ", ".join(f"{key}={value}" for key, value in trace.options.items())
+
+    lines = [f"{trace.name} ({trace.method}, {num_params} parameters, {options})"]
+    if num_evals == 0:
+        lines.append("  no evaluations")
+        return "\n".join(lines)
+
+    total_time = trace.times[-1]
+    lines += [
+        f"  evaluations: {num_evals}, iterations: {len(trace.iterations)}, "
+        f"time: {total_time:.2f} s ({1e3 * total_time / num_evals:.2f} ms/evaluation)",
+        f"  best value: {min(trace.values):.9g}, first value: {trace.values[0]:.9g}",
+        "  evaluations to reach the best value within a relative tolerance:",
+    ]
+
+    for rel_tol, evals in zip(
+        rel_tols, get_evaluations_to_converge(trace.values, rel_tols)
+    ):
+        lines.append(
+            f"    {rel_tol:8.0e}: {evals:6d} ({100 * evals / num_evals:5.1f} %, "
+            f"{trace.times[evals - 1]:.2f} s)"
+        )
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Summarize the convergence of optimizer traces",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "traces",
+        type=str,
+        nargs="+",
+        help="Paths to the optimizer trace files (.npz)",
+    )
+
+    parser.add_argument(
+        "--rel-tols",
+        type=float,
+        nargs="+",
+        default=[1e-2, 1e-3, 1e-4, 1e-6, 1e-9],
+        help="Relative tolerances of the gap to the best value",
+    )
+
+    parser.add_argument(
+        "--iterations",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Print the value at the end of each iteration",
+    )
+
+    args = parser.parse_args()
+
+    for filename in args.traces:
+        print(f"== {filename}")
+        for trace in load_traces(filename):
+            print(format_summary(trace, args.rel_tols))
+
+            if args.iterations:
+                best_so_far = np.fmin.accumulate(trace.values)
+                for i, evals in enumerate(trace.iterations, start=1):
+                    print(
+                        f"    iteration {i:3d}: {best_so_far[evals - 1]:.9g} "
+                        f"({evals} evaluations, {trace.times[evals - 1]:.2f} s)"
+                    )
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+from collections.abc import Callable, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import numpy as np
+
+from profiling import copy_context, profile_section
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Stage:
+    """Step of a pipeline, computed from the outputs of other stages.
+
+    Attributes:
+        name: Name of the stage
+        dependencies: Names of the stages whose outputs are the arguments of func
+        func: Function of the outputs of the dependencies returning the output
+        params: Other inputs of func, JSON serializable, e.g., the options and
+            the keys of the files read by the stage. They are part of the
+            fingerprint of the stage.
+        cache: Whether the output is saved to the cache directory. It must be
+            picklable.
+        hash_output: Whether the stages depending on this one are fingerprinted
+            with the content of the output, instead of the inputs of the stage.
+            For small outputs, e.g., parameters loaded from a file, so the
+            dependent stages are not run again if the output does not change.
+    """
+
+    name: str
+    dependencies: list[str]
+    func: Callable[..., Any]
+    params: dict[str, Any] = field(default_factory=dict)
+    cache: bool = True
+    hash_output: bool = False
+
+
+@dataclass
+class StageTiming:
+    """Execution record of a stage."""
+
+    name: str
+    cached: bool
+    seconds: float
+
+
+def _hash_items(*items: Any) -> str:
+    def default(obj: Any) -> Any:
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError(f"{type(obj).__name__} is not a valid stage parameter")
+
+    text = json.dumps(items, sort_keys=True, default=default)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class Pipeline:
+    """Directed acyclic graph of stages with cached outputs.
+
+    The fingerprint of a stage is a hash of its name, its params and the
+    fingerprints of its dependencies. With a cache directory, the output of
+    each stage is saved as <name>-<fingerprint>.pkl, so a stage is only run
+    again when one of its inputs changes, and the outputs of the stages before
+    it are not loaded if they are not needed. Independent stages run
+    concurrently in a thread pool.
+
+    Args:
+        cache_dir: Optional directory of the cached outputs
+        max_workers: Maximum number of stages running at the same time
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_workers: int = 4):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.stages: dict[str, Stage] = {}
+        self.outputs: dict[str, Any] = {}
+        self.keys: dict[str, str] = {}
+        self.fingerprints: dict[str, str] = {}
+        self.timings: list[StageTiming] = []
+
+    def add(
+        self,
+        name: str,
+        dependencies: Sequence[str],
+        func: Callable[..., Any],
+        **kwargs,
+    ):
+        """Add a stage, see Stage for the arguments."""
+        assert name not in self.stages, f"Stage {name} already exists"
+        for dep in dependencies:
+            assert dep in self.stages, f"Unknown dependency {dep} of stage {name}"
+
+        self.stages[name] = Stage(name, list(dependencies), func, **kwargs)
+
+    def _get_cache_filename(self, name: str) -> Optional[str]:
+        if self.cache_dir is None or not self.stages[name].cache:
+            return None
+        return os.path.join(self.cache_dir, f"{name}-{self.keys[name]}.pkl")
+
+    def _is_cached(self, name: str) -> bool:
+        filename = self._get_cache_filename(name)
+        return filename is not None and os.path.exists(filename)
+
+    def _get_key(self, name: str) -> str:
+        """Fingerprint of the inputs of a stage, the key of its cached output."""
+        if name not in self.keys:
+            stage = self.stages[name]
+            self.keys[name] = _hash_items(
+                name,
+                stage.params,
+                [self._get_fingerprint(dep) for dep in stage.dependencies],
+            )
+
+        return self.keys[name]
+
+    def _get_fingerprint(self, name: str) -> str:
+        """Fingerprint of the output of a stage, for the stages depending on it."""
+        if name not in self.fingerprints:
+            key = self._get_key(name)
+            if self.stages[name].hash_output:
+                self._execute([name])
+                output = pickle.dumps(self.outputs[name])
+                key = _hash_items(name, hashlib.sha1(output).hexdigest())
+
+            self.fingerprints[name] = key
+
+        return self.fingerprints[name]
+
+    def _run_stage(self, name: str) -> StageTiming:
+        stage = self.stages[name]
+        start = time.perf_counter()
+        filename = self._get_cache_filename(name)
+
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename, "rb") as f:
+                    self.outputs[name] = pickle.load(f)
+                return StageTiming(name, True, time.perf_counter() - start)
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                logger.warning("Cannot load the cached stage %s: %s", filename, e)
+                self._execute(stage.dependencies)
+                start = time.perf_counter()
+
+        output = stage.func(*[self.outputs[dep] for dep in stage.dependencies])
+
+        if filename is not None:
+            try:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                # Written to a temporary file, so an interrupted run does not
+                # leave a truncated cache file
+                with open(f"{filename}.tmp", "wb") as f:
+                    pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(f"{filename}.tmp", filename)
+            except OSError as e:
+                logger.warning("Cannot save the cached stage %s: %s", filename, e)
+
+        self.outputs[name] = output
+        return StageTiming(name, False, time.perf_counter() - start)
+
+    def _profile_stage(self, name: str) -> StageTiming:
+        with profile_section(name):
+            return self._run_stage(name)
+
+    def _execute(self, targets: Sequence[str]):
+        """Get the outputs of the targets, running the stages concurrently."""
+        for name in targets:
+            self._get_key(name)
+
+        # The dependencies of the cached stages are not needed
+        needed: set[str] = set()
+        pending_names = list(targets)
+        while pending_names:
+            name = pending_names.pop()
+            if name in needed or name in self.outputs:
+                continue
+
+            needed.add(name)
+            if not self._is_cached(name):
+                pending_names.extend(self.stages[name].dependencies)
+
+        def is_ready(name: str) -> bool:
+            return self._is_cached(name) or all(
+                dep in self.outputs for dep in self.stages[name].dependencies
+            )
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running: dict[Future, str] = {}
+
+            while needed or running:
+                for name in [name for name in self.stages if name in needed]:
+                    if is_ready(name):
+                        needed.remove(name)
+                        future = executor.submit(
+                            copy_context().run, self._profile_stage, name
+                        )
+                        running[future] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    self.timings.append(future.result())
+
+    def run(self, targets: Sequence[str]) -> dict[str, Any]:
+        """Get the outputs of the target stages.
+
+        Only the stages needed for the targets are run. A stage is loaded from
+        the cache if its fingerprint did not change, and then its dependencies
+        are not needed, unless their outputs are needed by other stages.
+
+        Returns:
+            dict[str, Any]: Outputs of the targets, by name
+        """
+        self._execute(targets)
+        return {name: self.outputs[name] for name in targets}
+
+    def report(self) -> str:
+        """Table with the time of each stage, and whether it was cached."""
+        width = max([len("Stage")] + [len(t.name) for t in self.timings])
+        lines = [f"{'Stage':<{width}}  {'Status':<6}  {'Time (s)':>8}"]
+        for t in self.timings:
+            status = "cached" if t.cached else "run"
+            lines.append(f"{t.name:<{width}}  {status:<6}  {t.seconds:>8.3f}")
+
+        total = sum(t.seconds for t in self.timings)
+        lines.append(f"{'Sum':<{width}}  {'':<6}  {total:>8.3f}")
+
+        return "\n".join(lines)
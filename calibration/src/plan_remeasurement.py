@@ -0,0 +1,385 @@
+import argparse
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from argutils import (
+    add_processed_take_argument,
+    add_profile_arguments,
+    add_resample_arguments,
+    add_take_server_argument,
+    parse_limit,
+)
+from data import load_bad_frames
+from design_poses import (
+    DEFAULT_INI,
+    MachineLimits,
+    get_add_gain,
+    get_normalized_features,
+    get_take_length,
+    load_machine_limits,
+    nearest_neighbour_order,
+)
+from profiling import profile_section, profiling
+from take_server import load_processed_data
+
+
+def get_residual_cells(
+    df: pd.DataFrame,
+    limits: np.ndarray,
+    grid: tuple[int, int, int],
+    sep: str = ".CALIBRATED.",
+) -> pd.DataFrame:
+    """Statistics of the residuals binned in a regular grid of gantry positions.
+
+    The cells are defined in machine coordinates (GAN.X, GAN.Y, GAN.Z), so
+    their positions can be used as waypoints of a measurement.
+
+    Args:
+        df: DataFrame with the processed data.
+        limits: Array with shape (3, 2) with the range of each axis. The frames
+            out of the range are left out.
+        grid: Number of cells along each axis.
+        sep: Separator of the error columns, ".CALIBRATED." or ".".
+
+    Returns:
+        pd.DataFrame: One row per cell of the grid with the cell indices, the
+            cell center, the mean gantry position and the number of frames in
+            the cell, and the RMS and maximum of the absolute error. Empty cells
+            have no frames and NaN statistics.
+    """
+    pos_cols = ["GAN.X", "GAN.Y", "GAN.Z"]
+    err_col = f"GAN.ERR{sep}Abs"
+
+    data = df[[*pos_cols, err_col]].dropna()
+    pos = data[pos_cols].to_numpy()
+    inside = np.all((pos >= limits[:, 0]) & (pos <= limits[:, 1]), axis=1)
+    data, pos = data[inside], pos[inside]
+    num = np.array(grid)
+
+    size = (limits[:, 1] - limits[:, 0]) / num
+    idx = np.clip(np.floor((pos - limits[:, 0]) / size).astype(int), 0, num - 1)
+    cell = np.ravel_multi_index(tuple(idx.T), grid)
+
+    grouped = data.assign(ERR2=data[err_col] ** 2).groupby(cell)
+    stats = pd.DataFrame(
+        {
+            "X": grouped[pos_cols[0]].mean(),
+            "Y": grouped[pos_cols[1]].mean(),
+            "Z": grouped[pos_cols[2]].mean(),
+            "frames": grouped.size(),
+            "rms error": np.sqrt(grouped["ERR2"].mean()),
+            "max error": grouped[err_col].max(),
+        }
+    )
+
+    all_idx = np.stack(np.unravel_index(np.arange(num.prod()), grid), axis=1)
+    center = limits[:, 0] + (all_idx + 0.5) * size
+    cells = pd.DataFrame(
+        {
+            "i": all_idx[:, 0],
+            "j": all_idx[:, 1],
+            "k": all_idx[:, 2],
+            "center X": center[:, 0],
+            "center Y": center[:, 1],
+            "center Z": center[:, 2],
+        }
+    )
+
+    cells = cells.join(stats)
+    cells["frames"] = cells["frames"].fillna(0).astype(int)
+
+    return cells
+
+
+def rank_cells(
+    cells: pd.DataFrame, limits: np.ndarray, error_weight: float = 0.5
+) -> pd.DataFrame:
+    """Rank the cells by residual error and parameter information gain.
+
+    The information gain of a cell is the increase of the log-determinant of
+    the information matrix of the calibration model (D-optimality) when adding
+    a measurement at the cell, where the current information matrix is made of
+    the measured cells weighted by their share of frames. Both scores are
+    normalized to [0, 1] and combined with error_weight.
+
+    Args:
+        cells: Cells, as returned by get_residual_cells.
+        limits: Array with shape (3, 2) with the range of each axis.
+        error_weight: Weight of the error score, the information gain score has
+            weight 1 - error_weight.
+
+    Returns:
+        pd.DataFrame: Cells with the information gain and score columns, sorted
+            by decreasing score.
+    """
+    # Waypoint of each cell: mean measured position, or its center if empty
+    pos = np.where(
+        cells[["X", "Y", "Z"]].notna().to_numpy(),
+        cells[["X", "Y", "Z"]].to_numpy(),
+        cells[["center X", "center Y", "center Z"]].to_numpy(),
+    )
+    f = get_normalized_features(pos, limits[:, 0], limits[:, 1])
+
+    weight = cells["frames"].to_numpy() / max(1, cells["frames"].sum())
+    m = (f * weight[:, None]).T @ f + 1e-9 * np.eye(f.shape[1])
+    gain = get_add_gain(np.linalg.inv(m), f, np.eye(f.shape[1]), "D")
+
+    error = cells["rms error"].fillna(0).to_numpy()
+    error_score = error / error.max() if error.max() > 0 else error
+    gain_score = gain / gain.max()
+
+    ranked = cells.assign(
+        **{
+            "waypoint X": pos[:, 0],
+            "waypoint Y": pos[:, 1],
+            "waypoint Z": pos[:, 2],
+            "info gain": gain,
+            "score": error_weight * error_score + (1 - error_weight) * gain_score,
+        }
+    )
+
+    return ranked.sort_values("score", ascending=False)
+
+
+@profile_section("plan_remeasurement")
+def plan_remeasurement(
+    gantry_file: str = "take_gantry.csv",
+    optitrack_file: str = "take_optitrack.csv",
+    alignment_params_file: str = "alignment_params.npy",
+    calibration_params_file: str = "calibration_params.npy",
+    bad_frames_file: str = "bad_frames.json",
+    remove_bad_frames: bool = True,
+    grid: tuple[int, int, int] = (8, 8, 4),
+    limits: Optional[list[Optional[tuple[float, float]]]] = None,
+    num_cells: int = 12,
+    error_weight: float = 0.5,
+    start: tuple[float, float, float] = (0, 0, 0),
+    feed_rate: float = 8000,
+    machine_limits: Optional[MachineLimits] = None,
+    dwell: float = 2.0,
+    take_server: Optional[str] = None,
+    processed_take: Optional[str] = None,
+    resample_rate: Optional[float] = None,
+    anti_alias: bool = True,
+    resample_cache_file: Optional[str] = None,
+) -> tuple[pd.DataFrame, np.ndarray, float]:
+    """Plan a short take over the cells of the workspace worth re-measuring.
+
+    Args:
+        gantry_file: Path to the gantry data of the previous take
+        optitrack_file: Path to the Optitrack data of the previous take
+        alignment_params_file: Path to the alignment parameters file
+        calibration_params_file: Path to the calibration parameters file
+        bad_frames_file: Path to the bad frames file
+        remove_bad_frames: Whether to remove the bad frames
+        grid: Number of cells along each axis
+        limits: Range (min, max) of each axis. If None, or for the None axes,
+            the range of the gantry positions of the take
+        num_cells: Number of cells of the plan
+        error_weight: Weight of the residual error in the score of the cells,
+            the information gain has weight 1 - error_weight
+        start: Position of the gantry at the start of the take (mm)
+        feed_rate: Feed rate of the moves between the waypoints (mm/min)
+        machine_limits: Axes and trajectory limits of the machine. If None,
+            loaded from the default LinuxCNC INI file
+        dwell: Dwell time at each waypoint (s)
+        take_server: Optional socket of the take server to get the data from
+        processed_take: Optional directory of the processed take
+        resample_rate: Optional rate (Hz) of a uniform time grid to resample the
+            take on, as in run_calibration.py --resample-rate
+        anti_alias: Whether to low-pass filter the streams before resampling
+        resample_cache_file: Optional path of a .npz file to cache the
+            resampled data
+
+    Returns:
+        tuple[pd.DataFrame, np.ndarray, float]: A tuple containing:
+            - Ranked cells
+            - Waypoints of the selected cells in visiting order, shape (N, 3)
+            - Approximate take length (s)
+    """
+    bad_frames = None
+    if remove_bad_frames:
+        bad_frames = load_bad_frames(bad_frames_file)
+
+    df, _ = load_processed_data(
+        take_server,
+        gantry_file,
+        optitrack_file,
+        alignment_params_file,
+        calibration_params_file,
+        bad_frames=bad_frames,
+        calibrate=True,
+        processed_take=processed_take,
+        resample_rate=resample_rate,
+        anti_alias=anti_alias,
+        resample_cache_filename=resample_cache_file,
+    )
+
+    pos = df[["GAN.X", "GAN.Y", "GAN.Z"]]
+    axis_limits = np.column_stack([pos.min().to_numpy(), pos.max().to_numpy()])
+    for i, limit in enumerate(limits or []):
+        if limit is not None:
+            axis_limits[i] = limit
+
+    cells = get_residual_cells(df, axis_limits, grid)
+    ranked = rank_cells(cells, axis_limits, error_weight)
+
+    waypoints = ranked[["waypoint X", "waypoint Y", "waypoint Z"]].to_numpy()
+    waypoints = waypoints[:num_cells]
+    waypoints = waypoints[nearest_neighbour_order(waypoints, start)]
+    if machine_limits is None:
+        machine_limits = load_machine_limits(DEFAULT_INI)
+    take_length = get_take_length(waypoints, start, feed_rate, machine_limits, dwell)
+
+    return ranked, waypoints, take_length
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Plan a targeted take over the high-residual regions",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--optitrack",
+        type=str,
+        default="take_optitrack.csv",
+        help="Path to Optitrack CSV file",
+    )
+
+    parser.add_argument(
+        "--gantry",
+        type=str,
+        default="take_gantry.csv",
+        help="Path to Gantry CSV file",
+    )
+
+    parser.add_argument(
+        "--alignment",
+        type=str,
+        default="alignment_params.npy",
+        help="Path to alignment parameters file",
+    )
+
+    parser.add_argument(
+        "--calibration",
+        type=str,
+        default="calibration_params.npy",
+        help="Path to calibration parameters file",
+    )
+
+    parser.add_argument(
+        "--remove-bad-frames",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Remove bad frames from the data",
+    )
+
+    parser.add_argument(
+        "--bad-frames",
+        type=str,
+        default="bad_frames.json",
+        help="Path to bad frames data file",
+    )
+
+    parser.add_argument(
+        "--grid",
+        type=int,
+        nargs=3,
+        default=[8, 8, 4],
+        help="Number of cells along each axis",
+    )
+
+    parser.add_argument(
+        "--xlim",
+        type=parse_limit,
+        help="X axis range as 'min,max'. If not given, the range of the take",
+    )
+    parser.add_argument(
+        "--ylim",
+        type=parse_limit,
+        help="Y axis range as 'min,max'. If not given, the range of the take",
+    )
+    parser.add_argument(
+        "--zlim",
+        type=parse_limit,
+        help="Z axis range as 'min,max'. If not given, the range of the take",
+    )
+
+    parser.add_argument(
+        "--num-cells",
+        type=int,
+        default=12,
+        help="Number of cells to re-measure",
+    )
+
+    parser.add_argument(
+        "--error-weight",
+        type=float,
+        default=0.5,
+        help="Weight of the residual error against the information gain (0-1)",
+    )
+
+    parser.add_argument(
+        "--dwell", type=float, default=2.0, help="Dwell time at each waypoint (s)"
+    )
+
+    parser.add_argument(
+        "--feed-rate",
+        type=float,
+        default=8000,
+        help="Feed rate of the moves between the waypoints (mm/min)",
+    )
+
+    parser.add_argument(
+        "--ini",
+        type=str,
+        default=DEFAULT_INI,
+        help="LinuxCNC INI file with the axes limits",
+    )
+
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Path to save the waypoints CSV for run_measurement.py --waypoints",
+    )
+
+    add_take_server_argument(parser)
+    add_processed_take_argument(parser)
+    add_resample_arguments(parser)
+    add_profile_arguments(parser)
+
+    args = parser.parse_args()
+
+    with profiling(args.profile, args.profile_memory):
+        ranked, waypoints, take_length = plan_remeasurement(
+            gantry_file=args.gantry,
+            optitrack_file=args.optitrack,
+            alignment_params_file=args.alignment,
+            calibration_params_file=args.calibration,
+            bad_frames_file=args.bad_frames,
+            remove_bad_frames=args.remove_bad_frames,
+            grid=tuple(args.grid),
+            limits=[args.xlim, args.ylim, args.zlim],
+            num_cells=args.num_cells,
+            error_weight=args.error_weight,
+            feed_rate=args.feed_rate,
+            machine_limits=load_machine_limits(args.ini),
+            dwell=args.dwell,
+            take_server=args.take_server,
+            processed_take=args.processed_take,
+            resample_rate=args.resample_rate,
+            anti_alias=args.anti_alias,
+            resample_cache_file=args.resample_cache,
+        )
+
+    cols = ["i", "j", "k", "frames", "rms error", "max error", "info gain", "score"]
+    print(ranked[cols].head(args.num_cells).to_string(float_format="{:.4g}".format))
+    print(f"\n{len(waypoints)} waypoints, approximate take length: {take_length:.0f} s")
+
+    if args.output:
+        df_waypoints = pd.DataFrame(waypoints, columns=["x", "y", "z"])
+        df_waypoints.to_csv(args.output, index=False)
@@ -5,7 +5,7 @@ import numpy as np
 import numpy.typing as npt
 from matplotlib.widgets import Button, Slider
 
-from data import get_calibration_matrices
+from calibration_model import get_calibration_matrices
 
 
 def coord_transform(
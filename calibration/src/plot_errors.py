@@ -6,10 +6,19 @@ import logging
 
 import matplotlib.pyplot as plt
 
-from argutils import parse_limit
-from data import get_processed_data, load_bad_frames
-
-
+from argutils import (
+    add_processed_take_argument,
+    add_profile_arguments,
+    add_resample_arguments,
+    add_take_server_argument,
+    parse_limit,
+)
+from data import load_bad_frames
+from profiling import profile_section, profiling
+from take_server import load_processed_data
+
+
+@profile_section("plot_errors")
 def plot_errors(
     gantry_file: str = "take_gantry.csv",
     optitrack_file: str = "take_optitrack.csv",
@@ -22,6 +31,11 @@ def plot_errors(
     position_limit: Optional[tuple[float, float]] = None,
     error_limit: Optional[tuple[float, float]] = None,
     abs_error_limit: Optional[tuple[float, float]] = None,
+    take_server: Optional[str] = None,
+    processed_take: Optional[str] = None,
+    resample_rate: Optional[float] = None,
+    anti_alias: bool = True,
+    resample_cache_file: Optional[str] = None,
 ) -> tuple[plt.Axes, plt.Axes, plt.Axes, plt.Axes, plt.Axes]:
     """Plot gantry and optitrack position and error data.
 
@@ -32,23 +46,43 @@ def plot_errors(
         calibration_file: Path to calibration parameters file
         remove_bad_frames: Whether to remove bad frames from the data
         bad_frames_file: Path to file with bad frames ranges
-        time_limit: Optional (min, max) tuple for x-axis time limits (seconds)
+        time_limit: Optional (min, max) tuple for x-axis time limits (seconds),
+            only this time window of the take is loaded
         position_limit: Optional (min, max) tuple for position plot y-axis limits (mm)
         error_limit: Optional (min, max) tuple for error plots y-axis limits (mm)
+        take_server: Optional socket of the take server to get the data from
+        processed_take: Optional directory of the processed take
+        resample_rate: Optional rate (Hz) of a uniform time grid to resample the
+            take on, as in run_calibration.py --resample-rate
+        anti_alias: Whether to low-pass filter the streams before resampling
+        resample_cache_file: Optional path of a .npz file to cache the
+            resampled data
     """
     # Handle bad frames if needed
     bad_frames = None
     if remove_bad_frames:
         bad_frames = load_bad_frames(bad_frames_file)
 
-    # Get the processed data
-    df, _ = get_processed_data(
+    # String separator for the gantry coordinates
+    sep = ".CALIBRATED." if calibrate else "."
+
+    # Get the processed data, only the plotted columns and time window
+    df, _ = load_processed_data(
+        take_server,
         gantry_file,
         optitrack_file,
         alignment_file,
         calibration_file,
         bad_frames=bad_frames,
         calibrate=calibrate,
+        columns=["time"]
+        + [f"GAN{sep}{axis}" for axis in "XYZ"]
+        + [f"GAN.ERR{sep}{name}" for name in ["X", "Y", "Z", "Abs"]],
+        time_window=time_limit,
+        processed_take=processed_take,
+        resample_rate=resample_rate,
+        anti_alias=anti_alias,
+        resample_cache_filename=resample_cache_file,
     )
 
     # Create figure with subplots
@@ -65,9 +99,6 @@ def plot_errors(
     for ax in [ax_pos, ax_x_err, ax_y_err, ax_z_err, ax_abs_err]:
         ax.grid(True)
 
-    # String separator for the gantry coordinates
-    sep = ".CALIBRATED." if calibrate else "."
-
     # Plot all positions in the same subplot
     ax_pos.plot(df["time"], df[f"GAN{sep}X"], "b-", linewidth=0.5, label="Gantry X")
     ax_pos.plot(df["time"], df[f"GAN{sep}Y"], "g-", linewidth=0.5, label="Gantry Y")
@@ -110,7 +141,8 @@ def plot_errors(
         ax_abs_err.set_ylim(*abs_error_limit)
 
     plt.tight_layout()
-    plt.show()
+    with profile_section("show"):
+        plt.show()
 
     return ax_pos, ax_x_err, ax_y_err, ax_z_err, ax_abs_err
 
@@ -200,21 +232,32 @@ def main():
         help="Y-axis limit for absolute error plot as 'min,max' (mm)",
     )
 
+    add_take_server_argument(parser)
+    add_processed_take_argument(parser)
+    add_resample_arguments(parser)
+    add_profile_arguments(parser)
+
     args = parser.parse_args()
 
-    plot_errors(
-        gantry_file=args.gantry,
-        optitrack_file=args.optitrack,
-        alignment_file=args.alignment,
-        calibration_file=args.calibration,
-        calibrate=args.calibrate,
-        remove_bad_frames=args.remove_bad_frames,
-        bad_frames_file=args.bad_frames,
-        time_limit=args.time_limit,
-        position_limit=args.poslim,
-        error_limit=args.errlim,
-        abs_error_limit=args.abserrlim,
-    )
+    with profiling(args.profile, args.profile_memory):
+        plot_errors(
+            gantry_file=args.gantry,
+            optitrack_file=args.optitrack,
+            alignment_file=args.alignment,
+            calibration_file=args.calibration,
+            calibrate=args.calibrate,
+            remove_bad_frames=args.remove_bad_frames,
+            bad_frames_file=args.bad_frames,
+            time_limit=args.time_limit,
+            position_limit=args.poslim,
+            error_limit=args.errlim,
+            abs_error_limit=args.abserrlim,
+            take_server=args.take_server,
+            processed_take=args.processed_take,
+            resample_rate=args.resample_rate,
+            anti_alias=args.anti_alias,
+            resample_cache_file=args.resample_cache,
+        )
 
 
 if __name__ == "__main__":
@@ -1,14 +1,25 @@
 # Plot the errors between the rigid body markers and the raw markers
 import argparse
 import logging
+from typing import Optional
+
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy import stats
 
-from argutils import parse_limit
-from data import get_processed_data, load_bad_frames
+from argutils import (
+    add_processed_take_argument,
+    add_profile_arguments,
+    add_resample_arguments,
+    add_take_server_argument,
+    parse_limit,
+)
+from data import load_bad_frames
+from profiling import profile_section, profiling
+from take_server import load_processed_data
 
 
+@profile_section("plot_errors_probability")
 def plot_errors_probability(
     gantry_file: str = "take_gantry.csv",
     optitrack_file: str = "take_optitrack.csv",
@@ -20,20 +31,31 @@ def plot_errors_probability(
     bins: int = 200,
     xyz_limits: tuple[float, float] = (-15, 15),
     abs_limits: tuple[float, float] = (0, 20),
+    take_server: Optional[str] = None,
+    processed_take: Optional[str] = None,
+    resample_rate: Optional[float] = None,
+    anti_alias: bool = True,
+    resample_cache_file: Optional[str] = None,
 ) -> list[plt.Axes]:
 
     bad_frames = None
     if remove_bad_frames:
         bad_frames = load_bad_frames(bad_frames_file)
 
-    # Get the processed data
-    df, _ = get_processed_data(
+    # Get the processed data, only the error columns are computed
+    df, _ = load_processed_data(
+        take_server,
         gantry_file,
         optitrack_file,
         alignment_params_filename=alignment_params_file,
         calibration_params_filename=calibration_params_file,
         bad_frames=bad_frames,
         calibrate=True,
+        lazy=True,
+        processed_take=processed_take,
+        resample_rate=resample_rate,
+        anti_alias=anti_alias,
+        resample_cache_filename=resample_cache_file,
     )
 
     # Create the subplots
@@ -124,7 +146,8 @@ def plot_errors_probability(
             ax.set_xlim(xyz_limits)
 
     plt.tight_layout()
-    plt.show()
+    with profile_section("show"):
+        plt.show()
 
     return [ax_x_err, ax_y_err, ax_z_err, ax_abs_err]
 
@@ -206,17 +229,28 @@ if __name__ == "__main__":
         help="Absolute error plot limits (min,max) in mm",
     )
 
+    add_take_server_argument(parser)
+    add_processed_take_argument(parser)
+    add_resample_arguments(parser)
+    add_profile_arguments(parser)
+
     args = parser.parse_args()
 
-    plot_errors_probability(
-        gantry_file=args.gantry,
-        optitrack_file=args.optitrack,
-        alignment_params_file=args.alignment,
-        calibration_params_file=args.calibration,
-        bad_frames_file=args.bad_frames,
-        remove_bad_frames=args.remove_bad_frames,
-        cumulative=args.cumulative,
-        bins=args.bins,
-        xyz_limits=args.xyzlim,
-        abs_limits=args.abslim,
-    )
+    with profiling(args.profile, args.profile_memory):
+        plot_errors_probability(
+            gantry_file=args.gantry,
+            optitrack_file=args.optitrack,
+            alignment_params_file=args.alignment,
+            calibration_params_file=args.calibration,
+            bad_frames_file=args.bad_frames,
+            remove_bad_frames=args.remove_bad_frames,
+            cumulative=args.cumulative,
+            bins=args.bins,
+            xyz_limits=args.xyzlim,
+            abs_limits=args.abslim,
+            take_server=args.take_server,
+            processed_take=args.processed_take,
+            resample_rate=args.resample_rate,
+            anti_alias=args.anti_alias,
+            resample_cache_file=args.resample_cache,
+        )
@@ -5,10 +5,19 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
-from argutils import parse_limit
-from data import get_processed_data, load_bad_frames
-
-
+from argutils import (
+    add_processed_take_argument,
+    add_profile_arguments,
+    add_resample_arguments,
+    add_take_server_argument,
+    parse_limit,
+)
+from data import load_bad_frames
+from profiling import profile_section, profiling
+from take_server import load_processed_data
+
+
+@profile_section("plot_errors_scatter")
 def plot_errors_scatter(
     gantry_file: str = "take_gantry.csv",
     optitrack_file: str = "take_optitrack.csv",
@@ -22,6 +31,11 @@ def plot_errors_scatter(
     style: dict[str, Any] = {"alpha": 0.25, "s": 2, "lw": 0},
     fit_style: dict[str, Any] = {"color": "r", "linestyle": "--", "alpha": 0.8},
     save_path: Optional[str] = None,
+    take_server: Optional[str] = None,
+    processed_take: Optional[str] = None,
+    resample_rate: Optional[float] = None,
+    anti_alias: bool = True,
+    resample_cache_file: Optional[str] = None,
 ) -> tuple[pd.DataFrame, list[plt.Axes]]:
     """
     Plot pairwise scatter plots between gantry position and positioning errors.
@@ -29,6 +43,13 @@ def plot_errors_scatter(
     Args:
         df: DataFrame containing gantry and error data
         save_path: Optional path to save the plots
+        take_server: Optional socket of the take server to get the data from
+        processed_take: Optional directory of the processed take
+        resample_rate: Optional rate (Hz) of a uniform time grid to resample the
+            take on, as in run_calibration.py --resample-rate
+        anti_alias: Whether to low-pass filter the streams before resampling
+        resample_cache_file: Optional path of a .npz file to cache the
+            resampled data
     """
     sep = ".CALIBRATED." if calibrate else "."
     errors = [f"GAN.ERR{sep}X", f"GAN.ERR{sep}Y", f"GAN.ERR{sep}Z"]
@@ -39,13 +60,18 @@ def plot_errors_scatter(
     if remove_bad_frames:
         bad_frames = load_bad_frames(bad_frames_file)
 
-    df, _ = get_processed_data(
+    df, _ = load_processed_data(
+        take_server,
         gantry_file,
         optitrack_file,
         alignment_params_file,
         calibration_params_file,
         bad_frames=bad_frames,
         calibrate=calibrate,
+        processed_take=processed_take,
+        resample_rate=resample_rate,
+        anti_alias=anti_alias,
+        resample_cache_filename=resample_cache_file,
     )
 
     plt.figure(constrained_layout=True)
@@ -84,7 +110,8 @@ def plot_errors_scatter(
     # plt.tight_layout(pad=0.1)
     if save_path:
         plt.savefig(save_path)
-    plt.show()
+    with profile_section("show"):
+        plt.show()
 
     return df, axes
 
@@ -157,20 +184,31 @@ if __name__ == "__main__":
         help="Y-axis limit for position plot as 'min,max' (mm)",
     )
 
+    add_take_server_argument(parser)
+    add_processed_take_argument(parser)
+    add_resample_arguments(parser)
+    add_profile_arguments(parser)
+
     args = parser.parse_args()
 
     # Create scatter plots of position errors
-    df, _ = plot_errors_scatter(
-        gantry_file=args.gantry,
-        optitrack_file=args.optitrack,
-        alignment_params_file=args.alignment,
-        calibration_params_file=args.calibration,
-        calibrate=args.calibrate,
-        bad_frames_file=args.bad_frames,
-        remove_bad_frames=args.remove_bad_frames,
-        ylim=args.ylim,
-        plot_fit=args.plot_fit,
-    )
+    with profiling(args.profile, args.profile_memory):
+        df, _ = plot_errors_scatter(
+            gantry_file=args.gantry,
+            optitrack_file=args.optitrack,
+            alignment_params_file=args.alignment,
+            calibration_params_file=args.calibration,
+            calibrate=args.calibrate,
+            bad_frames_file=args.bad_frames,
+            remove_bad_frames=args.remove_bad_frames,
+            ylim=args.ylim,
+            plot_fit=args.plot_fit,
+            take_server=args.take_server,
+            processed_take=args.processed_take,
+            resample_rate=args.resample_rate,
+            anti_alias=args.anti_alias,
+            resample_cache_file=args.resample_cache,
+        )
 
     # Print statistical summary
     print("\nStatistical Summary of Errors:")
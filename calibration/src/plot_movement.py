@@ -3,13 +3,22 @@ from typing import Optional, cast
 
 import matplotlib.pyplot as plt
 import mpl_toolkits.mplot3d.axes3d as axes3d
-import numpy as np
 
-from argutils import parse_limit
-from data import get_processed_data, load_bad_frames
+from argutils import (
+    add_processed_take_argument,
+    add_profile_arguments,
+    add_resample_arguments,
+    add_take_server_argument,
+    parse_limit,
+)
+from data import load_bad_frames
+from profiling import profile_section, profiling
+from take_server import load_processed_data
 from multipoint_player import MultiPointPlayer
+from window_buffer import SlidingWindowBuffer
 
 
+@profile_section("plot_movement")
 def plot_movement(
     gantry_file: str,
     optitrack_file: str,
@@ -25,6 +34,12 @@ def plot_movement(
     xlim: Optional[tuple[float, float]] = None,
     ylim: Optional[tuple[float, float]] = None,
     zlim: Optional[tuple[float, float]] = None,
+    time_limit: Optional[tuple[float, float]] = None,
+    take_server: Optional[str] = None,
+    processed_take: Optional[str] = None,
+    resample_rate: Optional[float] = None,
+    anti_alias: bool = True,
+    resample_cache_file: Optional[str] = None,
 ) -> plt.Axes:
     """Plot gantry and Optitrack movement data in 3D.
 
@@ -43,20 +58,36 @@ def plot_movement(
         xlim: Optional tuple of (min, max) for the x-axis
         ylim: Optional tuple of (min, max) for the y-axis
         zlim: Optional tuple of (min, max) for the z-axis
+        time_limit: Optional (min, max) tuple of the time window of the take to
+            load and play (seconds)
+        take_server: Optional socket of the take server to get the data from
+        processed_take: Optional directory of the processed take
+        resample_rate: Optional rate (Hz) of a uniform time grid to resample the
+            take on, as in run_calibration.py --resample-rate
+        anti_alias: Whether to low-pass filter the streams before resampling
+        resample_cache_file: Optional path of a .npz file to cache the
+            resampled data
     """
     bad_frames = None
     if remove_bad_frames:
         bad_frames = load_bad_frames(bad_frames_file)
 
     # Load and process the data
-    df, num_markers = get_processed_data(
+    df, num_markers = load_processed_data(
+        take_server,
         gantry_file,
         optitrack_file,
         alignment_params_file,
         calibration_params_file,
         bad_frames=bad_frames,
         calibrate=True,
+        time_window=time_limit,
+        processed_take=processed_take,
+        resample_rate=resample_rate,
+        anti_alias=anti_alias,
+        resample_cache_filename=resample_cache_file,
     )
+    df = df.reset_index(drop=True)
 
     # Set the time relative to the start time
     df["time"] = df["time"] - df["time"].iloc[0]
@@ -193,37 +224,42 @@ def plot_movement(
     gan_text = ax.text2D(0.02, 0.06, "", transform=ax.transAxes)
     gan_calib_text = ax.text2D(0.02, 0.03, "", transform=ax.transAxes)
 
+    # Array store with the error and coordinate columns used on each frame
+    err_names = ["X", "Y", "Z", "Abs"]
+    err_cols_aligned = [f"GAN.ERR.{name}" for name in err_names]
+    err_cols_calibrated = [f"GAN.ERR.CALIBRATED.{name}" for name in err_names]
+    rb_cols = ["RB.X", "RB.Y", "RB.Z"]
+    gan_cols = ["GAN.X", "GAN.Y", "GAN.Z"]
+    gan_calib_cols = ["GAN.CALIBRATED.X", "GAN.CALIBRATED.Y", "GAN.CALIBRATED.Z"]
+
+    window = SlidingWindowBuffer(
+        df,
+        err_cols_aligned + err_cols_calibrated + rb_cols + gan_cols + gan_calib_cols,
+        before_samples=error_before_samples,
+        after_samples=error_after_samples,
+    )
+
     def update_cb(frame_data):
         # Update error plots
-        err_n_min = max(0, (frame_data.frame_idx - error_before_samples))
-        err_n_max = min(len(df), (frame_data.frame_idx + error_after_samples))
-        times = df["time"][err_n_min:err_n_max]
+        window.update(frame_data.frame_idx, frame_data.frame_time)
+        times = window.times()
 
         for i, (error_line_aligned, error_line_calibrated) in enumerate(
             zip(error_lines_aligned, error_lines_calibrated)
         ):
-            col_name = f"GAN.ERR.{['X', 'Y', 'Z', 'Abs'][i]}"
-            errors = df[col_name][err_n_min:err_n_max]
-            error_line_aligned.set_data(times - frame_data.frame_time, errors)
-
-            col_name = f"GAN.ERR.CALIBRATED.{['X', 'Y', 'Z', 'Abs'][i]}"
-            errors = df[col_name][err_n_min:err_n_max]
-            error_line_calibrated.set_data(times - frame_data.frame_time, errors)
+            error_line_aligned.set_data(times, window.values(err_cols_aligned[i]))
+            error_line_calibrated.set_data(times, window.values(err_cols_calibrated[i]))
 
         # Update coordinate texts
-        rb_pos = np.array(df.iloc[frame_data.frame_idx][["RB.X", "RB.Y", "RB.Z"]])
+        rb_pos = window.frame_values(rb_cols)
         rb_text.set_text(f"RB: ({rb_pos[0]:.2f}, {rb_pos[1]:.2f}, {rb_pos[2]:.2f})")
 
-        gan_pos = np.array(df.iloc[frame_data.frame_idx][["GAN.X", "GAN.Y", "GAN.Z"]])
+        gan_pos = window.frame_values(gan_cols)
         gan_text.set_text(
             f"Gantry: ({gan_pos[0]:.2f}, {gan_pos[1]:.2f}, {gan_pos[2]:.2f})"
         )
 
-        gan_calib_pos = np.array(
-            df.iloc[frame_data.frame_idx][
-                ["GAN.CALIBRATED.X", "GAN.CALIBRATED.Y", "GAN.CALIBRATED.Z"]
-            ]
-        )
+        gan_calib_pos = window.frame_values(gan_calib_cols)
         gan_calib_text.set_text(
             f"Gantry Calibrated: ({gan_calib_pos[0]:.2f}, "
             f"{gan_calib_pos[1]:.2f}, {gan_calib_pos[2]:.2f})"
@@ -260,7 +296,8 @@ def plot_movement(
     print(anim.get_help_text())
 
     plt.tight_layout()
-    plt.show()
+    with profile_section("show"):
+        plt.show()
 
     return ax
 
@@ -334,6 +371,13 @@ if __name__ == "__main__":
         help="Path to bad frames data file",
     )
 
+    parser.add_argument(
+        "--time-limit",
+        type=parse_limit,
+        default=None,
+        help="Time window of the take to play as 'min,max' (seconds)",
+    )
+
     default_axis_limits = {
         "x": (0, 5000),
         "y": (0, 5000),
@@ -348,19 +392,31 @@ if __name__ == "__main__":
             default=default_axis_limits[axis],
         )
 
+    add_take_server_argument(parser)
+    add_processed_take_argument(parser)
+    add_resample_arguments(parser)
+    add_profile_arguments(parser)
+
     args = parser.parse_args()
 
-    plot_movement(
-        gantry_file=args.gantry,
-        optitrack_file=args.optitrack,
-        alignment_params_file=args.alignment,
-        calibration_params_file=args.calibration,
-        trail_after_samples=args.trail_after,
-        trail_before_samples=args.trail_before,
-        remove_bad_frames=args.remove_bad_frames,
-        bad_frames_file=args.bad_frames,
-        show_calibrated=args.show_calibrated,
-        xlim=args.xlim,
-        ylim=args.ylim,
-        zlim=args.zlim,
-    )
+    with profiling(args.profile, args.profile_memory):
+        plot_movement(
+            gantry_file=args.gantry,
+            optitrack_file=args.optitrack,
+            alignment_params_file=args.alignment,
+            calibration_params_file=args.calibration,
+            trail_after_samples=args.trail_after,
+            trail_before_samples=args.trail_before,
+            remove_bad_frames=args.remove_bad_frames,
+            bad_frames_file=args.bad_frames,
+            show_calibrated=args.show_calibrated,
+            xlim=args.xlim,
+            ylim=args.ylim,
+            zlim=args.zlim,
+            time_limit=args.time_limit,
+            take_server=args.take_server,
+            processed_take=args.processed_take,
+            resample_rate=args.resample_rate,
+            anti_alias=args.anti_alias,
+            resample_cache_file=args.resample_cache,
+        )
@@ -4,11 +4,13 @@ from typing import Optional, cast
 import matplotlib.pyplot as plt
 import mpl_toolkits.mplot3d.axes3d as axes3d
 
-from argutils import parse_limit
+from argutils import add_profile_arguments, parse_limit
 from data import load_gantry_data
+from profiling import profile_section, profiling
 from point_player import PointPlayer
 
 
+@profile_section("plot_movement_gantry")
 def plot_movement_gantry(
     gantry_file: str,
     trail_after_samples: int = 0,
@@ -52,7 +54,8 @@ def plot_movement_gantry(
     print(anim.get_help_text())
 
     plt.tight_layout()
-    plt.show()
+    with profile_section("show"):
+        plt.show()
 
     return ax
 
@@ -99,13 +102,16 @@ if __name__ == "__main__":
             default=default_axis_limits[axis],
         )
 
+    add_profile_arguments(parser)
+
     args = parser.parse_args()
 
-    plot_movement_gantry(
-        gantry_file=args.data,
-        trail_after_samples=args.trail_after,
-        trail_before_samples=args.trail_before,
-        xlim=args.xlim,
-        ylim=args.ylim,
-        zlim=args.zlim,
-    )
+    with profiling(args.profile, args.profile_memory):
+        plot_movement_gantry(
+            gantry_file=args.data,
+            trail_after_samples=args.trail_after,
+            trail_before_samples=args.trail_before,
+            xlim=args.xlim,
+            ylim=args.ylim,
+            zlim=args.zlim,
+        )
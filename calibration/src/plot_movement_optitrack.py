@@ -5,12 +5,14 @@ import matplotlib.pyplot as plt
 import mpl_toolkits.mplot3d.axes3d as axes3d
 
 from data import load_optitrack_data
-from argutils import parse_limit
+from profiling import profile_section, profiling
+from argutils import add_profile_arguments, parse_limit
 from multipoint_player import MultiPointPlayer
 
 from coordinates_utils import TransformRotateCenter
 
 
+@profile_section("plot_movement_optitrack")
 def plot_movement_optitrack(
     optitrack_file: str,
     trail_after_samples: int = 0,
@@ -99,7 +101,8 @@ def plot_movement_optitrack(
     print(anim.get_help_text())
 
     plt.tight_layout()
-    plt.show()
+    with profile_section("show"):
+        plt.show()
 
     return ax
 
@@ -145,13 +148,16 @@ if __name__ == "__main__":
             default=default_axis_limits[axis],
         )
 
+    add_profile_arguments(parser)
+
     args = parser.parse_args()
 
-    plot_movement_optitrack(
-        optitrack_file=args.data,
-        trail_after_samples=args.trail_after,
-        trail_before_samples=args.trail_before,
-        xlim=args.xlim,
-        ylim=args.ylim,
-        zlim=args.zlim,
-    )
+    with profiling(args.profile, args.profile_memory):
+        plot_movement_optitrack(
+            optitrack_file=args.data,
+            trail_after_samples=args.trail_after,
+            trail_before_samples=args.trail_before,
+            xlim=args.xlim,
+            ylim=args.ylim,
+            zlim=args.zlim,
+        )
@@ -2,7 +2,7 @@ import argparse
 
 import numpy as np
 
-from data import get_calibration_matrices
+from calibration_model import get_calibration_matrices
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -0,0 +1,326 @@
+import argparse
+import fcntl
+import glob
+import inspect
+import json
+import os
+import shutil
+import tempfile
+from collections.abc import Sequence
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+SCHEMA_FILENAME = "schema.json"
+
+# Arguments of get_processed_data that do not change the processed data, or
+# that select part of it
+IGNORED_ARGS = {
+    "resample_cache_filename",
+    "cache_dir",
+    "optimizer_trace_filename",
+    "lazy",
+    "columns",
+    "time_window",
+}
+
+PARAMS_FILENAME_ARGS = ["alignment_params_filename", "calibration_params_filename"]
+
+# Arguments of the alignment and calibration fits, which do not change the
+# processed data when the parameters are loaded from their file instead
+ALIGNMENT_FIT_ARGS = {"alignment_init_params", "time_offset_xcorr"}
+CALIBRATION_FIT_ARGS = {"dwell_calibration"}
+
+
+def get_take_key(kwargs: dict[str, Any]) -> str:
+    """Key of the processed data of the arguments of get_processed_data.
+
+    It depends on the size and modification time of the data and parameters
+    files, so a processed take is outdated if they change, e.g., after a new
+    calibration. The arguments with their default value are left out, so the
+    key does not depend on whether they are given, and so are the arguments of
+    a fit when its parameters file exists.
+    """
+    # Imported here, they import the processing dependencies
+    from data import get_processed_data
+    from resample import get_cache_key
+
+    defaults = {
+        name: param.default
+        for name, param in inspect.signature(get_processed_data).parameters.items()
+    }
+
+    filenames = [
+        kwargs[name]
+        for name in ["gantry_filename", "optitrack_filename", *PARAMS_FILENAME_ARGS]
+        if kwargs.get(name) and os.path.exists(kwargs[name])
+    ]
+    ignored = set(IGNORED_ARGS)
+    if kwargs.get("alignment_params_filename") in filenames:
+        ignored |= ALIGNMENT_FIT_ARGS
+    if not kwargs.get("calibrate") or (
+        kwargs.get("calibration_params_filename") in filenames
+    ):
+        ignored |= CALIBRATION_FIT_ARGS
+
+    params = {}
+    for name, value in kwargs.items():
+        if name in ignored or (name in defaults and value == defaults[name]):
+            continue
+        if name.endswith("filename") and value:
+            value = os.path.abspath(value)
+        params[name] = value
+    return get_cache_key(filenames, **params)
+
+
+def get_take_keys(kwargs: dict[str, Any]) -> list[str]:
+    """Keys of the processed takes with the data of the arguments.
+
+    A calibrated take has the columns of the uncalibrated one with the same
+    values, and the calibrated columns filled instead of NaN, so it is also
+    valid without calibrate.
+    """
+    keys = [get_take_key(kwargs)]
+    if not kwargs.get("calibrate"):
+        keys.append(get_take_key({**kwargs, "calibrate": True}))
+    return keys
+
+
+def save_processed_take(
+    directory: str,
+    df: pd.DataFrame,
+    num_markers: int,
+    alignment_params: Optional[np.ndarray] = None,
+    calibration_params: Optional[np.ndarray] = None,
+    key: Optional[str] = None,
+) -> str:
+    """Save a processed take as a directory of column files and a JSON schema.
+
+    Each column is a file with the raw little-endian values, so it can be
+    memory-mapped by load_processed_take. The schema has the number of rows,
+    the name, dtype and file of each column, the number of markers, and the
+    parameters of the take.
+
+    The take is written to a new version directory next to the given path,
+    which becomes a symbolic link to it. The link is replaced atomically, so
+    the readers see either the previous take or the new one. The writers swap
+    the link one at a time, holding a lock file, and remove the versions older
+    than the previous one. The processes with them open keep their mappings.
+
+    Args:
+        directory: Path of the processed take, replaced if it exists
+        df: Processed data, as returned by get_processed_data
+        num_markers: Number of markers of the take
+        alignment_params: Optional alignment parameters of the take
+        calibration_params: Optional calibration parameters of the take
+        key: Optional key of the arguments of the processing, see get_take_key
+
+    Returns:
+        str: Path of the version directory of the take
+    """
+    index_start = int(df.index[0]) if len(df) else 0
+    assert df.index.equals(
+        pd.RangeIndex(index_start, index_start + len(df))
+    ), "The index of the processed take must be a range"
+
+    directory = directory.rstrip(os.sep)
+    parent, name = os.path.split(os.path.abspath(directory))
+    tmp_dir = tempfile.mkdtemp(prefix=f"{name}.tmp-", dir=parent)
+    suffix = os.path.basename(tmp_dir)[len(f"{name}.tmp-") :]
+    version_dir = os.path.join(parent, f"{name}.v-{suffix}")
+
+    # mkdtemp is only accessible by the user, the takes are shared like files
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_dir, 0o777 & ~umask)
+
+    try:
+        columns = []
+        for i, col in enumerate(df.columns):
+            array = df[col].to_numpy()
+            if array.dtype.hasobject:
+                raise TypeError(f"Column {col} of dtype {array.dtype} cannot be saved")
+
+            array = array.astype(array.dtype.newbyteorder("<"), copy=False)
+            filename = f"column{i:03d}.bin"
+            array.tofile(os.path.join(tmp_dir, filename))
+            columns.append({"name": col, "dtype": array.dtype.str, "file": filename})
+
+        # The time window is selected by binary search if the time is sorted
+        time = df["time"].to_numpy() if "time" in df else np.array([])
+        schema = {
+            "format_version": FORMAT_VERSION,
+            "num_rows": len(df),
+            "index_start": index_start,
+            "time_sorted": bool(np.all(np.diff(time) >= 0)),
+            "num_markers": num_markers,
+            "alignment_params": (
+                np.asarray(alignment_params).tolist()
+                if alignment_params is not None
+                else None
+            ),
+            "calibration_params": (
+                np.asarray(calibration_params).tolist()
+                if calibration_params is not None
+                else None
+            ),
+            "key": key,
+            "columns": columns,
+        }
+
+        with open(os.path.join(tmp_dir, SCHEMA_FILENAME), "w") as f:
+            json.dump(schema, f, indent=2)
+
+        with open(f"{directory}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # A directory of a previous format is not a link and is replaced
+            if os.path.isdir(directory) and not os.path.islink(directory):
+                shutil.rmtree(directory)
+            previous = os.path.realpath(directory)
+
+            # The complete versions only exist while they are current or previous
+            os.rename(tmp_dir, version_dir)
+            link = f"{version_dir}.link"
+            os.symlink(os.path.basename(version_dir), link)
+            os.replace(link, directory)
+
+            for path in glob.glob(os.path.join(parent, f"{glob.escape(name)}.v-*")):
+                if path not in (version_dir, previous):
+                    shutil.rmtree(path, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if os.path.realpath(directory) != version_dir:
+            shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    return version_dir
+
+
+def load_schema(directory: str) -> Optional[dict[str, Any]]:
+    """Schema of a processed take, or None if there is none or of another
+    version."""
+    try:
+        with open(os.path.join(directory, SCHEMA_FILENAME)) as f:
+            schema = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if schema.get("format_version") != FORMAT_VERSION:
+        return None
+
+    return schema
+
+
+def load_processed_take(
+    directory: str,
+    columns: Optional[Sequence[str]] = None,
+    time_window: Optional[tuple[float, float]] = None,
+) -> tuple[pd.DataFrame, dict[str, Any]]:
+    """Open a processed take saved with save_processed_take.
+
+    The columns are memory-mapped copy-on-write, so they are not read until
+    they are used, the pages read are shared by all the processes with the take
+    open, and writing to the dataframe does not change the files. The schema
+    and the columns are of the same version of the take, resolved again if it
+    is replaced and removed while it is opened.
+
+    Args:
+        directory: Path of the processed take, or of one of its versions
+        columns: Optional columns to open, all by default
+        time_window: Optional (min, max) time range of the rows. If the time is
+            sorted, the rows are a view of the files, otherwise they are copied.
+            The index keeps the row numbers of the take.
+
+    Returns:
+        tuple[pd.DataFrame, dict[str, Any]]: The processed data and the schema
+    """
+    while True:
+        path = os.path.realpath(directory)
+        try:
+            return _load_processed_take_version(path, columns, time_window)
+        except FileNotFoundError:
+            if os.path.realpath(directory) == path:
+                raise
+
+
+def _load_processed_take_version(
+    directory: str,
+    columns: Optional[Sequence[str]],
+    time_window: Optional[tuple[float, float]],
+) -> tuple[pd.DataFrame, dict[str, Any]]:
+    schema = load_schema(directory)
+    if schema is None:
+        raise FileNotFoundError(f"No processed take in {directory}")
+
+    num_rows = schema["num_rows"]
+    column_specs = {spec["name"]: spec for spec in schema["columns"]}
+
+    def open_column(name: str) -> np.ndarray:
+        spec = column_specs[name]
+        if num_rows == 0:
+            return np.empty(0, dtype=np.dtype(spec["dtype"]))
+        return np.memmap(
+            os.path.join(directory, spec["file"]),
+            dtype=np.dtype(spec["dtype"]),
+            mode="c",
+            shape=(num_rows,),
+        )
+
+    start, stop = 0, num_rows
+    mask = None
+    if time_window is not None:
+        time = open_column("time")
+        if schema["time_sorted"]:
+            start = int(np.searchsorted(time, time_window[0], side="left"))
+            stop = int(np.searchsorted(time, time_window[1], side="right"))
+        else:
+            mask = (time >= time_window[0]) & (time <= time_window[1])
+
+    names = list(columns) if columns is not None else list(column_specs)
+    index_start = schema["index_start"]
+    if mask is None:
+        df = pd.DataFrame(
+            {name: open_column(name)[start:stop] for name in names},
+            index=pd.RangeIndex(index_start + start, index_start + stop),
+            copy=False,
+        )
+    else:
+        df = pd.DataFrame(
+            {name: open_column(name)[mask] for name in names},
+            index=index_start + np.flatnonzero(mask),
+            copy=False,
+        )
+
+    return df, schema
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Print the schema of a processed take",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument("directory", type=str, help="Processed take directory")
+
+    args = parser.parse_args()
+
+    schema = load_schema(args.directory)
+    if schema is None:
+        parser.error(f"No processed take of version {FORMAT_VERSION} found")
+
+    size = sum(
+        os.path.getsize(os.path.join(args.directory, spec["file"]))
+        for spec in schema["columns"]
+    )
+    print(
+        f"{schema['num_rows']} rows, {len(schema['columns'])} columns, "
+        f"{schema['num_markers']} markers, {size / 2**20:.1f} MB"
+    )
+    print(f"Key: {schema['key']}")
+    print(f"Alignment parameters: {schema['alignment_params']}")
+    print(f"Calibration parameters: {schema['calibration_params']}")
+    for spec in schema["columns"]:
+        print(f"  {spec['name']:<28} {spec['dtype']:<4} {spec['file']}")
@@ -0,0 +1,220 @@
+import contextvars
+import json
+import threading
+import time
+import tracemalloc
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+
+@dataclass
+class SectionStats:
+    """Accumulated measurements of a profiled section.
+
+    Attributes:
+        calls: Number of times the section was run
+        seconds: Total wall time of the section, with its subsections
+        child_seconds: Wall time of the subsections
+        peak_memory: High-water mark of the traced memory while the section
+            was running (bytes), 0 without memory tracking
+    """
+
+    calls: int = 0
+    seconds: float = 0.0
+    child_seconds: float = 0.0
+    peak_memory: int = 0
+
+    @property
+    def self_seconds(self) -> float:
+        """Wall time out of the subsections, which may run concurrently."""
+        return max(0.0, self.seconds - self.child_seconds)
+
+
+@dataclass
+class _Frame:
+    path: tuple[str, ...]
+    start: float
+    peak_memory: int = 0
+    child_seconds: float = 0.0
+
+
+# Open sections of the current context. The worker threads of the pipeline run
+# in a copy of the context of the caller, so their sections are nested in it.
+_stack: contextvars.ContextVar[tuple[_Frame, ...]] = contextvars.ContextVar(
+    "profiling_stack", default=()
+)
+
+
+@dataclass
+class Profiler:
+    """Collects the time and peak memory of nested sections.
+
+    The sections are identified by their path, the names of the open sections
+    when they start. The memory is traced with tracemalloc, which only sees
+    the allocations of Python and numpy, and is shared by all the threads, so
+    the peak of concurrent sections includes the memory of each other.
+
+    Attributes:
+        memory: Whether the memory is traced
+        sections: Statistics of each section path
+    """
+
+    memory: bool = True
+    sections: dict[tuple[str, ...], SectionStats] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def _get_peak_memory(self) -> int:
+        if not self.memory:
+            return 0
+
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        return peak
+
+    @contextmanager
+    def section(self, name: str) -> Iterator[None]:
+        """Measure the code run in the context as a subsection of the open one."""
+        stack = _stack.get()
+        peak_memory = self._get_peak_memory()
+        if stack:
+            stack[-1].peak_memory = max(stack[-1].peak_memory, peak_memory)
+
+        path = (*(stack[-1].path if stack else ()), name)
+        frame = _Frame(path, time.perf_counter(), peak_memory)
+        token = _stack.set((*stack, frame))
+
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - frame.start
+            frame.peak_memory = max(frame.peak_memory, self._get_peak_memory())
+            _stack.reset(token)
+
+            if stack:
+                stack[-1].peak_memory = max(stack[-1].peak_memory, frame.peak_memory)
+                stack[-1].child_seconds += seconds
+
+            with self.lock:
+                stats = self.sections.setdefault(path, SectionStats())
+                stats.calls += 1
+                stats.seconds += seconds
+                stats.child_seconds += frame.child_seconds
+                stats.peak_memory = max(stats.peak_memory, frame.peak_memory)
+
+    def to_dict(self) -> dict[str, Any]:
+        """Report of the sections, sorted by path, as a JSON serializable dict."""
+        return {
+            "memory": self.memory,
+            "sections": [
+                {
+                    "path": list(path),
+                    "calls": stats.calls,
+                    "seconds": stats.seconds,
+                    "self_seconds": stats.self_seconds,
+                    "peak_memory_mb": stats.peak_memory / 2**20,
+                }
+                for path, stats in sorted(self.sections.items())
+            ],
+        }
+
+    def to_collapsed(self) -> str:
+        """Self time of the sections in the collapsed stack format.
+
+        Each line is the path of a section, separated by semicolons, and its
+        self time in microseconds, the input of flamegraph.pl or speedscope.
+        """
+        return "".join(
+            f"{';'.join(path)} {round(1e6 * stats.self_seconds)}\n"
+            for path, stats in sorted(self.sections.items())
+        )
+
+    def format_table(self) -> str:
+        """Table of the sections, indented by depth."""
+        width = max(
+            [len("Section")] + [2 * (len(p) - 1) + len(p[-1]) for p in self.sections]
+        )
+        lines = [
+            f"{'Section':<{width}}  {'Calls':>7}  {'Time (s)':>9}  {'Self (s)':>9}"
+            f"  {'Peak (MB)':>9}"
+        ]
+        for path, stats in sorted(self.sections.items()):
+            name = "  " * (len(path) - 1) + path[-1]
+            lines.append(
+                f"{name:<{width}}  {stats.calls:>7}  {stats.seconds:>9.3f}"
+                f"  {stats.self_seconds:>9.3f}"
+                f"  {stats.peak_memory / 2**20:>9.1f}"
+            )
+
+        return "\n".join(lines)
+
+
+_profiler: Optional[Profiler] = None
+
+
+@contextmanager
+def profile_section(name: str) -> Iterator[None]:
+    """Profile the code run in the context, or decorated function, as a section.
+
+    Without an active profiler, see profiling, it does nothing.
+    """
+    if _profiler is None:
+        yield
+        return
+
+    with _profiler.section(name):
+        yield
+
+
+def copy_context() -> contextvars.Context:
+    """Context to run a task in another thread nested in the open sections."""
+    return contextvars.copy_context()
+
+
+@contextmanager
+def profiling(
+    filename: Optional[str], memory: bool = True, name: str = "main"
+) -> Iterator[Optional[Profiler]]:
+    """Profile the code run in the context, if filename is given.
+
+    The sections run in the context are measured, nested in a root section.
+    At the end, a table of the sections is printed, and the report is saved as
+    JSON to filename, and as collapsed stacks to filename + ".folded".
+
+    Args:
+        filename: Path of the JSON report, or None to disable the profiling
+        memory: Whether to trace the peak memory of the sections
+        name: Name of the root section
+
+    Yields:
+        Optional[Profiler]: The active profiler, None if disabled
+    """
+    global _profiler
+
+    if filename is None:
+        yield None
+        return
+
+    profiler = Profiler(memory)
+    if memory:
+        tracemalloc.start()
+
+    _profiler = profiler
+    try:
+        with profiler.section(name):
+            yield profiler
+    finally:
+        _profiler = None
+        if memory:
+            tracemalloc.stop()
+
+        print(profiler.format_table())
+
+        with open(filename, "w") as f:
+            json.dump(profiler.to_dict(), f, indent=2)
+
+        with open(f"{filename}.folded", "w") as f:
+            f.write(profiler.to_collapsed())
+
+        print(f"Profile saved to {filename} and {filename}.folded")
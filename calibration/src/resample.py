@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from coordinates_utils import InterpKernel
+
+
+@dataclass
+class TimeGrid:
+    """Uniform time grid, t[i] = start + i / rate."""
+
+    start: float
+    rate: float
+    num: int
+
+    @property
+    def times(self) -> np.ndarray:
+        return self.start + np.arange(self.num) / self.rate
+
+    def index(self, t: npt.ArrayLike) -> np.ndarray:
+        """Index of the nearest time of the grid, clipped to the grid."""
+        idx = np.rint((np.asarray(t) - self.start) * self.rate).astype(int)
+        return np.clip(idx, 0, self.num - 1)
+
+
+def get_time_grid(t_start: float, t_end: float, rate: float) -> TimeGrid:
+    """Uniform time grid covering [t_start, t_end] at the given rate (Hz)."""
+    num = int(np.floor((t_end - t_start) * rate + 1e-9)) + 1
+    return TimeGrid(float(t_start), float(rate), max(0, num))
+
+
+def lowpass_filter(
+    values: np.ndarray, rate: float, cutoff: float, order: int = 4
+) -> np.ndarray:
+    """Zero-phase Butterworth low-pass filter of uniformly sampled columns.
+
+    The NaN gaps are filled by linear interpolation before filtering and set to
+    NaN again afterwards, so they do not spread over the whole column.
+
+    Args:
+        values: Samples with shape (N, K)
+        rate: Sample rate (Hz)
+        cutoff: Cutoff frequency (Hz)
+        order: Order of the filter
+
+    Returns:
+        np.ndarray: Filtered samples with shape (N, K)
+    """
+    # Imported here, scipy.signal is slow to import
+    from scipy import signal
+
+    sos = signal.butter(order, cutoff, fs=rate, output="sos")
+    out = np.full_like(values, np.nan, dtype=np.float64)
+    x = np.arange(len(values))
+
+    for k in range(values.shape[1]):
+        valid = np.isfinite(values[:, k])
+        if valid.sum() <= 3 * (2 * len(sos) + 1):
+            out[:, k] = values[:, k]
+            continue
+
+        filled = np.interp(x, x[valid], values[valid, k])
+        out[:, k] = signal.sosfiltfilt(sos, filled)
+        out[~valid, k] = np.nan
+
+    return out
+
+
+def resample_columns(
+    t: npt.ArrayLike,
+    values: npt.ArrayLike,
+    grid: TimeGrid,
+    anti_alias: bool = True,
+    cutoff_ratio: float = 0.8,
+) -> np.ndarray:
+    """Resample columns of (possibly irregular) samples on a uniform time grid.
+
+    When the samples are faster than the grid and anti_alias is set, they are
+    first interpolated on a uniform grid at their median rate and low-pass
+    filtered below the Nyquist frequency of the target grid.
+
+    Args:
+        t: Increasing sample times with shape (N,)
+        values: Samples with shape (N, K), invalid samples are NaN
+        grid: Target time grid
+        anti_alias: Whether to filter the samples before downsampling
+        cutoff_ratio: Cutoff frequency of the filter relative to the Nyquist
+            frequency of the grid
+
+    Returns:
+        np.ndarray: Resampled values with shape (grid.num, K), NaN out of the
+            time range of the samples
+    """
+    t = np.asarray(t, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+
+    source_rate = 1 / np.median(np.diff(t))
+    if anti_alias and source_rate > grid.rate:
+        source_grid = get_time_grid(t[0], t[-1], source_rate)
+        uniform = InterpKernel(source_grid.times, t)(values)
+        uniform = lowpass_filter(uniform, source_rate, cutoff_ratio * grid.rate / 2)
+        t, values = source_grid.times, uniform
+
+    return InterpKernel(grid.times, t)(values)
+
+
+def resample_frame(
+    df: pd.DataFrame,
+    grid: TimeGrid,
+    time_col: str = "time",
+    anti_alias: bool = True,
+    cutoff_ratio: float = 0.8,
+) -> pd.DataFrame:
+    """Resample all the columns of a dataframe on a uniform time grid.
+
+    The frame column, if any, is interpolated too, so each row keeps the
+    (fractional) frame number of the original data.
+    """
+    cols = [col for col in df.columns if col != time_col]
+    values = df[cols].to_numpy(dtype=np.float64)
+    values = resample_columns(df[time_col], values, grid, anti_alias, cutoff_ratio)
+
+    df_grid = pd.DataFrame(values, columns=cols)
+    df_grid.insert(0, time_col, grid.times)
+
+    if "frame" in df.columns:
+        df_grid["frame"] = InterpKernel(grid.times, df[time_col])(df["frame"])
+
+    return df_grid[list(df.columns)]
+
+
+def get_cache_key(filenames: list[str], **params) -> str:
+    """Key of the cached data, from the size and time of the files and params."""
+    items = [
+        (os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f))
+        for f in filenames
+    ]
+    text = json.dumps({"files": items, "params": params}, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def save_resampled(filename: str, key: str, frames: dict[str, pd.DataFrame]):
+    """Save resampled dataframes to a .npz cache file."""
+    arrays = {"key": np.array(key)}
+    for name, df in frames.items():
+        arrays[f"{name}.columns"] = np.array(df.columns, dtype=str)
+        arrays[f"{name}.values"] = df.to_numpy(dtype=np.float64)
+
+    # Through a file object so no .npz extension is appended to the filename
+    with open(filename, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def load_resampled(filename: str, key: str) -> Optional[dict[str, pd.DataFrame]]:
+    """Load resampled dataframes from a .npz cache file.
+
+    Returns:
+        Optional[dict[str, pd.DataFrame]]: The dataframes, or None if the file
+            does not exist or was saved with another key.
+    """
+    if not os.path.exists(filename):
+        return None
+
+    with np.load(filename) as data:
+        if str(data["key"]) != key:
+            return None
+
+        names = [f[: -len(".values")] for f in data.files if f.endswith(".values")]
+        return {
+            name: pd.DataFrame(
+                data[f"{name}.values"], columns=data[f"{name}.columns"].tolist()
+            )
+            for name in names
+        }
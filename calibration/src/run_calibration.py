@@ -4,7 +4,12 @@ import logging
 import os
 import sys
 
+import numpy as np
+
+from argutils import add_profile_arguments, add_resample_arguments
 from data import get_processed_data, load_bad_frames
+from processed_take import get_take_key, save_processed_take
+from profiling import profiling
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -63,6 +68,69 @@ if __name__ == "__main__":
         help="Path to the alignment initial parameters file",
     )
 
+    parser.add_argument(
+        "--dwell-calibration",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Calibrate with the averaged points of the gantry dwells "
+        "(takes measured with run_measurement.py --dwell)",
+    )
+
+    parser.add_argument(
+        "--time-offset-xcorr",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Start the fit of the alignment time shift from its estimate by "
+        "cross-correlation of the gantry and Optitrack speeds",
+    )
+
+    parser.add_argument(
+        "--clock-drift",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Estimate and correct a linear drift of the gantry clock",
+    )
+
+    parser.add_argument(
+        "--time-warp",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Estimate and correct a piecewise linear time offset (long takes)",
+    )
+
+    parser.add_argument(
+        "--time-warp-window",
+        type=float,
+        default=60.0,
+        help="Length of the windows of the time warp (s)",
+    )
+
+    add_resample_arguments(parser)
+
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory to cache the output of each processing stage",
+    )
+
+    parser.add_argument(
+        "--optimizer-trace",
+        type=str,
+        default=None,
+        help="Path of a .npz file to save the objective evaluations of the fits, "
+        "summarized with optimizer_trace.py",
+    )
+
+    parser.add_argument(
+        "--processed-take",
+        type=str,
+        default=None,
+        help="Directory to save the calibrated processed take, memory-mapped by "
+        "the tools with --processed-take",
+    )
+
+    add_profile_arguments(parser)
 
     args = parser.parse_args()
 
@@ -100,13 +168,37 @@ if __name__ == "__main__":
         with open(args.alignment_init, "r") as f:
             alignment_init_params = json.load(f)
 
+    kwargs = {
+        "gantry_filename": args.gantry,
+        "optitrack_filename": args.optitrack,
+        "alignment_params_filename": args.alignment,
+        "calibration_params_filename": args.calibration,
+        "bad_frames": bad_frames,
+        "alignment_init_params": alignment_init_params,
+        "calibrate": True,
+        "dwell_calibration": args.dwell_calibration,
+        "time_offset_xcorr": args.time_offset_xcorr,
+        "clock_drift": args.clock_drift,
+        "time_warp": args.time_warp,
+        "time_warp_window": args.time_warp_window,
+        "resample_rate": args.resample_rate,
+        "anti_alias": args.anti_alias,
+        "resample_cache_filename": args.resample_cache,
+        "cache_dir": args.cache_dir,
+        "optimizer_trace_filename": args.optimizer_trace,
+    }
+
     # Get the processed data with calibration
-    df_calibrated, _ = get_processed_data(
-        args.gantry,
-        args.optitrack,
-        alignment_params_filename=args.alignment,
-        calibration_params_filename=args.calibration,
-        bad_frames=bad_frames,
-        alignment_init_params=alignment_init_params,
-        calibrate=True,
-    )
+    with profiling(args.profile, args.profile_memory):
+        df_calibrated, num_markers = get_processed_data(**kwargs)
+
+    if args.processed_take:
+        save_processed_take(
+            args.processed_take,
+            df_calibrated,
+            num_markers,
+            np.load(args.alignment),
+            np.load(args.calibration),
+            key=get_take_key(kwargs),
+        )
+        print(f"Processed take saved to {args.processed_take}")
@@ -0,0 +1,512 @@
+# Synthetic takes in the Motive CSV and gantry CSV formats, with known ground
+# truth alignment and calibration parameters, for benchmarks and regression
+# tests without the measured takes
+
+import argparse
+import json
+import os
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Optional, TextIO
+
+import numpy as np
+import pandas as pd
+
+from calibration_model import get_calibration_matrices
+
+# Lissajous trajectory of the gantry: center, amplitude (mm) and period (s)
+TRAJECTORY_CENTER = np.array([2500.0, 2500.0, -800.0])
+TRAJECTORY_AMPLITUDE = np.array([2000.0, 2000.0, 250.0])
+TRAJECTORY_PERIOD = np.array([97.0, 71.0, 53.0])
+TRAJECTORY_PHASE = np.array([0.0, 1.0, 2.0])
+
+# Default alignment, shift (mm), rotations about X, Y, Z (rad) and time shift (s)
+DEFAULT_ALIGNMENT = (120.0, -80.0, 40.0, 0.002, -0.003, 0.01, 0.35)
+
+
+def get_rotation_matrix(axis: str, angle: float) -> np.ndarray:
+    """Matrix of the rotation of column vectors made by coord_rotate."""
+    cos_a, sin_a = np.cos(angle), np.sin(angle)
+    i, j = {"x": (1, 2), "y": (0, 2), "z": (0, 1)}[axis]
+
+    matrix = np.eye(3)
+    matrix[i, i], matrix[i, j] = cos_a, -sin_a
+    matrix[j, i], matrix[j, j] = sin_a, cos_a
+
+    return matrix
+
+
+def get_random_calibration_params(
+    rng: np.random.Generator, scale: float = 1.0
+) -> np.ndarray:
+    """Calibration parameters with errors of the magnitude of the measured ones.
+
+    Args:
+        rng: Random generator
+        scale: Factor of the magnitude of the errors, 0 for the identity
+
+    Returns:
+        np.ndarray: Array of calibration parameters (18 elements).
+    """
+    params = np.zeros(18)
+    params[:9] = np.eye(3).ravel() + scale * rng.normal(0, 3e-3, 9)
+    params[9:15] = scale * rng.normal(0, 5e-7, 6)
+    params[15:18] = scale * rng.normal(0, 5.0, 3)
+
+    return params
+
+
+def get_marker_offsets(num_markers: int, radius: float = 40.0) -> np.ndarray:
+    """Positions of the markers relative to the rigid body, on a sphere."""
+    i = np.arange(num_markers) + 0.5
+    z = 1 - 2 * i / num_markers
+    r = np.sqrt(1 - z**2)
+    angle = np.pi * (3 - np.sqrt(5)) * i
+
+    offsets = radius * np.column_stack([r * np.cos(angle), r * np.sin(angle), z])
+    return offsets - offsets.mean(axis=0)
+
+
+@dataclass
+class SyntheticTake:
+    """Synthetic take of the gantry and the OptiTrack rigid body.
+
+    The gantry follows a Lissajous trajectory. The OptiTrack data is the
+    calibrated gantry position, transformed with the inverse of the alignment,
+    so get_processed_data should recover the ground truth parameters. The data
+    is generated in chunks, each with its own random generator, so the files
+    are written without holding the take in memory.
+
+    Attributes:
+        duration: Duration of each stream (s)
+        optitrack_rate: Frame rate of the OptiTrack data (Hz)
+        gantry_rate: Mean sample rate of the gantry data (Hz), with a jitter of
+            20 % of the sample interval
+        num_markers: Number of markers of the rigid body
+        marker_noise: Standard deviation of the noise of the raw markers (mm)
+        rb_noise: Standard deviation of the noise of the rigid body (mm)
+        gantry_noise: Standard deviation of the noise of the gantry (mm)
+        dropout: Probability of a raw marker missing in a frame
+        occlusions_per_minute: Mean number of occlusions of all the markers
+        occlusion_length: Duration of the occlusions (s)
+        alignment_params: Ground truth alignment parameters (7 elements)
+        calibration_params: Ground truth calibration parameters (18 elements)
+        start_time: Capture start time of the take
+        rigid_body_name: Name of the rigid body
+        seed: Seed of the random generators
+        chunk_duration: Duration of the chunks written at once (s)
+    """
+
+    duration: float = 120.0
+    optitrack_rate: float = 120.0
+    gantry_rate: float = 30.0
+    num_markers: int = 3
+    marker_noise: float = 0.1
+    rb_noise: float = 0.05
+    gantry_noise: float = 0.0
+    dropout: float = 0.01
+    occlusions_per_minute: float = 0.5
+    occlusion_length: float = 0.5
+    alignment_params: np.ndarray = field(
+        default_factory=lambda: np.array(DEFAULT_ALIGNMENT)
+    )
+    calibration_params: np.ndarray = field(
+        default_factory=lambda: get_random_calibration_params(
+            np.random.default_rng([0, 0])
+        )
+    )
+    start_time: datetime = datetime(2025, 4, 23, 10, 0, 0)
+    rigid_body_name: str = "RB"
+    seed: int = 0
+    chunk_duration: float = 10.0
+
+    def __post_init__(self):
+        self.alignment_params = np.asarray(self.alignment_params, dtype=np.float64)
+        self.calibration_params = np.asarray(
+            self.calibration_params, dtype=np.float64
+        )
+        self.marker_offsets = get_marker_offsets(self.num_markers)
+
+        # The occlusions are few, so they are drawn once for the whole take
+        rng = np.random.default_rng([self.seed, 1])
+        num_occlusions = rng.poisson(self.occlusions_per_minute * self.duration / 60)
+        self.occlusion_starts = np.sort(rng.uniform(0, self.duration, num_occlusions))
+
+        self.rb_centroid = self._get_rb_centroid()
+
+    @property
+    def num_frames(self) -> int:
+        return int(self.duration * self.optitrack_rate)
+
+    def gantry_position(self, t: np.ndarray) -> np.ndarray:
+        """Position of the gantry at the times t (s from the capture start)."""
+        angle = 2 * np.pi * t[:, None] / TRAJECTORY_PERIOD + TRAJECTORY_PHASE
+        return TRAJECTORY_CENTER + TRAJECTORY_AMPLITUDE * np.sin(angle)
+
+    def calibrated_position(self, t: np.ndarray) -> np.ndarray:
+        """Gantry position at the times t in the aligned OptiTrack space."""
+        pos = self.gantry_position(t)
+        matrix1, matrix2, array = get_calibration_matrices(self.calibration_params)
+        return pos @ matrix1 + pos**2 @ matrix2 + array
+
+    def _get_chunk(self, i: int) -> dict[str, np.ndarray]:
+        """Frames of the i-th chunk of the OptiTrack data, without the alignment."""
+        rng = np.random.default_rng([self.seed, 2, i])
+        chunk_frames = int(self.chunk_duration * self.optitrack_rate)
+        frames = np.arange(
+            i * chunk_frames, min((i + 1) * chunk_frames, self.num_frames)
+        )
+        t = frames / self.optitrack_rate
+
+        # The aligned data at the time t is the raw data at t - t_shift
+        aligned = self.calibrated_position(t + self.alignment_params[6])
+
+        missing = rng.random((len(frames), self.num_markers)) < self.dropout
+        if len(self.occlusion_starts):
+            starts = self.occlusion_starts
+            k = np.searchsorted(starts, t, side="right") - 1
+            occluded = (k >= 0) & (t - starts[np.maximum(k, 0)] < self.occlusion_length)
+            missing[occluded] = True
+
+        return {
+            "frames": frames,
+            "t": t,
+            "aligned": aligned,
+            "missing": missing,
+            "rb_noise": rng.normal(0, self.rb_noise, aligned.shape),
+            "marker_noise": rng.normal(
+                0, self.marker_noise, (len(frames), self.num_markers, 3)
+            ),
+        }
+
+    def _get_chunks(self) -> Iterator[dict[str, np.ndarray]]:
+        chunk_frames = int(self.chunk_duration * self.optitrack_rate)
+        for i in range(-(-self.num_frames // chunk_frames)):
+            yield self._get_chunk(i)
+
+    def _get_rb_centroid(self) -> np.ndarray:
+        """Centroid of the tracked rigid body, the center of the rotations.
+
+        The rotations of the alignment are made about the centroid of the rigid
+        body, which they keep, so it is the centroid of the aligned positions of
+        the frames where some marker is tracked.
+        """
+        total = np.zeros(3)
+        count = 0
+        for chunk in self._get_chunks():
+            tracked = ~chunk["missing"].all(axis=1)
+            total += chunk["aligned"][tracked].sum(axis=0)
+            count += tracked.sum()
+
+        return total / max(count, 1)
+
+    def unalign(self, aligned: np.ndarray) -> np.ndarray:
+        """Raw OptiTrack positions of the aligned positions (rows)."""
+        shift, angles = self.alignment_params[:3], self.alignment_params[3:6]
+
+        # aligned = Rz Ry Rx (raw + shift - c) + c, with c the centroid
+        rotation = (
+            get_rotation_matrix("z", angles[2])
+            @ get_rotation_matrix("y", angles[1])
+            @ get_rotation_matrix("x", angles[0])
+        )
+        c = self.rb_centroid
+
+        return (aligned - c) @ rotation + c - shift
+
+    def get_optitrack_columns(self) -> list[tuple[str, str, str, str, str]]:
+        """Columns of the Motive CSV file: type, name, ID, data and axis."""
+        rb = self.rigid_body_name
+        columns = [("", "", "", "", "Frame"), ("", "", "", "", "Time (Seconds)")]
+        columns += [("Rigid Body", rb, "1", "Rotation", axis) for axis in "XYZW"]
+        columns += [("Rigid Body", rb, "1", "Position", axis) for axis in "XYZ"]
+        columns += [("Rigid Body", rb, "1", "Mean Marker Error", "")]
+
+        for m in range(1, self.num_markers + 1):
+            name = f"{rb}:Marker{m}"
+            columns += [
+                ("Rigid Body Marker", name, f"1:{m}", "Position", axis)
+                for axis in "XYZ"
+            ]
+            columns += [("Rigid Body Marker", name, f"1:{m}", "Marker Quality", "")]
+
+        for m in range(1, self.num_markers + 1):
+            name = f"{rb}:Marker{m}"
+            columns += [("Marker", name, f"1:{m}", "Position", axis) for axis in "XYZ"]
+
+        return columns
+
+    def write_optitrack_header(self, f: TextIO):
+        # The time is written in 12-hour format, with AM/PM in the take name
+        start = self.start_time
+        metadata = [
+            ("Format Version", "1.23"),
+            ("Take Name", f"Take {start:%Y-%m-%d %I.%M.%S %p}"),
+            ("Capture Frame Rate", f"{self.optitrack_rate:g}"),
+            ("Export Frame Rate", f"{self.optitrack_rate:g}"),
+            ("Capture Start Time", f"{start:%Y-%m-%d %I.%M.%S}.000"),
+            ("Capture Start Frame", "0"),
+            ("Total Frames in Take", str(self.num_frames)),
+            ("Total Exported Frames", str(self.num_frames)),
+        ]
+        f.write(",".join(item for pair in metadata for item in pair) + "\n\n")
+
+        for row in zip(*self.get_optitrack_columns()):
+            f.write(",".join(row) + "\n")
+
+    def write_optitrack(self, filename: str):
+        """Write the OptiTrack data as a Motive CSV file, chunk by chunk."""
+        with open(filename, "w", newline="") as f:
+            self.write_optitrack_header(f)
+
+            for chunk in self._get_chunks():
+                num_frames = len(chunk["frames"])
+                missing = chunk["missing"]
+                tracked = ~missing.all(axis=1)
+
+                rb = self.unalign(chunk["aligned"]) + chunk["rb_noise"]
+                rb_markers = rb[:, None, :] + self.marker_offsets
+                markers = rb_markers + chunk["marker_noise"]
+                markers[missing] = np.nan
+
+                # Untracked rigid body frames are empty, like in Motive
+                rb[~tracked] = np.nan
+                rb_markers[~tracked] = np.nan
+                error = np.linalg.norm(markers - rb_markers, axis=2)
+                num_tracked = (~missing).sum(axis=1)
+                marker_error = np.full(num_frames, np.nan)
+                marker_error[tracked] = (
+                    np.nansum(error[tracked], axis=1) / num_tracked[tracked]
+                )
+
+                rotation = np.tile([0.0, 0.0, 0.0, 1.0], (num_frames, 1))
+                rotation[~tracked] = np.nan
+                quality = np.where(missing, np.nan, 1.0)
+
+                values = np.column_stack(
+                    [
+                        chunk["t"],
+                        rotation,
+                        rb,
+                        marker_error,
+                        *[
+                            np.column_stack([rb_markers[:, m], quality[:, m]])
+                            for m in range(self.num_markers)
+                        ],
+                        markers.reshape(num_frames, -1),
+                    ]
+                )
+
+                df = pd.DataFrame(values)
+                df.insert(0, "frame", chunk["frames"])
+                df.to_csv(f, header=False, index=False, float_format="%.6f")
+
+    def write_gantry(self, filename: str):
+        """Write the gantry data as a CSV file with the absolute time, chunk by
+        chunk."""
+        t_start = self.start_time.timestamp()
+        mean_dt = 1 / self.gantry_rate
+
+        with open(filename, "w", newline="") as f:
+            f.write("time,x,y,z\n")
+
+            t_last = 0.0
+            for i in range(int(np.ceil(self.duration / self.chunk_duration))):
+                rng = np.random.default_rng([self.seed, 3, i])
+                t_end = min((i + 1) * self.chunk_duration, self.duration)
+                num = int(np.ceil((t_end - t_last) / (0.8 * mean_dt))) + 1
+
+                t = t_last + np.cumsum(rng.uniform(0.8 * mean_dt, 1.2 * mean_dt, num))
+                t = t[t < t_end]
+                if len(t) == 0:
+                    continue
+                t_last = t[-1]
+
+                pos = self.gantry_position(t)
+                pos += rng.normal(0, self.gantry_noise, pos.shape)
+
+                df = pd.DataFrame(pos, columns=["x", "y", "z"])
+                df.insert(0, "time", t_start + t)
+                df.to_csv(f, header=False, index=False, float_format="%.6f")
+
+    def get_ground_truth(self) -> dict[str, Any]:
+        """Parameters of the take, JSON serializable."""
+        return {
+            "alignment_params": self.alignment_params.tolist(),
+            "calibration_params": self.calibration_params.tolist(),
+            "rb_centroid": self.rb_centroid.tolist(),
+            "marker_offsets": self.marker_offsets.tolist(),
+            "capture_start_time": self.start_time.isoformat(),
+            "duration": self.duration,
+            "optitrack_rate": self.optitrack_rate,
+            "gantry_rate": self.gantry_rate,
+            "num_markers": self.num_markers,
+            "marker_noise": self.marker_noise,
+            "rb_noise": self.rb_noise,
+            "gantry_noise": self.gantry_noise,
+            "dropout": self.dropout,
+            "occlusions_per_minute": self.occlusions_per_minute,
+            "occlusion_length": self.occlusion_length,
+            "seed": self.seed,
+        }
+
+    def write(
+        self,
+        optitrack_filename: str,
+        gantry_filename: str,
+        ground_truth_filename: Optional[str] = None,
+    ):
+        """Write the OptiTrack, gantry and ground truth files."""
+        self.write_optitrack(optitrack_filename)
+        self.write_gantry(gantry_filename)
+
+        if ground_truth_filename:
+            with open(ground_truth_filename, "w") as f:
+                json.dump(self.get_ground_truth(), f, indent=2)
+
+
+def load_ground_truth(filename: str) -> dict[str, Any]:
+    """Load the ground truth of a synthetic take, with the parameters as arrays."""
+    with open(filename, "r") as f:
+        ground_truth = json.load(f)
+
+    for key in ["alignment_params", "calibration_params", "rb_centroid"]:
+        ground_truth[key] = np.array(ground_truth[key])
+
+    return ground_truth
+
+
+def parse_params(params_str: str) -> np.ndarray:
+    """Parse comma-separated parameters, or load them from a .npy file."""
+    if params_str.endswith(".npy"):
+        return np.load(params_str)
+
+    try:
+        return np.array([float(x) for x in params_str.split(",")])
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Parameters must be comma-separated numbers or a .npy file "
+            f"(got '{params_str}')"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic take with known alignment and calibration",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--output-dir", type=str, default=".", help="Directory of the output files"
+    )
+    parser.add_argument(
+        "--optitrack",
+        type=str,
+        default="take_optitrack.csv",
+        help="Name of the Motive CSV file",
+    )
+    parser.add_argument(
+        "--gantry", type=str, default="take_gantry.csv", help="Name of the gantry file"
+    )
+    parser.add_argument(
+        "--ground-truth",
+        type=str,
+        default="ground_truth.json",
+        help="Name of the JSON file with the ground truth parameters",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=120.0, help="Duration of the take (s)"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=120.0, help="OptiTrack frame rate (Hz)"
+    )
+    parser.add_argument(
+        "--gantry-rate", type=float, default=30.0, help="Gantry sample rate (Hz)"
+    )
+    parser.add_argument(
+        "--markers", type=int, default=3, help="Number of markers of the rigid body"
+    )
+    parser.add_argument(
+        "--marker-noise", type=float, default=0.1, help="Raw marker noise (mm)"
+    )
+    parser.add_argument(
+        "--rb-noise", type=float, default=0.05, help="Rigid body noise (mm)"
+    )
+    parser.add_argument(
+        "--gantry-noise", type=float, default=0.0, help="Gantry noise (mm)"
+    )
+    parser.add_argument(
+        "--dropout",
+        type=float,
+        default=0.01,
+        help="Probability of a raw marker missing in a frame",
+    )
+    parser.add_argument(
+        "--occlusions",
+        type=float,
+        default=0.5,
+        help="Mean number of occlusions of all the markers per minute",
+    )
+    parser.add_argument(
+        "--occlusion-length",
+        type=float,
+        default=0.5,
+        help="Duration of the occlusions (s)",
+    )
+    parser.add_argument(
+        "--alignment",
+        type=parse_params,
+        default=",".join(map(str, DEFAULT_ALIGNMENT)),
+        help="Ground truth alignment as 'x,y,z,rx,ry,rz,t' or a .npy file",
+    )
+    parser.add_argument(
+        "--calibration",
+        type=parse_params,
+        default=None,
+        help="Ground truth calibration parameters (18, comma-separated or a .npy "
+        "file), random if not given",
+    )
+    parser.add_argument(
+        "--calibration-scale",
+        type=float,
+        default=1.0,
+        help="Magnitude of the random calibration errors relative to the measured",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    args = parser.parse_args()
+
+    calibration_params = args.calibration
+    if calibration_params is None:
+        calibration_params = get_random_calibration_params(
+            np.random.default_rng([args.seed, 0]), args.calibration_scale
+        )
+
+    take = SyntheticTake(
+        duration=args.duration,
+        optitrack_rate=args.rate,
+        gantry_rate=args.gantry_rate,
+        num_markers=args.markers,
+        marker_noise=args.marker_noise,
+        rb_noise=args.rb_noise,
+        gantry_noise=args.gantry_noise,
+        dropout=args.dropout,
+        occlusions_per_minute=args.occlusions,
+        occlusion_length=args.occlusion_length,
+        alignment_params=args.alignment,
+        calibration_params=calibration_params,
+        seed=args.seed,
+    )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    take.write(
+        os.path.join(args.output_dir, args.optitrack),
+        os.path.join(args.output_dir, args.gantry),
+        os.path.join(args.output_dir, args.ground_truth),
+    )
+
+    print(
+        f"Wrote {take.num_frames} frames of {args.markers} markers to "
+        f"{args.output_dir}"
+    )
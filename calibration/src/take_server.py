@@ -0,0 +1,493 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Optional, Union, cast
+
+import numpy as np
+import pandas as pd
+
+from processed_take import (
+    get_take_key,
+    get_take_keys,
+    load_processed_take,
+    load_schema,
+    save_processed_take,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = os.path.join(
+    tempfile.gettempdir(), f"calibration-take-server-{os.getuid()}.sock"
+)
+
+# Offsets of the columns in the shared memory block are aligned to this
+ALIGNMENT = 64
+
+
+class TakeServerError(Exception):
+    """Error reported by the take server."""
+
+
+@dataclass
+class ResidentTake:
+    """Processed take held in a shared memory block by the server.
+
+    Attributes:
+        shm: Shared memory block with the columns, one after the other
+        meta: Description of the block sent to the clients, see to_shared_memory
+    """
+
+    shm: shared_memory.SharedMemory
+    meta: dict[str, Any]
+
+
+def to_shared_memory(df: pd.DataFrame) -> ResidentTake:
+    """Copy the columns of a dataframe to a new shared memory block.
+
+    The meta of the take has the name of the block, the number of rows, and the
+    name, dtype and offset of each column. A non-default index is stored as a
+    column with a None name.
+    """
+    arrays: list[tuple[Optional[str], np.ndarray]] = []
+    if not df.index.equals(pd.RangeIndex(len(df))):
+        arrays.append((None, df.index.to_numpy()))
+    for col in df.columns:
+        arrays.append((col, df[col].to_numpy()))
+
+    offsets = []
+    size = 0
+    for _, array in arrays:
+        if array.dtype.hasobject:
+            raise TypeError(f"Column of dtype {array.dtype} cannot be shared")
+        offsets.append(size)
+        size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for (_, array), offset in zip(arrays, offsets):
+        shared = np.ndarray(array.shape, array.dtype, buffer=shm.buf, offset=offset)
+        shared[:] = array
+
+    meta = {
+        "shm": shm.name,
+        "num_rows": len(df),
+        "columns": [
+            [name, array.dtype.str, offset]
+            for (name, array), offset in zip(arrays, offsets)
+        ],
+    }
+    return ResidentTake(shm, meta)
+
+
+# Blocks attached by this process. They are kept open until it exits, since
+# the arrays of the dataframes are views of them.
+_attached: dict[str, shared_memory.SharedMemory] = {}
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    if name in _attached:
+        return _attached[name]
+
+    try:
+        shm = shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13, the resource tracker of this process would
+        # unlink the block of the server at exit
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore
+
+    _attached[name] = shm
+    return shm
+
+
+# Dataframes of the attached blocks. The dataframes returned are shallow copies
+# of them, so the copy on write of pandas copies the columns written to,
+# instead of failing to write to the read-only shared memory.
+_frames: dict[str, pd.DataFrame] = {}
+
+
+def from_shared_memory(meta: dict[str, Any]) -> pd.DataFrame:
+    """Dataframe with views of the columns of a shared memory block.
+
+    The columns are only copied if they are written to.
+    """
+    name = meta["shm"]
+    if name not in _frames:
+        shm = _attach_shared_memory(name)
+        num_rows = meta["num_rows"]
+
+        index = None
+        columns = {}
+        for col, dtype, offset in meta["columns"]:
+            array = np.ndarray(
+                (num_rows,), np.dtype(dtype), buffer=shm.buf, offset=offset
+            )
+            array.flags.writeable = False
+            if col is None:
+                index = array
+            else:
+                columns[col] = array
+
+        _frames[name] = pd.DataFrame(columns, index=index, copy=False)
+
+    return _frames[name].copy(deep=False)
+
+
+class TakeServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Server of processed takes in shared memory, over a Unix socket.
+
+    Each request is a JSON line with an "op", and the response is a JSON line,
+    with an "error" if the request failed:
+
+    - get: process a take with get_processed_data and the "kwargs" of the
+      request, unless it is resident, and respond with its meta, see
+      to_shared_memory, and "num_markers"
+    - list: respond with the "takes", the kwargs and meta of each take
+    - drop: remove the take with the "key" of the request
+    - shutdown: stop the server
+
+    The takes are identified by the kwargs and the size and modification time
+    of their files, so a take is processed again if a file changes. The least
+    recently used takes are removed over max_takes. The clients keep the
+    blocks they attached mapped, so they are freed once they are closed.
+
+    Args:
+        socket_path: Path of the Unix socket
+        max_takes: Maximum number of resident takes
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, max_takes: int = 8):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        super().__init__(socket_path, TakeRequestHandler)
+        self.socket_path = socket_path
+        self.max_takes = max_takes
+        self.takes: OrderedDict[str, tuple[dict[str, Any], ResidentTake]] = (
+            OrderedDict()
+        )
+        self.lock = threading.Lock()
+        self.key_locks: dict[str, threading.Lock] = {}
+
+    def get_take(self, kwargs: dict[str, Any]) -> dict[str, Any]:
+        # Imported here, the server starts without loading the processing
+        from data import get_processed_data
+        from resample import get_cache_key
+
+        filenames = [
+            kwargs[name]
+            for name in [
+                "gantry_filename",
+                "optitrack_filename",
+                "alignment_params_filename",
+                "calibration_params_filename",
+            ]
+            if kwargs.get(name) and os.path.exists(kwargs[name])
+        ]
+        key = get_cache_key(filenames, **kwargs)
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        # Concurrent requests of the same take wait for a single processing
+        with key_lock:
+            with self.lock:
+                if key in self.takes:
+                    self.takes.move_to_end(key)
+                    return self.takes[key][1].meta
+
+            logger.info("Processing take %s: %s", key, kwargs)
+            df, num_markers = get_processed_data(**kwargs)
+            take = to_shared_memory(cast(pd.DataFrame, df))
+            take.meta.update(key=key, num_markers=num_markers)
+
+            with self.lock:
+                self.takes[key] = (kwargs, take)
+                while len(self.takes) > self.max_takes:
+                    self.drop_take(next(iter(self.takes)))
+
+            logger.info(
+                "Take %s resident: %d rows, %.1f MB",
+                key,
+                len(df),
+                take.shm.size / 2**20,
+            )
+            return take.meta
+
+    def drop_take(self, key: str):
+        """Remove a take, the caller holds the lock."""
+        _, take = self.takes.pop(key)
+        self.key_locks.pop(key, None)
+        take.shm.close()
+        take.shm.unlink()
+        logger.info("Take %s removed", key)
+
+    def server_close(self):
+        super().server_close()
+        with self.lock:
+            for key in list(self.takes):
+                self.drop_take(key)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class TakeRequestHandler(socketserver.StreamRequestHandler):
+    server: TakeServer
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.handle_request(json.loads(line))
+            except Exception as e:
+                logger.exception("Request failed")
+                response = {"error": f"{type(e).__name__}: {e}"}
+
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+            if response.get("shutdown"):
+                # The handlers run in their own threads, so this waits for
+                # serve_forever to return, after the response is sent
+                self.server.shutdown()
+                return
+
+    def handle_request(self, request: dict[str, Any]) -> dict[str, Any]:
+        op = request.get("op")
+        if op == "get":
+            return self.server.get_take(request["kwargs"])
+
+        if op == "list":
+            with self.server.lock:
+                return {
+                    "takes": [
+                        {"kwargs": kwargs, **take.meta}
+                        for kwargs, take in self.server.takes.values()
+                    ]
+                }
+
+        if op == "drop":
+            with self.server.lock:
+                if request["key"] in self.server.takes:
+                    self.server.drop_take(request["key"])
+            return {}
+
+        if op == "shutdown":
+            return {"shutdown": True}
+
+        raise ValueError(f"Unknown op {op}")
+
+
+def request(socket_path: str, message: dict[str, Any]) -> dict[str, Any]:
+    """Send a request to the take server and return its response.
+
+    Raises:
+        OSError: If the server is not running
+        TakeServerError: If the request failed on the server
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as f:
+            f.write(json.dumps(message).encode() + b"\n")
+            f.flush()
+            line = f.readline()
+
+    if not line:
+        raise TakeServerError("Connection closed by the take server")
+
+    response = json.loads(line)
+    if "error" in response:
+        raise TakeServerError(response["error"])
+
+    return response
+
+
+def load_processed_data(
+    take_server: Optional[str],
+    gantry_filename: str,
+    optitrack_filename: str,
+    alignment_params_filename: Optional[str] = None,
+    calibration_params_filename: Optional[str] = None,
+    lazy: bool = False,
+    columns: Optional[Sequence[str]] = None,
+    time_window: Optional[tuple[float, float]] = None,
+    processed_take: Optional[str] = None,
+    **kwargs,
+) -> tuple[Union[pd.DataFrame, Any], int]:
+    """get_processed_data, from a processed take or the take server if given.
+
+    The server holds the whole processed take, and the dataframe returned has
+    views of its shared memory, so it is not copied, unless it is written to.
+    The columns and the time window are selected from it. If the server is not
+    running, the take is processed by this process.
+
+    With processed_take, the take is memory-mapped from this directory if it
+    was saved with the same arguments and files, see
+    processed_take.get_take_key. A calibrated take is also used without
+    calibrate. Otherwise, the take is processed and saved to it, calibrated if
+    the calibration parameters file exists, so it serves both requests.
+
+    Args:
+        take_server: Path of the socket of the take server, or None to process
+            the take in this process
+        processed_take: Optional directory of the processed take
+        gantry_filename, optitrack_filename, alignment_params_filename,
+        calibration_params_filename, lazy, columns, time_window, kwargs:
+            Arguments of get_processed_data
+
+    Returns:
+        tuple[Union[pd.DataFrame, LazyFrame], int]: The processed data and the
+            number of markers, see get_processed_data
+    """
+    filenames = {
+        "gantry_filename": gantry_filename,
+        "optitrack_filename": optitrack_filename,
+        "alignment_params_filename": alignment_params_filename,
+        "calibration_params_filename": calibration_params_filename,
+    }
+
+    if processed_take is not None:
+        keys = get_take_keys({**filenames, **kwargs})
+        while True:
+            # The schema and the columns are of the same version of the take
+            take_path = os.path.realpath(processed_take)
+            schema = load_schema(take_path)
+            if schema is None and os.path.realpath(processed_take) != take_path:
+                continue
+            if schema is None or schema["key"] not in keys:
+                break
+
+            try:
+                df, _ = load_processed_take(take_path, columns, time_window)
+                return df, schema["num_markers"]
+            except FileNotFoundError:
+                # Replaced by a newer version while it was opened
+                if os.path.realpath(processed_take) == take_path:
+                    raise
+
+        if (
+            not kwargs.get("calibrate")
+            and calibration_params_filename
+            and os.path.exists(calibration_params_filename)
+        ):
+            kwargs = {**kwargs, "calibrate": True}
+
+        df, num_markers = load_processed_data(take_server, **filenames, **kwargs)
+
+        # After the processing, which may have saved the parameters files
+        alignment_params, calibration_params = [
+            np.load(f) if f and os.path.exists(f) else None
+            for f in [alignment_params_filename, calibration_params_filename]
+        ]
+        take_path = save_processed_take(
+            processed_take,
+            cast(pd.DataFrame, df),
+            num_markers,
+            alignment_params,
+            calibration_params if kwargs.get("calibrate") else None,
+            key=get_take_key({**filenames, **kwargs}),
+        )
+        logger.info("Processed take saved to %s", processed_take)
+
+        df, _ = load_processed_take(take_path, columns, time_window)
+        return df, num_markers
+
+    if take_server is not None:
+        # The server may run in another directory
+        server_kwargs = {
+            name: os.path.abspath(f) if f else f for name, f in filenames.items()
+        }
+        server_kwargs.update(kwargs)
+        if kwargs.get("resample_cache_filename"):
+            server_kwargs["resample_cache_filename"] = os.path.abspath(
+                kwargs["resample_cache_filename"]
+            )
+
+        try:
+            meta = request(take_server, {"op": "get", "kwargs": server_kwargs})
+        except OSError as e:
+            logger.warning(
+                "Cannot connect to the take server %s (%s), processing the take",
+                take_server,
+                e,
+            )
+        else:
+            df = from_shared_memory(meta)
+            if time_window is not None:
+                df = df[df["time"].between(*time_window)]
+            if columns is not None:
+                df = df[list(columns)]
+            return df, meta["num_markers"]
+
+    from data import get_processed_data
+
+    return get_processed_data(
+        **filenames,
+        lazy=lazy,
+        columns=columns,
+        time_window=time_window,
+        **kwargs,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve processed takes in shared memory, so the plot tools "
+        "attach to them instead of processing them again",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--socket", type=str, default=DEFAULT_SOCKET, help="Path of the Unix socket"
+    )
+    parser.add_argument(
+        "--max-takes",
+        type=int,
+        default=8,
+        help="Maximum number of resident takes, the least recently used are removed",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="List the takes of the running server instead of starting one",
+    )
+    parser.add_argument(
+        "--shutdown",
+        action="store_true",
+        help="Stop the running server instead of starting one",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.list:
+        for take in request(args.socket, {"op": "list"})["takes"]:
+            size = sum(
+                np.dtype(dtype).itemsize * take["num_rows"]
+                for _, dtype, _ in take["columns"]
+            )
+            print(
+                f"{take['key']}: {take['num_rows']} rows, "
+                f"{len(take['columns'])} columns, {size / 2**20:.1f} MB"
+            )
+            for name, value in take["kwargs"].items():
+                print(f"  {name}: {value}")
+    elif args.shutdown:
+        request(args.socket, {"op": "shutdown"})
+    else:
+        with TakeServer(args.socket, args.max_takes) as server:
+            logger.info("Take server listening on %s", args.socket)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
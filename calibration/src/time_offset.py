@@ -0,0 +1,462 @@
+import argparse
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from coordinates_utils import InterpKernel
+from profiling import profile_section
+
+
+@dataclass
+class ClockOffset:
+    """Time offset between two streams with a linear clock drift.
+
+    The offset at time t is offset + drift * (t - t_ref), such that
+    pos_ref(t) = pos_other(t - offset(t)), i.e., the t_shift of
+    TransformShiftT that aligns the other stream with the reference.
+    """
+
+    offset: float
+    drift: float = 0.0
+    t_ref: float = 0.0
+
+    def shift(self, t: npt.ArrayLike) -> np.ndarray:
+        return self.offset + self.drift * (np.asarray(t) - self.t_ref)
+
+
+def get_speed_profile(
+    t: npt.ArrayLike, pos: npt.ArrayLike, t_grid: np.ndarray
+) -> np.ndarray:
+    """Speed of a trajectory resampled on a uniform time grid.
+
+    The positions are resampled before differentiating to reduce the noise of
+    the speed. The speed is invariant to rotations and translations, so the
+    streams can be correlated before aligning them in space.
+
+    Args:
+        t: Time of the samples with shape (N,)
+        pos: Positions with shape (N, 3), invalid samples are NaN
+        t_grid: Uniform time grid
+
+    Returns:
+        np.ndarray: Speed at each time of the grid, NaN out of the time range of
+            the valid samples.
+    """
+    t = np.asarray(t, dtype=np.float64)
+    pos = np.asarray(pos, dtype=np.float64)
+    valid = np.isfinite(t) & np.isfinite(pos).all(axis=1)
+
+    pos_grid = InterpKernel(t_grid, t[valid])(pos[valid])
+    return np.linalg.norm(np.gradient(pos_grid, t_grid, axis=0), axis=1)
+
+
+def xcorr_lags(
+    a: np.ndarray,
+    b: np.ndarray,
+    dt: float,
+    max_lag: Optional[float] = None,
+    min_overlap: float = 0.25,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Lag between rows of signals with normalized FFT cross-correlation.
+
+    The lag maximizes the correlation coefficient between a(t) and b(t - lag)
+    computed over the overlap of the valid (not NaN) samples, and it is refined
+    to sub-sample resolution with a parabola through the peak.
+
+    Args:
+        a: Signals with shape (W, N) or (N,), sampled every dt
+        b: Signals with the same shape as a
+        dt: Sample period
+        max_lag: Maximum absolute lag to consider, all lags if None
+        min_overlap: Minimum overlap of the valid samples, as a fraction of the
+            valid samples of the shortest signal
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Lag and peak correlation coefficient of
+            each row, NaN if no lag has enough overlap.
+    """
+    a = np.atleast_2d(a)
+    b = np.atleast_2d(b)
+    n = a.shape[1]
+    nfft = 1 << int(np.ceil(np.log2(2 * n)))
+
+    mask_a = np.isfinite(a)
+    mask_b = np.isfinite(b)
+    a = np.where(mask_a, a - np.nanmean(a, axis=1, keepdims=True), 0.0)
+    b = np.where(mask_b, b - np.nanmean(b, axis=1, keepdims=True), 0.0)
+
+    def xcorr(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        # c[k] = sum_t x[t] y[t - k], with negative lags at the end
+        c = np.fft.irfft(np.fft.rfft(x, nfft) * np.conj(np.fft.rfft(y, nfft)), nfft)
+        return np.concatenate([c[:, nfft - n + 1 :], c[:, :n]], axis=1)
+
+    fa, fb = mask_a.astype(np.float64), mask_b.astype(np.float64)
+    c = xcorr(a, b)
+    energy = xcorr(a**2, fb) * xcorr(fa, b**2)
+    overlap = xcorr(fa, fb)
+
+    lags = np.arange(-n + 1, n)
+    min_count = min_overlap * np.minimum(fa.sum(axis=1), fb.sum(axis=1))[:, None]
+    valid = (overlap >= np.maximum(min_count, 3)) & (energy > 0)
+    if max_lag is not None:
+        valid &= np.abs(lags * dt) <= max_lag
+
+    rho = np.full(c.shape, -np.inf)
+    rho[valid] = c[valid] / np.sqrt(energy[valid])
+
+    best = np.argmax(rho, axis=1)
+    rows = np.arange(len(rho))
+    peak = rho[rows, best]
+
+    # Parabolic interpolation of the peak
+    left = rho[rows, np.maximum(best - 1, 0)]
+    right = rho[rows, np.minimum(best + 1, len(lags) - 1)]
+    denom = left - 2 * peak + right
+    with np.errstate(invalid="ignore", divide="ignore"):
+        delta = np.where(
+            np.isfinite(left) & np.isfinite(right) & (denom < 0),
+            0.5 * (left - right) / denom,
+            0.0,
+        )
+
+    lag = (lags[best] + delta) * dt
+    found = np.isfinite(peak)
+    return np.where(found, lag, np.nan), np.where(found, peak, np.nan)
+
+
+def estimate_time_offset(
+    t_ref: npt.ArrayLike,
+    pos_ref: npt.ArrayLike,
+    t_other: npt.ArrayLike,
+    pos_other: npt.ArrayLike,
+    rate: float = 50.0,
+    max_lag: Optional[float] = None,
+) -> float:
+    """Time offset between two streams from the cross-correlation of their speed.
+
+    Args:
+        t_ref: Time of the reference samples, e.g., the gantry
+        pos_ref: Reference positions with shape (N, 3)
+        t_other: Time of the other samples, e.g., the OptiTrack rigid body
+        pos_other: Other positions with shape (M, 3)
+        rate: Rate of the common time grid (Hz)
+        max_lag: Maximum absolute offset (s), any if None
+
+    Returns:
+        float: Offset such that pos_ref(t) = pos_other(t - offset), i.e., the
+            t_shift of TransformShiftT applied to the other stream.
+    """
+    t_ref = np.asarray(t_ref, dtype=np.float64)
+    t_other = np.asarray(t_other, dtype=np.float64)
+    t_min = min(np.nanmin(t_ref), np.nanmin(t_other))
+    t_max = max(np.nanmax(t_ref), np.nanmax(t_other))
+    t_grid = np.arange(t_min, t_max, 1 / rate)
+
+    speed_ref = get_speed_profile(t_ref, pos_ref, t_grid)
+    speed_other = get_speed_profile(t_other, pos_other, t_grid)
+
+    lag, _ = xcorr_lags(speed_ref, speed_other, 1 / rate, max_lag)
+    return float(lag[0])
+
+
+def estimate_window_offsets(
+    t_ref: npt.ArrayLike,
+    pos_ref: npt.ArrayLike,
+    t_other: npt.ArrayLike,
+    pos_other: npt.ArrayLike,
+    offset: float,
+    window: float = 120.0,
+    max_lag: float = 1.0,
+    rate: float = 50.0,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Time offset of each window of the reference stream.
+
+    The other stream is first shifted by the global offset, then the residual
+    offset of all the windows is found with a single batched cross-correlation
+    limited to max_lag. Consecutive windows overlap by half their length.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Center time, offset and peak
+            correlation coefficient of each window.
+    """
+    t_ref = np.asarray(t_ref, dtype=np.float64)
+    t_grid = np.arange(np.nanmin(t_ref), np.nanmax(t_ref), 1 / rate)
+
+    speed_ref = get_speed_profile(t_ref, pos_ref, t_grid)
+    speed_other = get_speed_profile(
+        np.asarray(t_other, dtype=np.float64) + offset, pos_other, t_grid
+    )
+
+    size = int(round(window * rate))
+    step = max(1, size // 2)
+    num = max(1, (len(t_grid) - size) // step + 1)
+    idx = np.arange(num)[:, None] * step + np.arange(min(size, len(t_grid)))
+
+    lag, peak = xcorr_lags(speed_ref[idx], speed_other[idx], 1 / rate, max_lag)
+    return t_grid[idx].mean(axis=1), offset + lag, peak
+
+
+@profile_section("estimate_clock_offset")
+def estimate_clock_offset(
+    t_ref: npt.ArrayLike,
+    pos_ref: npt.ArrayLike,
+    t_other: npt.ArrayLike,
+    pos_other: npt.ArrayLike,
+    drift: bool = False,
+    window: float = 120.0,
+    max_lag: Optional[float] = None,
+    rate: float = 50.0,
+    min_peak: float = 0.5,
+) -> ClockOffset:
+    """Time offset between two streams, optionally with a linear clock drift.
+
+    The drift is the slope of a line fitted to the offsets of windows of the
+    take, weighted by their correlation peak. Windows with a peak correlation
+    below min_peak, e.g., without motion, are ignored.
+    """
+    offset = estimate_time_offset(t_ref, pos_ref, t_other, pos_other, rate, max_lag)
+    if not drift:
+        return ClockOffset(offset)
+
+    t_win, offsets, peak = estimate_window_offsets(
+        t_ref, pos_ref, t_other, pos_other, offset, window, rate=rate
+    )
+    valid = np.isfinite(offsets) & (peak >= min_peak)
+    if np.count_nonzero(valid) < 2:
+        return ClockOffset(offset)
+
+    t_win, offsets, w = t_win[valid], offsets[valid], peak[valid]
+    t_ref_drift = float(np.average(t_win, weights=w))
+    slope, intercept = np.polyfit(t_win - t_ref_drift, offsets, 1, w=w)
+
+    return ClockOffset(float(intercept), float(slope), t_ref_drift)
+
+
+@profile_section("fit_time_warp")
+def fit_time_warp(
+    t_ref: npt.ArrayLike,
+    pos_ref: npt.ArrayLike,
+    t_other: npt.ArrayLike,
+    pos_other: npt.ArrayLike,
+    window: float = 60.0,
+    max_lag: Optional[float] = None,
+    window_max_lag: float = 1.0,
+    rate: float = 50.0,
+    min_peak: float = 0.5,
+    max_deviation: float = 3.0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Piecewise linear time offset between two streams.
+
+    The knots of the time warp are the centers of the windows of the take with
+    the offset found by cross-correlation. Windows with a peak correlation below
+    min_peak, e.g., without motion, and outliers whose offset deviates more than
+    max_deviation times the median absolute deviation from the median of their
+    neighbours are discarded.
+
+    Args:
+        t_ref: Time of the reference samples, e.g., the gantry
+        pos_ref: Reference positions with shape (N, 3)
+        t_other: Time of the other samples, e.g., the OptiTrack rigid body
+        pos_other: Other positions with shape (M, 3)
+        window: Length of the windows (s)
+        max_lag: Maximum absolute global offset (s), any if None
+        window_max_lag: Maximum deviation of a window from the global offset (s)
+        rate: Rate of the common time grid (Hz)
+        min_peak: Minimum peak correlation coefficient of a window
+        max_deviation: Outlier threshold in median absolute deviations
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Time and offset of the knots, as used by
+            TransformTimeWarp applied to the other stream.
+    """
+    offset = estimate_time_offset(t_ref, pos_ref, t_other, pos_other, rate, max_lag)
+    t_win, offsets, peak = estimate_window_offsets(
+        t_ref, pos_ref, t_other, pos_other, offset, window, window_max_lag, rate
+    )
+
+    valid = np.isfinite(offsets) & (peak >= min_peak)
+    t_win, offsets = t_win[valid], offsets[valid]
+    if len(offsets) < 3:
+        t_mid = float(np.nanmean(np.asarray(t_ref, dtype=np.float64)))
+        return np.array([t_mid]), np.array([offset])
+
+    # Median of each window and its two neighbours
+    padded = np.pad(offsets, 1, mode="edge")
+    neighbours = np.median(np.lib.stride_tricks.sliding_window_view(padded, 3), axis=1)
+    deviation = np.abs(offsets - neighbours)
+    mad = np.median(deviation)
+    inlier = deviation <= max_deviation * max(mad, 1 / rate)
+
+    return t_win[inlier], offsets[inlier]
+
+
+@profile_section("refine_time_warp")
+def refine_time_warp(
+    t_ref: npt.ArrayLike,
+    pos_ref: npt.ArrayLike,
+    t_other: npt.ArrayLike,
+    pos_other: npt.ArrayLike,
+    knots: tuple[np.ndarray, np.ndarray],
+    window: float = 60.0,
+    linear: bool = False,
+    search: float = 0.15,
+    step: float = 0.002,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Refine a time warp by the distance between the aligned positions.
+
+    The offsets of the cross-correlation of the speeds are only accurate to a
+    few samples of their grid, so the offset of each window is searched again
+    around the warp on a finer grid, as the minimum of the mean distance between
+    the reference positions and the other positions, and it is refined with a
+    parabola through the minimum. The streams must be aligned in space.
+
+    Args:
+        t_ref: Time of the reference samples, e.g., the gantry
+        pos_ref: Reference positions with shape (N, 3)
+        t_other: Time of the other samples, e.g., the aligned OptiTrack rigid body
+        pos_other: Other positions with shape (M, 3)
+        knots: Time and offset of the knots of the warp
+        window: Length of the windows (s). The windows are centered on the knots,
+            or with linear, they overlap by half their length over the take
+        linear: Whether the warp is a linear clock drift, fitted to the offsets of
+            the windows
+        search: Maximum deviation of the offsets from the warp (s)
+        step: Step of the grid of the offsets (s)
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Time and offset of the knots of the
+            refined warp, the same times with linear.
+    """
+    t_ref = np.asarray(t_ref, dtype=np.float64)
+    pos_ref = np.asarray(pos_ref, dtype=np.float64)
+    t_other = np.asarray(t_other, dtype=np.float64)
+    pos_other = np.asarray(pos_other, dtype=np.float64)
+    valid_ref = np.isfinite(t_ref) & np.isfinite(pos_ref).all(axis=1)
+    valid_other = np.isfinite(t_other) & np.isfinite(pos_other).all(axis=1)
+    t_ref, pos_ref = t_ref[valid_ref], pos_ref[valid_ref]
+    t_other, pos_other = t_other[valid_other], pos_other[valid_other]
+
+    knots_t, knots_shift = knots
+    if linear:
+        t_min, t_max = t_ref.min(), t_ref.max()
+        num = max(1, int((t_max - t_min - window) // (window / 2)) + 1)
+        t_win = t_min + window / 2 + np.arange(num) * window / 2
+    else:
+        t_win = knots_t
+
+    deltas = np.arange(-search, search + step / 2, step)
+    offsets = np.interp(t_win, knots_t, knots_shift)
+    for i, t_center in enumerate(t_win):
+        in_window = np.abs(t_ref - t_center) <= window / 2
+        if np.count_nonzero(in_window) < 3:
+            continue
+
+        # Mean distance of each offset, pos_ref(t) = pos_other(t - offset)
+        t_shifted = t_ref[in_window] - (offsets[i] + deltas)[:, None]
+        dist = np.zeros(t_shifted.shape)
+        for axis in range(3):
+            interp = np.interp(t_shifted, t_other, pos_other[:, axis])
+            dist += (pos_ref[in_window, axis] - interp) ** 2
+        mean_dist = np.sqrt(dist).mean(axis=1)
+
+        # Parabolic interpolation of the minimum
+        best = int(np.argmin(mean_dist))
+        delta = deltas[best]
+        if 0 < best < len(deltas) - 1:
+            left, right = mean_dist[best - 1], mean_dist[best + 1]
+            denom = left - 2 * mean_dist[best] + right
+            if denom > 0:
+                delta += 0.5 * (left - right) / denom * step
+        offsets[i] += delta
+
+    if not linear:
+        return t_win, offsets
+    if len(t_win) < 2:
+        return knots_t, knots_shift + offsets[0] - np.interp(t_win[0], *knots)
+
+    slope, intercept = np.polyfit(t_win, offsets, 1)
+    return knots_t, intercept + slope * knots_t
+
+
+if __name__ == "__main__":
+    import logging
+
+    from data import load_gantry_data, load_optitrack_data, load_optitrack_metadata
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description="Estimate the time offset between the gantry and Optitrack data",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--optitrack",
+        type=str,
+        default="take_optitrack.csv",
+        help="Path to the CSV file with the Optitrack movement data",
+    )
+
+    parser.add_argument(
+        "--gantry",
+        type=str,
+        default="take_gantry.csv",
+        help="Path to CSV file with the gantry movement data",
+    )
+
+    parser.add_argument(
+        "--drift",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Fit a linear clock drift",
+    )
+
+    parser.add_argument(
+        "--window", type=float, default=120.0, help="Window of the drift fit (s)"
+    )
+
+    parser.add_argument(
+        "--time-warp",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Fit a piecewise linear time offset and print its knots",
+    )
+
+    parser.add_argument(
+        "--rate", type=float, default=50.0, help="Rate of the speed profiles (Hz)"
+    )
+
+    args = parser.parse_args()
+
+    df_optitrack, _ = load_optitrack_data(args.optitrack)
+    start_time = load_optitrack_metadata(args.optitrack)["Capture Start Time"]
+    df_gantry = load_gantry_data(args.gantry)
+
+    clock = estimate_clock_offset(
+        df_gantry["time"] - start_time.timestamp(),
+        df_gantry[["x", "y", "z"]],
+        df_optitrack["time"],
+        df_optitrack[["RB.X", "RB.Y", "RB.Z"]],
+        drift=args.drift,
+        window=args.window,
+        rate=args.rate,
+    )
+
+    print(f"Time offset: {clock.offset:.4f} s at t = {clock.t_ref:.1f} s")
+    print(f"Clock drift: {clock.drift * 1e6:.2f} ppm")
+
+    if args.time_warp:
+        knots_t, knots_shift = fit_time_warp(
+            df_gantry["time"] - start_time.timestamp(),
+            df_gantry[["x", "y", "z"]],
+            df_optitrack["time"],
+            df_optitrack[["RB.X", "RB.Y", "RB.Z"]],
+            window=args.window,
+            rate=args.rate,
+        )
+
+        print("\nTime warp knots:")
+        for t, shift in zip(knots_t, knots_shift):
+            print(f"{t:10.1f} s: {shift:.4f} s")
@@ -0,0 +1,642 @@
+"""Browser-based player for processed takes.
+
+The processed take is converted to compact float arrays and served by a local
+asyncio HTTP/WebSocket server. The page in web_player.html requests chunks of
+frames as binary WebSocket messages and renders the gantry, the rigid body and
+the markers with WebGL. Everything is served from localhost, so the player works
+fully offline. WebSocket requests from pages of other origins are rejected, so
+other pages open in the browser cannot connect to the player.
+
+WebSocket protocol:
+  - On connection the server sends a JSON text message with the take metadata,
+    followed by a binary message with the frame times.
+  - The page requests chunks with JSON text messages {"op": "chunk", "index": k}
+    and the server answers with a binary message per chunk.
+
+Binary messages start with a header of four little-endian int32 values:
+[message type, chunk index, first frame, number of frames]. Time messages
+(type 0) are followed by float64 times. Chunk messages (type 1) are followed by
+float32 positions with shape (slots, frames, 3), where the slots are: gantry,
+rigid body, rigid body markers and raw markers. Chunks include the first frame
+of the next chunk so that trails are continuous across chunks. Missing values
+are sent as INVALID_POS.
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import struct
+from dataclasses import dataclass
+from typing import Any, Optional
+from urllib.parse import urlsplit
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from argutils import (
+    add_processed_take_argument,
+    add_resample_arguments,
+    add_take_server_argument,
+    parse_limit,
+)
+from data import load_bad_frames
+from take_server import load_processed_data
+
+logger = logging.getLogger(__name__)
+
+INVALID_POS = 1e30
+
+MSG_TIME = 0
+MSG_CHUNK = 1
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_OP_CONT = 0x0
+WS_OP_TEXT = 0x1
+WS_OP_BINARY = 0x2
+WS_OP_CLOSE = 0x8
+WS_OP_PING = 0x9
+WS_OP_PONG = 0xA
+
+WS_CLOSE_POLICY_VIOLATION = 1008
+WS_CLOSE_MESSAGE_TOO_BIG = 1009
+
+# Maximum size of a message of the page, which only sends small JSON requests
+WS_MAX_MESSAGE_SIZE = 1 << 16
+
+# Hosts of the pages allowed to open the WebSocket, other pages open in the
+# browser must not be able to drive the player
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+HTML_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "web_player.html")
+
+
+@dataclass
+class TakeArrays:
+    """Arrays of a processed take in the layout streamed to the page.
+
+    Attributes:
+        time: Frame times relative to the first frame, shape (frames,)
+        positions: Positions with shape (slots, frames, 3) where the slots are
+            the gantry, the rigid body, the rigid body markers and the raw markers
+        num_markers: Number of markers of the rigid body
+    """
+
+    time: npt.NDArray[np.float64]
+    positions: npt.NDArray[np.float32]
+    num_markers: int
+
+    @property
+    def num_frames(self) -> int:
+        return len(self.time)
+
+
+def get_take_arrays(
+    df: pd.DataFrame, num_markers: int, show_calibrated: bool = True
+) -> TakeArrays:
+    """Convert a processed take into the arrays streamed to the page.
+
+    Args:
+        df: Processed take as returned by get_processed_data
+        num_markers: Number of markers of the rigid body
+        show_calibrated: Whether to use the calibrated gantry position
+    """
+    sep = ".CALIBRATED." if show_calibrated else "."
+    slot_cols = [
+        (f"GAN{sep}X", f"GAN{sep}Y", f"GAN{sep}Z"),
+        ("RB.X", "RB.Y", "RB.Z"),
+        *[(f"RB.X{i}", f"RB.Y{i}", f"RB.Z{i}") for i in range(1, num_markers + 1)],
+        *[(f"M.X{i}", f"M.Y{i}", f"M.Z{i}") for i in range(1, num_markers + 1)],
+    ]
+
+    cols = [col for cols in slot_cols for col in cols]
+    positions = df[cols].to_numpy(dtype=np.float32).reshape(len(df), len(slot_cols), 3)
+    positions = np.ascontiguousarray(positions.transpose(1, 0, 2))
+    positions[np.isnan(positions)] = INVALID_POS
+
+    time = df["time"].to_numpy(dtype=np.float64)
+
+    return TakeArrays(time - time[0], positions, num_markers)
+
+
+def get_num_chunks(take: TakeArrays, chunk_frames: int) -> int:
+    return -(-take.num_frames // chunk_frames)
+
+
+def get_chunk_message(take: TakeArrays, index: int, chunk_frames: int) -> bytes:
+    """Binary message with the positions of a chunk of frames.
+
+    Raises:
+        ValueError: If the index is not the index of a chunk of the take
+    """
+    if not 0 <= index < get_num_chunks(take, chunk_frames):
+        raise ValueError(f"Invalid chunk index: {index}")
+
+    start = index * chunk_frames
+    end = min(take.num_frames, start + chunk_frames + 1)
+    data = take.positions[:, start:end, :]
+    header = struct.pack("<4i", MSG_CHUNK, index, start, end - start)
+    return header + data.astype("<f4", copy=False).tobytes()
+
+
+def get_time_message(take: TakeArrays) -> bytes:
+    """Binary message with the times of all the frames."""
+    header = struct.pack("<4i", MSG_TIME, 0, 0, take.num_frames)
+    return header + take.time.astype("<f8", copy=False).tobytes()
+
+
+def ws_accept_key(key: str) -> str:
+    """Value of the Sec-WebSocket-Accept header for a Sec-WebSocket-Key."""
+    digest = hashlib.sha1((key + WS_GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+
+def is_allowed_origin(origin: Optional[str], hosts: set[str]) -> bool:
+    """Whether the Origin header of a WebSocket request is a page of the hosts.
+
+    Requests without an Origin do not come from a browser page and are allowed.
+    """
+    if origin is None:
+        return True
+
+    try:
+        return urlsplit(origin).hostname in hosts
+    except ValueError:
+        return False
+
+
+def ws_encode_frame(opcode: int, payload: bytes) -> bytes:
+    """Encode an unmasked and unfragmented WebSocket frame."""
+    length = len(payload)
+
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+    return header + payload
+
+
+class WebSocketError(Exception):
+    """Protocol error of a WebSocket connection, closed with the status code."""
+
+    def __init__(self, code: int, reason: str):
+        super().__init__(reason)
+        self.code = code
+        self.reason = reason
+
+
+def ws_close_payload(code: int, reason: str = "") -> bytes:
+    return struct.pack("!H", code) + reason.encode()[:123]
+
+
+async def ws_read_message(
+    reader: asyncio.StreamReader, max_size: int = WS_MAX_MESSAGE_SIZE
+) -> tuple[int, bytes]:
+    """Read a (possibly fragmented) WebSocket message.
+
+    Control frames interleaved with the fragments of a message are returned
+    immediately.
+
+    Raises:
+        WebSocketError: If the message is longer than max_size bytes, checked
+            before reading its frames
+    """
+    message_opcode: Optional[int] = None
+    payload = bytearray()
+
+    while True:
+        b0, b1 = await reader.readexactly(2)
+        fin = b0 & 0x80
+        opcode = b0 & 0x0F
+        length = b1 & 0x7F
+
+        if length == 126:
+            (length,) = struct.unpack("!H", await reader.readexactly(2))
+        elif length == 127:
+            (length,) = struct.unpack("!Q", await reader.readexactly(8))
+
+        if len(payload) + length > max_size:
+            raise WebSocketError(
+                WS_CLOSE_MESSAGE_TOO_BIG, f"Message larger than {max_size} bytes"
+            )
+
+        mask = await reader.readexactly(4) if b1 & 0x80 else None
+        data = await reader.readexactly(length)
+
+        if mask is not None:
+            mask_array = np.resize(np.frombuffer(mask, np.uint8), length)
+            data = (np.frombuffer(data, np.uint8) ^ mask_array).tobytes()
+
+        if opcode >= WS_OP_CLOSE:
+            return opcode, data
+
+        if opcode != WS_OP_CONT:
+            message_opcode = opcode
+
+        payload += data
+
+        if fin and message_opcode is not None:
+            return message_opcode, bytes(payload)
+
+
+class WebPlayerServer:
+    """Local HTTP/WebSocket server for the browser-based player.
+
+    Args:
+        take: Arrays of the processed take
+        chunk_frames: Number of frames of each chunk
+        bounds: Axis limits of the scene as ((xmin, xmax), (ymin, ymax), (zmin, zmax))
+        trail_before_samples: Number of samples of the trails before the current frame
+        trail_after_samples: Number of samples of the trails after the current frame
+    """
+
+    def __init__(
+        self,
+        take: TakeArrays,
+        chunk_frames: int = 4096,
+        bounds: Optional[list[tuple[float, float]]] = None,
+        trail_before_samples: int = 2000,
+        trail_after_samples: int = 0,
+    ):
+        self.take = take
+        self.chunk_frames = chunk_frames
+        self.bounds = bounds
+        self.trail_before_samples = trail_before_samples
+        self.trail_after_samples = trail_after_samples
+        self.origin_hosts = set(LOCAL_HOSTS)
+
+    def get_metadata(self) -> dict[str, Any]:
+        bounds = self.bounds
+        if bounds is None:
+            pos = self.take.positions.reshape(-1, 3)
+            pos = pos[np.all(pos < INVALID_POS, axis=1)]
+            bounds = [(float(pos[:, i].min()), float(pos[:, i].max())) for i in range(3)]
+
+        return {
+            "num_frames": self.take.num_frames,
+            "num_markers": self.take.num_markers,
+            "num_slots": self.take.positions.shape[0],
+            "chunk_frames": self.chunk_frames,
+            "num_chunks": get_num_chunks(self.take, self.chunk_frames),
+            "bounds": bounds,
+            "trail_before_samples": self.trail_before_samples,
+            "trail_after_samples": self.trail_after_samples,
+            "invalid_pos": INVALID_POS,
+        }
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+
+        request_line, *header_lines = request.decode("latin-1").split("\r\n")
+        headers = {
+            name.strip().lower(): value.strip()
+            for name, _, value in (line.partition(":") for line in header_lines if line)
+        }
+
+        try:
+            method, path, _ = request_line.split(" ", 2)
+        except ValueError:
+            writer.close()
+            return
+
+        if method != "GET":
+            await self.send_http(writer, 405, "text/plain", b"Method Not Allowed")
+        elif headers.get("upgrade", "").lower() == "websocket":
+            if "sec-websocket-key" not in headers:
+                await self.send_http(writer, 400, "text/plain", b"Bad Request")
+            elif not is_allowed_origin(headers.get("origin"), self.origin_hosts):
+                await self.send_http(writer, 403, "text/plain", b"Forbidden")
+            else:
+                await self.handle_websocket(reader, writer, headers)
+        elif path in ("/", "/index.html"):
+            with open(HTML_FILE, "rb") as f:
+                await self.send_http(writer, 200, "text/html; charset=utf-8", f.read())
+        else:
+            await self.send_http(writer, 404, "text/plain", b"Not Found")
+
+    async def send_http(
+        self, writer: asyncio.StreamWriter, status: int, content_type: str, body: bytes
+    ):
+        reason = {
+            200: "OK",
+            400: "Bad Request",
+            403: "Forbidden",
+            404: "Not Found",
+            405: "Method Not Allowed",
+        }[status]
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Cache-Control: no-store\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode()
+            + body
+        )
+        await writer.drain()
+        writer.close()
+
+    async def handle_websocket(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        headers: dict[str, str],
+    ):
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {ws_accept_key(headers['sec-websocket-key'])}"
+                "\r\n\r\n"
+            ).encode()
+        )
+
+        writer.write(
+            ws_encode_frame(WS_OP_TEXT, json.dumps(self.get_metadata()).encode())
+        )
+        writer.write(ws_encode_frame(WS_OP_BINARY, get_time_message(self.take)))
+        await writer.drain()
+
+        try:
+            while True:
+                opcode, payload = await ws_read_message(reader)
+
+                if opcode == WS_OP_CLOSE:
+                    writer.write(ws_encode_frame(WS_OP_CLOSE, payload[:2]))
+                    break
+                elif opcode == WS_OP_PING:
+                    writer.write(ws_encode_frame(WS_OP_PONG, payload))
+                elif opcode == WS_OP_TEXT:
+                    message = self.get_response(payload)
+                    if message is not None:
+                        writer.write(ws_encode_frame(WS_OP_BINARY, message))
+
+                await writer.drain()
+        except WebSocketError as e:
+            logger.warning("Closing the WebSocket connection: %s", e.reason)
+            writer.write(
+                ws_encode_frame(WS_OP_CLOSE, ws_close_payload(e.code, e.reason))
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def get_response(self, payload: bytes) -> Optional[bytes]:
+        """Binary message answering a request of the page, None if it has none.
+
+        Raises:
+            WebSocketError: If the request is not valid
+        """
+        try:
+            request = json.loads(payload)
+            if not isinstance(request, dict):
+                raise ValueError("The request is not an object")
+
+            if request.get("op") != "chunk":
+                return None
+
+            index = request.get("index")
+            if not isinstance(index, int) or isinstance(index, bool):
+                raise ValueError(f"Invalid chunk index: {index!r}")
+            return get_chunk_message(self.take, index, self.chunk_frames)
+        except ValueError as e:
+            raise WebSocketError(WS_CLOSE_POLICY_VIOLATION, f"Bad request: {e}")
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765):
+        # The page is served from the host address too if it is not local
+        self.origin_hosts.add(host)
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print(f"Serving the take player on http://{host}:{port}/")
+
+        async with server:
+            await server.serve_forever()
+
+
+def web_player(
+    gantry_file: str,
+    optitrack_file: str,
+    alignment_params_file: str,
+    calibration_params_file: str,
+    remove_bad_frames: bool = False,
+    bad_frames_file: str = "bad_frames.json",
+    show_calibrated: bool = True,
+    trail_before_samples: int = 2000,
+    trail_after_samples: int = 0,
+    chunk_frames: int = 4096,
+    bounds: Optional[list[tuple[float, float]]] = None,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    take_server: Optional[str] = None,
+    processed_take: Optional[str] = None,
+    resample_rate: Optional[float] = None,
+    anti_alias: bool = True,
+    resample_cache_file: Optional[str] = None,
+):
+    """Serve the browser-based player for a processed take.
+
+    Args:
+        gantry_file: Path to the gantry CSV file
+        optitrack_file: Path to the Optitrack CSV file
+        alignment_params_file: Path to the alignment parameters file
+        calibration_params_file: Path to the calibration parameters file
+        remove_bad_frames: Whether to remove bad frames from the data
+        bad_frames_file: Path to the bad frames file
+        show_calibrated: Whether to show the gantry position after calibration
+        trail_before_samples: Number of previous samples to show for the trails
+        trail_after_samples: Number of next samples to show for the trails
+        chunk_frames: Number of frames of each streamed chunk
+        bounds: Optional axis limits as ((xmin, xmax), (ymin, ymax), (zmin, zmax))
+        host: Host address of the server
+        port: Port of the server
+        take_server: Optional socket of the take server to get the data from
+        processed_take: Optional directory of the processed take
+        resample_rate: Optional rate (Hz) of a uniform time grid to resample the
+            take on, as in run_calibration.py --resample-rate
+        anti_alias: Whether to low-pass filter the streams before resampling
+        resample_cache_file: Optional path of a .npz file to cache the
+            resampled data
+    """
+    bad_frames = None
+    if remove_bad_frames:
+        bad_frames = load_bad_frames(bad_frames_file)
+
+    df, num_markers = load_processed_data(
+        take_server,
+        gantry_file,
+        optitrack_file,
+        alignment_params_file,
+        calibration_params_file,
+        bad_frames=bad_frames,
+        calibrate=True,
+        processed_take=processed_take,
+        resample_rate=resample_rate,
+        anti_alias=anti_alias,
+        resample_cache_filename=resample_cache_file,
+    )
+
+    take = get_take_arrays(df, num_markers, show_calibrated)
+    del df
+
+    server = WebPlayerServer(
+        take,
+        chunk_frames=chunk_frames,
+        bounds=bounds,
+        trail_before_samples=trail_before_samples,
+        trail_after_samples=trail_after_samples,
+    )
+
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description="Play the gantry and Optitrack movement in the browser",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--gantry",
+        help="Path to the CSV file with the gantry movement data",
+        type=str,
+        default="take_gantry.csv",
+    )
+
+    parser.add_argument(
+        "--optitrack",
+        help="Path to the CSV file with the Optitrack movement data",
+        type=str,
+        default="take_optitrack.csv",
+    )
+
+    parser.add_argument(
+        "--alignment",
+        help="Path to the alignment parameters file",
+        type=str,
+        default="alignment_params.npy",
+    )
+
+    parser.add_argument(
+        "--calibration",
+        help="Path to the calibration parameters file",
+        type=str,
+        default="calibration_params.npy",
+    )
+
+    parser.add_argument(
+        "--show-calibrated",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Show the gantry position after calibration",
+    )
+
+    parser.add_argument(
+        "--trail-before",
+        help="Number of previous samples to show before the current frame",
+        type=int,
+        default=2000,
+    )
+
+    parser.add_argument(
+        "--trail-after",
+        help="Number of previous samples to show after the current frame",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--remove-bad-frames",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Remove bad frames from the data",
+    )
+
+    parser.add_argument(
+        "--bad-frames",
+        type=str,
+        default="bad_frames.json",
+        help="Path to bad frames data file",
+    )
+
+    parser.add_argument(
+        "--chunk-frames",
+        help="Number of frames of each chunk streamed to the browser",
+        type=int,
+        default=4096,
+    )
+
+    parser.add_argument(
+        "--host",
+        help="Host address of the server",
+        type=str,
+        default="127.0.0.1",
+    )
+
+    parser.add_argument(
+        "--port",
+        help="Port of the server",
+        type=int,
+        default=8765,
+    )
+
+    default_axis_limits = {
+        "x": (0, 5000),
+        "y": (0, 5000),
+        "z": (-1100, -500),
+    }
+
+    for axis in ["x", "y", "z"]:
+        parser.add_argument(
+            f"--{axis}lim",
+            help=f"{axis.upper()} axis limits in format 'min,max'",
+            type=parse_limit,
+            default=default_axis_limits[axis],
+        )
+
+    add_take_server_argument(parser)
+    add_processed_take_argument(parser)
+    add_resample_arguments(parser)
+
+    args = parser.parse_args()
+
+    web_player(
+        gantry_file=args.gantry,
+        optitrack_file=args.optitrack,
+        alignment_params_file=args.alignment,
+        calibration_params_file=args.calibration,
+        remove_bad_frames=args.remove_bad_frames,
+        bad_frames_file=args.bad_frames,
+        show_calibrated=args.show_calibrated,
+        trail_before_samples=args.trail_before,
+        trail_after_samples=args.trail_after,
+        chunk_frames=args.chunk_frames,
+        bounds=[args.xlim, args.ylim, args.zlim],
+        host=args.host,
+        port=args.port,
+        take_server=args.take_server,
+        processed_take=args.processed_take,
+        resample_rate=args.resample_rate,
+        anti_alias=args.anti_alias,
+        resample_cache_file=args.resample_cache,
+    )
@@ -0,0 +1,71 @@
+from collections.abc import Sequence
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+
+class SlidingWindowBuffer:
+    """Sliding window over a set of columns of a dataframe.
+
+    The columns are copied once into a contiguous array store, so moving the
+    window only slices views of the store and shifts the time axis of the
+    window into a preallocated buffer. The values of a single frame can also be
+    read from the store without materializing a row of the dataframe.
+
+    Args:
+        df: Dataframe with the data
+        columns: Columns to keep in the array store
+        before_samples: Number of samples to include before the current frame
+        after_samples: Number of samples to include after the current frame
+        time_col: Name of the time column
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        columns: Sequence[str],
+        before_samples: int,
+        after_samples: int,
+        time_col: str = "time",
+    ):
+        self.before_samples = before_samples
+        self.after_samples = after_samples
+        self.num_frames = len(df)
+
+        self.time = df[time_col].to_numpy(dtype=np.float64, copy=True)
+        self.data = np.ascontiguousarray(df[list(columns)].to_numpy(dtype=np.float64).T)
+        self.col_idx = {col: i for i, col in enumerate(columns)}
+
+        self.rel_time = np.empty(before_samples + after_samples, dtype=np.float64)
+        self.frame_idx: int | None = None
+        self.start = 0
+        self.end = 0
+
+    def update(self, frame_idx: int, frame_time: float) -> None:
+        """Move the window to the given frame."""
+        if frame_idx == self.frame_idx:
+            return
+
+        self.frame_idx = frame_idx
+        self.start = max(0, frame_idx - self.before_samples)
+        self.end = min(self.num_frames, frame_idx + self.after_samples)
+
+        np.subtract(
+            self.time[self.start : self.end],
+            frame_time,
+            out=self.rel_time[: self.end - self.start],
+        )
+
+    def times(self) -> npt.NDArray[np.float64]:
+        """Time of the window samples relative to the current frame time."""
+        return self.rel_time[: self.end - self.start]
+
+    def values(self, col: str) -> npt.NDArray[np.float64]:
+        """Values of a column in the window (a view of the array store)."""
+        return self.data[self.col_idx[col], self.start : self.end]
+
+    def frame_values(self, cols: Sequence[str]) -> tuple[float, ...]:
+        """Values of the given columns at the current frame."""
+        assert self.frame_idx is not None, "The window has not been updated yet"
+        return tuple(self.data[self.col_idx[col], self.frame_idx].item() for col in cols)
@@ -85,6 +85,10 @@ HAL pins (defaults in parentheses):
   calibxyzkins.max-iter (10) -- Maximum number of iterations for the
                                 inverse kinematics
   calibxyzkins.tol (1e-3) -- Tolerance for the inverse kinematics
+  calibxyzkins.inverse-iter -- Number of iterations of the last inverse
+                               kinematics (output)
+  calibxyzkins.inverse-error -- Error norm of the last inverse kinematics
+                                (output)
 
 ---------------------------------------------------------------------*/
 
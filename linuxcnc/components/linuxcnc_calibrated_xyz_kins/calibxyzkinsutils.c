@@ -251,8 +251,20 @@ int init_hal_pins(int comp_id, haldata_t *haldata) {
     return res;
   }
 
+  if ((res = hal_pin_u32_newf(HAL_OUT, &haldata->inverse_iter, comp_id,
+                              "calibxzkins.inverse-iter")) < 0) {
+    return res;
+  }
+
+  if ((res = hal_pin_float_newf(HAL_OUT, &haldata->inverse_error, comp_id,
+                                "calibxzkins.inverse-error")) < 0) {
+    return res;
+  }
+
   *haldata->max_iter = 10;
   *haldata->tol = 1e-3;
+  *haldata->inverse_iter = 0;
+  *haldata->inverse_error = 0;
 
   return 0;
 }
@@ -433,6 +445,8 @@ int calib_xyz_kins_inverse(const joints_mapping_t *joints_mapping,
 
   double xyz_pos[3] = {pos->tran.x, pos->tran.y, pos->tran.z};
   double xyz_joints[3];
+  double F_norm = 0;
+  unsigned int num_iter = 0;
 
   read_hal_calibration_params(haldata, A, B, C);
   read_hal_joints_limits_params(haldata, joints_min, joints_max);
@@ -440,7 +454,11 @@ int calib_xyz_kins_inverse(const joints_mapping_t *joints_mapping,
   // Get calibrated XYZ joint values from XYZ position values
   // The returned joint values are within the specified bounds
   calib_xyz_inverse(A, B, C, joints_min, joints_max, *haldata->max_iter,
-                    *haldata->tol, xyz_pos, xyz_joints, NULL);
+                    *haldata->tol, xyz_pos, xyz_joints, &F_norm, &num_iter);
+
+  // Export the convergence of the inverse kinematics, e.g., for the sampler
+  *haldata->inverse_iter = num_iter;
+  *haldata->inverse_error = F_norm;
 
   for (int jno = 0; jno < EMCMOT_MAX_JOINTS; ++jno) {
     int axno = joints_mapping->axno_for_jno[jno];
@@ -38,6 +38,7 @@
  * Pins:
  *  - Max iterations for inverse kinematics
  *  - Tolerance for inverse kinematics
+ *  - Iterations and error norm of the last inverse kinematics (outputs)
  */
 typedef struct {
   hal_float_t calib_m_A[3][3];
@@ -47,6 +48,8 @@ typedef struct {
   hal_float_t joints_max[3];
   hal_u32_t *max_iter;
   hal_float_t *tol;
+  hal_u32_t *inverse_iter;
+  hal_float_t *inverse_error;
 } haldata_t;
 
 /*
@@ -50,7 +50,8 @@ int calib_xyz_inverse(const double A[3][3], const double B[3][3],
                       const double C[3], const double *min_bounds,
                       const double *max_bounds, const unsigned int max_iter,
                       const double tol, const double position[3],
-                      double joints[3], double *F_norm) {
+                      double joints[3], double *F_norm,
+                      unsigned int *num_iter) {
   double F[3];
   double F_norm_val;
   double J[3][3];
@@ -71,7 +72,9 @@ int calib_xyz_inverse(const double A[3][3], const double B[3][3],
     }
   }
 
-  for (int iter = 0; iter < max_iter; ++iter) {
+  unsigned int iter;
+
+  for (iter = 0; iter < max_iter; ++iter) {
     // F = A * joints + B * joints^2 + C - position
     for (int i = 0; i < 3; ++i) {
       F[i] = C[i] - position[i];
@@ -125,6 +128,10 @@ int calib_xyz_inverse(const double A[3][3], const double B[3][3],
     *F_norm = F_norm_val;
   }
 
+  if (num_iter != NULL) {
+    *num_iter = iter;
+  }
+
   return 0;
 }
 
@@ -56,7 +56,9 @@ void calib_xyz_forward(const double A[3][3], const double B[3][3],
  * number of iterations and minimum tolerance of the method are controlled with
  * the max_iter and tol parameters, respectively. If min_bounds and max_bounds
  * parameters are not NULL then the obtained joints positions will be within the
- * specified bounds.
+ * specified bounds. If F_norm is not NULL it is set to the norm of the error of
+ * the last iteration, and if num_iter is not NULL it is set to the number of
+ * Newton-Raphson updates performed.
  *
  * The Jacobian matrix for this problem is:
  *
@@ -73,7 +75,8 @@ int calib_xyz_inverse(const double A[3][3], const double B[3][3],
                       const double C[3], const double *min_bounds,
                       const double *max_bounds, const unsigned int max_iter,
                       const double tol, const double position[3],
-                      double joints[3], double *F_norm);
+                      double joints[3], double *F_norm,
+                      unsigned int *num_iter);
 
 /*
  * Check that inverse exist within min and max bounds for calibration matrices A